@@ -0,0 +1,92 @@
+"""
+Compares the archive compression codecs on a directory
+
+usage: python benchmarks/compression.py [directory]
+
+Without a directory, a mix of text logs, random binaries and an already
+compressed file is generated
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tubular.file_utils import compressArchive, decompressArchive
+
+CODECS = [
+    "store", "deflate:1", "deflate", "deflate:9", "bz2", "lzma", "zstd",
+    "adaptive"
+]
+
+MB = 1024 * 1024
+
+
+def makeSample(path: str):
+    rand = random.Random(0)
+    os.makedirs(os.path.join(path, "logs"))
+    os.makedirs(os.path.join(path, "bin"))
+
+    words = ["build", "test", "ok", "warning", "compile", "link", "src/main.c"]
+    with open(os.path.join(path, "logs", "build.log"), mode='w') as f:
+        for idx in range(400000):
+            f.write(
+                f"[{idx:08}] {' '.join(rand.choices(words, k=8))} {rand.random()}\n"
+            )
+
+    with open(os.path.join(path, "bin", "app.bin"), mode='wb') as f:
+        f.write(rand.randbytes(16 * MB))
+
+    with zipfile.ZipFile(os.path.join(path, "bin", "libs.jar"),
+                         mode='w',
+                         compression=zipfile.ZIP_DEFLATED) as f:
+        f.writestr("data.txt", "".join(
+            f"{rand.random()}\n" for _ in range(800000)))
+
+
+def getSize(path: str) -> int:
+    out = 0
+    for root, _, files in os.walk(path):
+        for x in files:
+            out += os.path.getsize(os.path.join(root, x))
+    return out
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp:
+        if len(sys.argv) > 1:
+            source = sys.argv[1]
+        else:
+            source = os.path.join(temp, "sample")
+            makeSample(source)
+
+        size = getSize(source)
+        print(f"{size / MB:.1f} MB in {source}\n")
+        print(f"{'codec':<10} {'ratio':>7} {'comp MB/s':>10} {'decomp MB/s':>12}")
+
+        for codec in CODECS:
+            out = os.path.join(temp, f"{codec}.zip")
+            try:
+                start = time.perf_counter()
+                compressArchive(source, out, codec)
+                compTime = time.perf_counter() - start
+            except RuntimeError as err:
+                print(f"{codec:<10} {err}")
+                continue
+
+            extracted = os.path.join(temp, f"{codec}.out")
+            start = time.perf_counter()
+            decompressArchive(out, extracted)
+            decompTime = time.perf_counter() - start
+
+            ratio = os.path.getsize(out) / size
+            print(f"{codec:<10} {ratio:>7.3f} {size / MB / compTime:>10.1f} "
+                  f"{size / MB / decompTime:>12.1f}")
+            os.remove(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures the artifact download throughput between a node and the controller
+
+usage: python benchmarks/download.py [size in MB]
+
+Serves a random file the same way the nodes do, then downloads it with
+the controller's downloadFile and with the old unchunked iter_content
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import FileResponse
+
+from tubular.file_utils import writeChecksum, readChecksum, CHECKSUM_HEADER
+from tubular_controller.nodeConnection import downloadFile
+
+MB = 1024 * 1024
+# the old path is too slow to download the whole file
+OLD_SIZE = 1 * MB
+
+
+def startServer(path: str) -> str:
+    app = FastAPI()
+
+    @app.get("/file")
+    async def getFile() -> FileResponse:
+        return FileResponse(path,
+                            headers={CHECKSUM_HEADER: str(readChecksum(path))})
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    config = uvicorn.Config(app,
+                            host="127.0.0.1",
+                            port=port,
+                            log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}/file"
+
+
+def main():
+    size = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 512 * MB
+
+    with tempfile.TemporaryDirectory() as temp:
+        source = os.path.join(temp, "source.zip")
+        with open(source, mode='wb') as f:
+            for _ in range(size // MB):
+                f.write(os.urandom(MB))
+        writeChecksum(source)
+
+        url = startServer(source)
+        session = requests.Session()
+        dest = os.path.join(temp, "dest.zip")
+
+        start = time.perf_counter()
+        downloadFile(session, url, dest)
+        elapsed = time.perf_counter() - start
+        print(f"downloadFile:        {size / MB / elapsed:8.1f} MB/s"
+              f" ({size // MB} MB, checksum verified)")
+
+        start = time.perf_counter()
+        with session.get(url, stream=True) as r:
+            with open(dest, mode='wb') as f:
+                for chunk in r.iter_content():
+                    f.write(chunk)
+                    if f.tell() >= OLD_SIZE:
+                        break
+        elapsed = time.perf_counter() - start
+        print(f"iter_content():      {OLD_SIZE / MB / elapsed:8.1f} MB/s"
+              f" (first {OLD_SIZE // MB} MB)")
+
+
+if __name__ == "__main__":
+    main()
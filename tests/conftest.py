@@ -0,0 +1,76 @@
+import os
+import subprocess
+from typing import Any
+
+import yaml
+
+from tubular import git_cmds
+from tubular.pipeline import Pipeline, PipelineDef, PipelineReq
+from tubular.repo import Repo
+
+REPO_URL = "file:///repo"
+BRANCH = "main"
+
+
+def writeYAML(path: str, data: dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w') as f:
+        yaml.safe_dump(data, f)
+
+
+def writeTask(repoPath: str,
+              name: str,
+              steps: list[dict[str, Any]] | None = None,
+              meta: dict[str, Any] | None = None):
+    config: dict[str, Any] = {"steps": steps or []}
+    if meta is not None:
+        config["meta"] = meta
+    writeYAML(os.path.join(repoPath, f"{name}.yaml"), config)
+
+
+def writePipeline(repoPath: str,
+                  stages: list[list],
+                  meta: dict[str, Any] | None = None,
+                  file: str = "p.yaml") -> PipelineDef:
+    """
+    Writes the pipeline, its tasks must already be written
+    """
+    config: dict[str, Any] = {
+        "stages": [{"display": f"S{idx}", "tasks": tasks}
+                   for idx, tasks in enumerate(stages)]
+    }
+    if meta is not None:
+        config["meta"] = meta
+    writeYAML(os.path.join(repoPath, file), config)
+    return PipelineDef(repoPath, file)
+
+
+def makePipeline(repoPath: str,
+                 pipelineDef: PipelineDef,
+                 priority: str = "manual",
+                 commit: bytes = b"") -> Pipeline:
+    req = PipelineReq(branch=BRANCH,
+                      pipeline_path=pipelineDef.file,
+                      args=[],
+                      priority=priority)
+    return Pipeline(REPO_URL, pipelineDef, req,
+                    os.path.join(repoPath, "archive"),
+                    os.path.join(repoPath, "output"), commit)
+
+
+def commitRepo(path: str) -> tuple[Repo, bytes]:
+    """
+    Commit everything in the directory, making it a git repo if it isn't
+    one yet. Returns the repo and the new commit
+    """
+    if not os.path.isdir(os.path.join(path, ".git")):
+        _git(path, "init", "-q", "-b", BRANCH)
+    _git(path, "add", "-A")
+    _git(path, "-c", "user.name=test", "-c", "user.email=test@localhost",
+         "commit", "-q", "--allow-empty", "-m", "test")
+    repo = Repo(REPO_URL, BRANCH, path)
+    return repo, bytes(git_cmds.getCurrentLocalCommit(repo))
+
+
+def _git(path: str, *args: str):
+    subprocess.run(["git", *args], cwd=path, check=True)
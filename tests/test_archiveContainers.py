@@ -0,0 +1,75 @@
+import os
+import zipfile
+
+from tubular import file_utils
+from tubular.file_utils import compressArchive
+from tubular_controller import archiveContainers
+
+SMALL = b"small file\n" * 10
+LARGE = bytes(range(256)) * 64
+
+
+def _makeRun(tmp_path, monkeypatch) -> str:
+    """
+    A run's archive with one task zip holding a small compressed file and
+    a large stored one
+    """
+    monkeypatch.setattr(file_utils, "SEEKABLE_SIZE", 4096)
+    taskDir = os.path.join(tmp_path, "task")
+    os.makedirs(os.path.join(taskDir, "out"))
+    with open(os.path.join(taskDir, "out", "small.txt"), mode='wb') as f:
+        f.write(SMALL)
+    with open(os.path.join(taskDir, "out", "large.bin"), mode='wb') as f:
+        f.write(LARGE)
+    archiveZip = os.path.join(tmp_path, "task.zip")
+    compressArchive(taskDir, archiveZip, "deflate")
+
+    archivePath = os.path.join(tmp_path, "archive")
+    archiveContainers.addContainer(archivePath, "a", archiveZip)
+    return archivePath
+
+
+def test_largeFilesAreStored(tmp_path, monkeypatch):
+    archivePath = _makeRun(tmp_path, monkeypatch)
+    container = os.path.join(archiveContainers.getContainerDir(archivePath),
+                             "a.zip")
+    with zipfile.ZipFile(container) as f:
+        assert f.getinfo("out/large.bin").compress_type == zipfile.ZIP_STORED
+        assert f.getinfo("out/small.txt").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_listMembers(tmp_path, monkeypatch):
+    archivePath = _makeRun(tmp_path, monkeypatch)
+    members = archiveContainers.listMembers(archivePath)
+    assert members == {
+        os.path.join("out", "small.txt"): len(SMALL),
+        os.path.join("out", "large.bin"): len(LARGE),
+    }
+
+
+def test_seekStoredMember(tmp_path, monkeypatch):
+    archivePath = _makeRun(tmp_path, monkeypatch)
+    member = archiveContainers.findMember(archivePath, "out/large.bin")
+    assert member is not None and member.size == len(LARGE)
+    with member.open() as f:
+        assert f.seekable()
+        f.seek(5000)
+        assert f.read(100) == LARGE[5000:5100]
+        f.seek(-10, os.SEEK_END)
+        assert f.read() == LARGE[-10:]
+        f.seek(0)
+        assert f.read() == LARGE
+
+
+def test_readCompressedMember(tmp_path, monkeypatch):
+    archivePath = _makeRun(tmp_path, monkeypatch)
+    member = archiveContainers.findMember(archivePath, "out/small.txt")
+    assert member is not None
+    with member.open() as f:
+        f.seek(11)
+        assert f.read() == SMALL[11:]
+
+
+def test_missingMember(tmp_path, monkeypatch):
+    archivePath = _makeRun(tmp_path, monkeypatch)
+    assert archiveContainers.findMember(archivePath, "out/nope") is None
@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+import pytest
+
+from tubular_controller.blobStore import BlobStore
+
+
+@pytest.fixture
+def store(tmp_path) -> BlobStore:
+    out = BlobStore()
+    out.setWorkspace(os.path.join(tmp_path, "blobs"))
+    return out
+
+
+def _writeArchive(path: str, files: dict[str, bytes]):
+    for name, data in files.items():
+        file = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, mode='wb') as f:
+            f.write(data)
+
+
+def _listBlobs(store: BlobStore) -> set[str]:
+    return {x for _, _, files in os.walk(store.path) for x in files}
+
+
+def test_dedupeLinksIdenticalFiles(tmp_path, store):
+    run1 = os.path.join(tmp_path, "run1")
+    run2 = os.path.join(tmp_path, "run2")
+    _writeArchive(run1, {"a.txt": b"same", "b.txt": b"other"})
+    _writeArchive(run2, {"sub/a.txt": b"same"})
+
+    hashes, storedBytes = store.dedupe(run1)
+    assert hashes == {
+        "a.txt": hashlib.sha256(b"same").hexdigest(),
+        "b.txt": hashlib.sha256(b"other").hexdigest(),
+    }
+    assert storedBytes == len(b"same") + len(b"other")
+    # the blob is shared, so it's only stored once
+    assert store.dedupe(run2)[1] == 0
+
+    assert _listBlobs(store) == set(hashes.values())
+    a1 = os.stat(os.path.join(run1, "a.txt"))
+    a2 = os.stat(os.path.join(run2, "sub", "a.txt"))
+    assert a1.st_ino == a2.st_ino
+    # the two runs and the store
+    assert a1.st_nlink == 3
+    with open(os.path.join(run2, "sub", "a.txt"), mode='rb') as f:
+        assert f.read() == b"same"
+
+
+def test_dedupeSkipsEmptyAndDedupedFiles(tmp_path, store):
+    run = os.path.join(tmp_path, "run")
+    _writeArchive(run, {"empty": b"", "a.txt": b"data"})
+    assert list(store.dedupe(run)[0]) == ["a.txt"]
+    # files added later are picked up by another dedupe
+    _writeArchive(run, {"late.txt": b"late"})
+    assert list(store.dedupe(run)[0]) == ["late.txt"]
+    with open(store.getManifestPath(run), mode='r') as f:
+        assert len(f.read().split()) == 2
+
+
+def test_removeTreeKeepsSharedBlobs(tmp_path, store):
+    run1 = os.path.join(tmp_path, "run1")
+    run2 = os.path.join(tmp_path, "run2")
+    _writeArchive(run1, {"a.txt": b"same", "b.txt": b"only run1"})
+    _writeArchive(run2, {"a.txt": b"same"})
+    store.dedupe(run1)
+    store.dedupe(run2)
+
+    store.removeTree(run1)
+    assert not os.path.exists(run1)
+    assert not os.path.exists(store.getManifestPath(run1))
+    assert _listBlobs(store) == {hashlib.sha256(b"same").hexdigest()}
+
+    store.removeTree(run2)
+    assert _listBlobs(store) == set()
+
+
+def test_collectAll(tmp_path, store):
+    run = os.path.join(tmp_path, "run")
+    _writeArchive(run, {"a.txt": b"data"})
+    store.dedupe(run)
+    # i.e. stopped after removing the files but before the blobs
+    os.remove(os.path.join(run, "a.txt"))
+    store.collectAll()
+    assert _listBlobs(store) == set()
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+from conftest import BRANCH, writeTask, writePipeline, commitRepo
+
+from tubular.pipeline import PipelineReq
+from tubular.pipeline_db import PipelineDB
+from tubular_controller.controller import ControllerState
+
+
+class _State:
+    """
+    A controller with a pipeline repo to fetch runs from, only run setup
+    is used
+    """
+
+    def __init__(self, path: str) -> None:
+        self.remote = os.path.join(path, "remote")
+        os.makedirs(self.remote)
+        writeTask(self.remote, "a")
+        writePipeline(self.remote, [["a"]], meta={"coalesce": True})
+        writePipeline(self.remote, [["a"]],
+                      meta={"coalesce": False},
+                      file="solo.yaml")
+        commitRepo(self.remote)
+
+        self.ctrl = ControllerState()
+        self.ctrl.pipelineRepoUrl = self.remote
+        self.ctrl.pipelineRepoPath = os.path.join(path, "pipelines")
+        self.db = PipelineDB(os.path.join(path, "db.sqlite"))
+        self.ctrl._db = self.db
+        self.admitted: list[PipelineReq] = []
+        self.ctrl._admitRun = lambda func, req, *args: self.admitted.append(
+            req)
+
+    def prepare(self, req: PipelineReq) -> int | None:
+        """
+        Returns the new run's number, None if it was merged
+        """
+        prepared = self.ctrl._prepareRun(req)
+        return None if prepared is None else prepared[1]
+
+    def getMerged(self, file: str = "p.yaml") -> dict[int, int]:
+        return self.db.getMergedCounts(self.db.getPipelineId(file))
+
+
+@pytest.fixture
+def state(tmp_path):
+    out = _State(os.fspath(tmp_path))
+    yield out
+    out.ctrl.stop()
+
+
+def _makeReq(args: dict[str, str] | None = None,
+             file: str = "p.yaml") -> PipelineReq:
+    return PipelineReq(branch=BRANCH,
+                       pipeline_path=file,
+                       args=[{"k": k, "v": v} for k, v in (args or {}).items()])
+
+
+def test_identicalRequestsMerged(state):
+    assert state.prepare(_makeReq()) == 1
+    assert state.prepare(_makeReq()) is None
+    assert state.getMerged() == {1: 1}
+
+
+def test_differentArgsNotMerged(state):
+    assert state.prepare(_makeReq({"x": "1"})) == 1
+    assert state.prepare(_makeReq({"x": "2"})) == 2
+    assert state.getMerged() == {}
+
+
+def test_newCommitNotMerged(state):
+    assert state.prepare(_makeReq()) == 1
+    with open(os.path.join(state.remote, "README"), mode='w') as f:
+        f.write("new commit\n")
+    commitRepo(state.remote)
+    assert state.prepare(_makeReq()) == 2
+
+
+def test_coalesceOff(state):
+    assert state.prepare(_makeReq(file="solo.yaml")) == 1
+    assert state.prepare(_makeReq(file="solo.yaml")) == 2
+
+
+def test_finishedRunsNotMerged(state):
+    prepared = state.ctrl._prepareRun(_makeReq())
+    assert prepared is not None
+    state.ctrl._removeRunKeys(prepared[5])
+    assert state.prepare(_makeReq()) == 2
+
+
+def test_mergedBeforeAdmission(state):
+    assert state.ctrl.queuePipeline(_makeReq()) is None
+    assert len(state.admitted) == 1
+    assert state.prepare(state.admitted[0]) == 1
+
+    runID = state.ctrl.queuePipeline(_makeReq())
+    assert runID == (state.db.getPipelineId("p.yaml"), 1)
+    # never queued or admitted
+    assert len(state.admitted) == 1
+    assert state.db.getQueuedRequests() == [
+        (1, state.admitted[0].model_dump_json())
+    ]
+    assert state.getMerged() == {1: 1}
+
+    # a new commit on the branch isn't the same request anymore
+    commitRepo(state.remote)
+    assert state.ctrl.queuePipeline(_makeReq()) is None
+    assert len(state.admitted) == 2
@@ -0,0 +1,40 @@
+import pytest
+
+from tubular_controller.controller_router import _parseRange
+
+SIZE = 100
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=10-", (10, 99)),
+    ("bytes=90-500", (90, 99)),
+    ("bytes = 5-5", (5, 5)),
+    # suffix ranges are the last n bytes
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+])
+def test_parseRange(header: str, expected: tuple[int, int]):
+    assert _parseRange(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=-0",
+    "bytes=100-",
+    "bytes=50-10",
+])
+def test_parseRangeUnsatisfiable(header: str):
+    assert _parseRange(header, SIZE) is None
+
+
+@pytest.mark.parametrize("header", [
+    "items=0-9",
+    "bytes=0-9,20-29",
+    "bytes=abc-",
+    "bytes=0-x",
+    "bytes=-",
+    "bytes",
+])
+def test_parseRangeMalformed(header: str):
+    with pytest.raises(ValueError):
+        _parseRange(header, SIZE)
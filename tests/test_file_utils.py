@@ -0,0 +1,123 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from tubular import file_utils
+from tubular.file_utils import streamArchive, extractArchiveStream
+
+
+def _writeFiles(path: str, files: dict[str, bytes]):
+    for name, data in files.items():
+        file = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, mode='wb') as f:
+            f.write(data)
+
+
+def _readFiles(path: str) -> dict[str, bytes]:
+    out: dict[str, bytes] = {}
+    for root, _, files in os.walk(path):
+        for x in files:
+            with open(os.path.join(root, x), mode='rb') as f:
+                out[os.path.relpath(os.path.join(root, x), path)] = f.read()
+    return out
+
+
+@pytest.fixture
+def noDataFilter(monkeypatch):
+    # like the Pythons before extraction filters
+    if hasattr(tarfile, "data_filter"):
+        monkeypatch.delattr(tarfile, "data_filter")
+
+
+@pytest.mark.parametrize("filtered", [True, False])
+def test_streamRoundTrip(tmp_path, monkeypatch, filtered):
+    if not filtered:
+        monkeypatch.delattr(tarfile, "data_filter", raising=False)
+    # so the archive takes many chunks
+    monkeypatch.setattr(file_utils, "STREAM_CHUNK_SIZE", 1000)
+    src = os.path.join(tmp_path, "src")
+    files = {
+        "a.txt": b"a" * 5000,
+        os.path.join("sub", "b.bin"): bytes(range(256)) * 20,
+        "empty": b"",
+    }
+    _writeFiles(src, files)
+    os.symlink("a.txt", os.path.join(src, "link"))
+
+    chunks = list(streamArchive(src))
+    assert len(chunks) > 1
+
+    dest = os.path.join(tmp_path, "dest")
+    extractArchiveStream(io.BytesIO(b"".join(chunks)), dest)
+    assert _readFiles(dest) == {**files, "link": files["a.txt"]}
+    assert os.readlink(os.path.join(dest, "link")) == "a.txt"
+
+
+def test_streamStopsWhenClosed(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_utils, "STREAM_CHUNK_SIZE", 100)
+    src = os.path.join(tmp_path, "src")
+    _writeFiles(src, {f"{x}.txt": b"x" * 1000 for x in range(100)})
+
+    stream = streamArchive(src)
+    assert len(next(stream)) > 0
+    # the packing thread gives up instead of waiting on the queue
+    stream.close()
+
+
+def _makeTar(members: list[tarfile.TarInfo]) -> io.BytesIO:
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w|") as tar:
+        for member in members:
+            data = b"data" if member.isfile() else b""
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    out.seek(0)
+    return out
+
+
+def _makeMember(name: str,
+                type: bytes = tarfile.REGTYPE,
+                linkname: str = "") -> tarfile.TarInfo:
+    out = tarfile.TarInfo(name)
+    out.type = type
+    out.linkname = linkname
+    return out
+
+
+@pytest.mark.parametrize("member", [
+    _makeMember("/etc/evil"),
+    _makeMember("../evil"),
+    _makeMember("sub/../../evil"),
+    _makeMember("link", tarfile.SYMTYPE, "../outside"),
+    _makeMember("link", tarfile.SYMTYPE, "/etc/passwd"),
+    _makeMember("hard", tarfile.LNKTYPE, "../outside"),
+    _makeMember("dev", tarfile.CHRTYPE),
+    _makeMember("fifo", tarfile.FIFOTYPE),
+])
+def test_unsafeMembersRejected(tmp_path, noDataFilter, member):
+    dest = os.path.join(tmp_path, "dest")
+    with pytest.raises(RuntimeError):
+        extractArchiveStream(_makeTar([member]), dest)
+    assert not os.path.exists(os.path.join(tmp_path, "evil"))
+
+
+def test_linkThroughExtractedSymlinkRejected(tmp_path, noDataFilter):
+    dest = os.path.join(tmp_path, "dest")
+    members = [
+        _makeMember("up", tarfile.SYMTYPE, ".."),
+        _makeMember("up/evil"),
+    ]
+    with pytest.raises(RuntimeError):
+        extractArchiveStream(_makeTar(members), dest)
+    assert not os.path.exists(os.path.join(tmp_path, "evil"))
+
+
+def test_specialBitsDropped(tmp_path, noDataFilter):
+    dest = os.path.join(tmp_path, "dest")
+    member = _makeMember("tool")
+    member.mode = 0o4755
+    extractArchiveStream(_makeTar([member]), dest)
+    assert os.stat(os.path.join(dest, "tool")).st_mode & 0o7777 == 0o755
@@ -0,0 +1,114 @@
+import hashlib
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+from tubular.artifacts import ArtifactCache, ArtifactSource
+from tubular.pipeline_db import PipelineDB
+from tubular_controller import archiveContainers
+from tubular_controller.controller import ControllerState
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class _Run:
+    """
+    A run whose tasks a and then b both archived out/x
+    """
+
+    def __init__(self, path: str) -> None:
+        self.ctrl = ControllerState()
+        self.ctrl.pipelineRepoPath = os.path.join(path, "pipelines")
+        self.ctrl._db = PipelineDB(os.path.join(path, "db.sqlite"))
+        self.archivePath = self.ctrl._getArchivePath("main", "p", 1)
+        self._addTask(path, "a", {"out/x": b"from a", "out/y": b"only a"})
+        self._addTask(path, "b", {"out/x": b"from b", "other": b"b"})
+
+    def _addTask(self, path: str, name: str, files: dict[str, bytes]):
+        archiveZip = os.path.join(path, f"{name}.zip")
+        with zipfile.ZipFile(archiveZip, mode='w') as f:
+            for file, data in files.items():
+                f.writestr(file, data)
+        archiveContainers.addContainer(self.archivePath, name, archiveZip)
+        # the containers are ordered by mtime
+        time.sleep(0.01)
+
+    def read(self, file: str, task: str | None = None) -> bytes:
+        with self.ctrl.getArchiveFile("p.yaml", "main", 1, file,
+                                      task).open() as f:
+            return f.read()
+
+
+@pytest.fixture
+def run(tmp_path):
+    out = _Run(os.fspath(tmp_path))
+    yield out
+    out.ctrl.stop()
+
+
+def test_manifestScopedToTask(run):
+    manifest = run.ctrl.getArchiveManifest("p.yaml", "main", 1, "out", "a")
+    assert manifest == [
+        {"path": os.path.join("out", "x"), "size": 6,
+         "sha256": _sha256(b"from a")},
+        {"path": os.path.join("out", "y"), "size": 6,
+         "sha256": _sha256(b"only a")},
+    ]
+    assert run.ctrl.getArchiveManifest("p.yaml", "main", 1, "", "b") == [
+        {"path": "other", "size": 1, "sha256": _sha256(b"b")},
+        {"path": os.path.join("out", "x"), "size": 6,
+         "sha256": _sha256(b"from b")},
+    ]
+    assert run.ctrl.getArchiveManifest("p.yaml", "main", 1, "", "c") == []
+
+
+def test_fileScopedToTask(run):
+    # the last task to archive a path wins when no task is given
+    assert run.read("out/x") == b"from b"
+    assert run.read("out/x", "a") == b"from a"
+    with pytest.raises(RuntimeError, match="Path not found"):
+        run.read("other", "a")
+
+
+@pytest.fixture
+def cache(tmp_path) -> ArtifactCache:
+    out = ArtifactCache()
+    out.setWorkspace(os.path.join(tmp_path, "cache"))
+    return out
+
+
+def test_fetchFromCache(tmp_path, cache):
+    digest = _sha256(b"cached")
+    entry = cache._getEntryPath(digest)
+    os.makedirs(os.path.dirname(entry))
+    with open(entry, mode='wb') as f:
+        f.write(b"cached")
+    os.utime(entry, (0, 0))
+
+    # no urls, so it can only come from the cache
+    source = ArtifactSource(task="a", task_id="1")
+    dest = os.path.join(tmp_path, "ws", "bin", "tool")
+    cache.fetch(source, {"path": "tool", "sha256": digest}, False, dest,
+                io.StringIO())
+    with open(dest, mode='rb') as f:
+        assert f.read() == b"cached"
+    # it's now the most recently used
+    assert os.stat(entry).st_mtime > 0
+
+
+def test_trimLeastRecentlyUsed(cache):
+    cache.maxBytes = 10
+    for idx, data in enumerate((b"oldest", b"newest")):
+        entry = cache._getEntryPath(_sha256(data))
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        with open(entry, mode='wb') as f:
+            f.write(data)
+        os.utime(entry, (idx, idx))
+    cache.trim()
+    assert not os.path.exists(cache._getEntryPath(_sha256(b"oldest")))
+    assert os.path.exists(cache._getEntryPath(_sha256(b"newest")))
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from tubular.enums import NodeStatus
+from tubular.pipeline_db import PipelineDB
+from tubular_controller import controller
+from tubular_controller.controller import ControllerState
+from tubular_node import node
+from tubular_node.node import NodeState, NodeSlot
+
+TASK_ID = "abc123"
+
+
+async def _collect(chunks) -> list:
+    return [x async for x in chunks]
+
+
+@pytest.fixture
+def fastPoll(monkeypatch):
+    monkeypatch.setattr(node, "LIVE_OUTPUT_POLL", 0.01)
+    monkeypatch.setattr(controller, "LIVE_OUTPUT_POLL", 0.01)
+
+
+def test_nodeFollowsRunningTask(tmp_path, fastPoll):
+    state = NodeState()
+    state.retainedPath = os.fspath(tmp_path)
+    slot = NodeSlot(0, os.fspath(tmp_path))
+    slot.taskID = TASK_ID
+    slot.status = NodeStatus.Active
+    slot.outputFile = os.path.join(tmp_path, "task.output")
+    state.slots[0] = slot
+    with open(slot.outputFile, mode='wb') as f:
+        f.write(b"first\n")
+
+    async def follow() -> list[bytes]:
+        chunks = state.followOutput(TASK_ID, 2)
+        out = [await anext(chunks)]
+        # the follower waits for more without holding up the loop
+        await asyncio.sleep(0.05)
+        with open(slot.outputFile, mode='ab') as f:
+            f.write(b"second\n")
+        out.append(await anext(chunks))
+        slot.status = NodeStatus.Idle
+        return out + await _collect(chunks)
+
+    assert asyncio.run(follow()) == [b"rst\n", b"second\n"]
+
+
+class _Run:
+    """
+    A finished run with the output of task a stored
+    """
+
+    def __init__(self, path: str) -> None:
+        self.ctrl = ControllerState()
+        self.ctrl.pipelineRepoPath = os.path.join(path, "pipelines")
+        self.ctrl._db = PipelineDB(os.path.join(path, "db.sqlite"))
+        outputPath = self.ctrl._getOutputPath("main", "p", 1)
+        os.makedirs(outputPath)
+        with open(os.path.join(outputPath, "a.output"), mode='wb') as f:
+            f.write(b"line 1\nline 2\n")
+
+    def stream(self, offset: int = 0):
+        return self.ctrl.streamTaskOutput("p.yaml", "main", 1, "a", offset)
+
+
+@pytest.fixture
+def run(tmp_path):
+    out = _Run(os.fspath(tmp_path))
+    yield out
+    out.ctrl.stop()
+
+
+def test_controllerReadsFinishedOutput(run):
+    chunks = run.stream(7)
+    assert chunks is not None
+    assert b"".join(x for _, x in asyncio.run(_collect(chunks))) == \
+        b"line 2\n"
+
+
+def test_controllerMissingOutput(run):
+    with pytest.raises(RuntimeError):
+        run.ctrl.streamTaskOutput("p.yaml", "main", 1, "b", 0)
+
+
+def test_controllerLimitsFollowers(run):
+    run.ctrl._followers = threading.BoundedSemaphore(1)
+    chunks = run.stream()
+    assert chunks is not None
+    assert run.stream() is None
+    # finished followers make room for new ones
+    asyncio.run(_collect(chunks))
+    assert run.stream() is not None
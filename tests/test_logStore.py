@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from tubular_controller import logStore
+from tubular_controller.logStore import LogIndex, Log
+
+NUM_LINES = 500
+
+
+@pytest.fixture
+def smallBlocks(monkeypatch):
+    # so a small log spans many checkpoints, read chunks and blocks
+    monkeypatch.setattr(logStore, "CHECKPOINT_BYTES", 64)
+    monkeypatch.setattr(logStore, "STREAM_CHUNK_SIZE", 50)
+    monkeypatch.setattr(logStore, "LOG_BLOCK_SIZE", 300)
+
+
+def _makeLines() -> list[bytes]:
+    # lines of varying length, some longer than a checkpoint
+    return [f"line {x} ".encode() + b"x" * (x % 97) + b"\n"
+            for x in range(NUM_LINES)]
+
+
+def _writeLog(tmp_path, lines: list[bytes]) -> str:
+    path = os.path.join(tmp_path, "task.output")
+    with open(path, mode='wb') as f:
+        f.writelines(lines)
+    return path
+
+
+def test_buildCountsLines(tmp_path, smallBlocks):
+    lines = _makeLines()
+    path = _writeLog(tmp_path, lines)
+    index = LogIndex.build(path)
+    assert index.numLines == NUM_LINES
+    assert index.size == sum(len(x) for x in lines)
+    assert len(index.checkpoints) > 10
+    assert index.checkpoints[0] == (0, 0)
+
+
+def test_buildWithoutTrailingNewline(tmp_path, smallBlocks):
+    path = _writeLog(tmp_path, [b"a\n", b"b"])
+    assert LogIndex.build(path).numLines == 2
+
+
+def test_buildFindsSteps(tmp_path, smallBlocks):
+    lines = [b"[ Run Task a ] (now)\n"] + _makeLines()[:50]
+    lines.insert(10, b"[ Script step-0.sh ] (T+ 0.30ms)\n")
+    lines.insert(40, b"[ Script step-1.sh ] (T+ 1.00s)\n")
+    lines.append(b"[ Task Complete ] (T+ 2.00s) (now)\n")
+    path = _writeLog(tmp_path, lines)
+
+    index = LogIndex.build(path)
+    assert [(x[0], x[1]) for x in index.steps] == [("Script step-0.sh", 10),
+                                                   ("Script step-1.sh", 40)]
+    assert index.end[0] == len(lines) - 1
+    with open(path, mode='rb') as f:
+        f.seek(index.steps[1][2])
+        assert f.readline() == lines[40]
+
+
+def _checkLines(log: Log, lines: list[bytes]):
+    offset = 0
+    for idx, line in enumerate(lines):
+        assert log.findLine(idx) == offset
+        offset += len(line)
+    assert log.findLine(len(lines)) == offset
+    # out of range lines are clamped
+    assert log.findLine(-5) == 0
+    assert log.findLine(len(lines) + 5) == offset
+
+
+def test_findLine(tmp_path, smallBlocks):
+    lines = _makeLines()
+    path = _writeLog(tmp_path, lines)
+    with Log(LogIndex.build(path), logStore._LogData(path)) as log:
+        _checkLines(log, lines)
+
+
+def test_findLineCompressed(tmp_path, smallBlocks):
+    lines = _makeLines()
+    _writeLog(tmp_path, lines)
+    logStore.indexLog(str(tmp_path), "task.output", compress=True)
+    assert not os.path.exists(os.path.join(tmp_path, "task.output"))
+
+    log = logStore.openLog(str(tmp_path), "task.output")
+    assert log is not None
+    with log:
+        assert log.index.blocks is not None
+        assert len(log.index.blocks) > 10
+        _checkLines(log, lines)
+        first, last, start, end = log.getLineRange(100, 50)
+        assert (first, last) == (100, 150)
+        assert b"".join(log.readRange(start, end)) == b"".join(
+            lines[100:150])
+
+
+def test_openLogWritesIndex(tmp_path, smallBlocks):
+    lines = _makeLines()
+    _writeLog(tmp_path, lines)
+    log = logStore.openLog(str(tmp_path), "task.output")
+    assert log is not None
+    with log:
+        assert log.index.numLines == NUM_LINES
+    assert os.path.exists(
+        logStore._getIndexPath(str(tmp_path), "task.output"))
+
+
+def test_openLogMissing(tmp_path):
+    assert logStore.openLog(str(tmp_path), "task.output") is None
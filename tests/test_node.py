@@ -0,0 +1,22 @@
+import os
+import threading
+import time
+
+from tubular_node.node import NodeState
+
+
+def test_expiredTaskFilesRemoved(tmp_path):
+    state = NodeState()
+    state.retainedPath = os.fspath(tmp_path)
+    state.retainDays = 1
+    for name, age in (("old", 2 * 24 * 60 * 60), ("new", 0)):
+        os.makedirs(os.path.join(tmp_path, name, "archive"))
+        mtime = time.time() - age
+        os.utime(os.path.join(tmp_path, name), (mtime, mtime))
+
+    state._cleanerThread = threading.Thread(target=state.cleanerThread)
+    state._cleanerThread.start()
+    # the first sweep runs right away, stopping waits for it
+    state.stop()
+    assert not state._cleanerThread.is_alive()
+    assert os.listdir(tmp_path) == ["new"]
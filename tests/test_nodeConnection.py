@@ -0,0 +1,45 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from tubular.file_utils import CHECKSUM_HEADER
+from tubular_controller.nodeConnection import downloadFile
+
+DATA = b"zip data"
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)))
+        self.send_header(CHECKSUM_HEADER, "0" * 64)
+        self.end_headers()
+        self.wfile.write(DATA)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    out = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=out.serve_forever)
+    thread.start()
+    yield f"http://127.0.0.1:{out.server_address[1]}"
+    out.shutdown()
+    thread.join()
+
+
+@pytest.mark.parametrize("path", ["/missing", "/bad_checksum"])
+def test_failedDownloadLeavesNothing(tmp_path, server, path):
+    dest = os.path.join(tmp_path, "task", "archive.zip")
+    with pytest.raises((requests.HTTPError, RuntimeError)):
+        downloadFile(requests.Session(), f"{server}{path}", dest)
+    assert not os.path.exists(dest)
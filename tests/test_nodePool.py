@@ -0,0 +1,66 @@
+from conftest import REPO_URL, BRANCH, writeTask, writePipeline, makePipeline
+
+from tubular.task import Task
+from tubular_controller.nodeConnection import NodeConnection
+from tubular_controller.nodePool import NodePool
+from tubular_node.node import NodeStatus
+
+COMMIT = bytes.fromhex("ab" * 20)
+
+
+def _makeNode(name: str, tags: list[str], idle: bool = True) -> NodeConnection:
+    node = NodeConnection(name, name, 8000, tags)
+    node.slots[0].status = NodeStatus.Idle if idle else NodeStatus.Active
+    return node
+
+
+def _warmUp(node: NodeConnection, task: Task):
+    node.slots[0].workspaces[(REPO_URL, BRANCH,
+                              task.meta.file)] = task.commit.hex()
+
+
+def _makeTask(tmp_path) -> Task:
+    writeTask(tmp_path, "a")
+    pipeline = makePipeline(tmp_path, writePipeline(tmp_path, [["a"]]),
+                            commit=COMMIT)
+    return next(pipeline.tasks())
+
+
+def _makePool(nodes: list[NodeConnection]) -> NodePool:
+    pool = NodePool()
+    pool.rebuild(nodes)
+    return pool
+
+
+def test_warmestNodeIsPicked(tmp_path):
+    task = _makeTask(tmp_path)
+    cold = _makeNode("cold", ["linux"])
+    warm = _makeNode("warm", ["linux"])
+    _warmUp(warm, task)
+    pool = _makePool([cold, warm])
+
+    classes = pool.getEligibleClasses({"linux"}, set())
+    assert pool.getWarmestNode(task, classes, cold) is warm
+
+
+def test_defaultKeptOnTies(tmp_path):
+    task = _makeTask(tmp_path)
+    first = _makeNode("first", ["linux"])
+    second = _makeNode("second", ["linux"])
+    pool = _makePool([first, second])
+
+    classes = pool.getEligibleClasses({"linux"}, set())
+    assert pool.getWarmestNode(task, classes, second) is second
+
+
+def test_busyOrIneligibleNodesSkipped(tmp_path):
+    task = _makeTask(tmp_path)
+    cold = _makeNode("cold", ["linux"])
+    busy = _makeNode("busy", ["linux"], idle=False)
+    other = _makeNode("other", ["windows"])
+    _warmUp(busy, task)
+    _warmUp(other, task)
+    pool = _makePool([cold, busy, other])
+
+    classes = pool.getEligibleClasses({"linux"}, set())
+    assert pool.getWarmestNode(task, classes, cold) is cold
@@ -0,0 +1,79 @@
+import pytest
+from conftest import writeTask, writePipeline, makePipeline
+
+
+def test_stagesAreBarriers(tmp_path):
+    for x in "abcd":
+        writeTask(tmp_path, x)
+    pipeline = writePipeline(tmp_path, [["a", "b"], ["c"], ["d"]])
+    assert pipeline.needs == {"a": [], "b": [], "c": ["a", "b"], "d": ["c"]}
+
+
+def test_explicitNeeds(tmp_path):
+    for x in "abc":
+        writeTask(tmp_path, x)
+    pipeline = writePipeline(tmp_path, [
+        ["a"],
+        ["b", {"task": "c", "needs": ["b"]}],
+    ])
+    assert pipeline.needs == {"a": [], "b": ["a"], "c": ["b"]}
+
+
+def test_needsCycle(tmp_path):
+    for x in "abc":
+        writeTask(tmp_path, x)
+    with pytest.raises(RuntimeError, match="cycle"):
+        writePipeline(tmp_path, [[
+            {"task": "a", "needs": ["c"]},
+            {"task": "b", "needs": ["a"]},
+            {"task": "c", "needs": ["b"]},
+        ]])
+
+
+def test_needsSelf(tmp_path):
+    writeTask(tmp_path, "a")
+    with pytest.raises(RuntimeError, match="cycle"):
+        writePipeline(tmp_path, [[{"task": "a", "needs": ["a"]}]])
+
+
+def test_needsUnknownTask(tmp_path):
+    writeTask(tmp_path, "a")
+    with pytest.raises(RuntimeError, match="unknown task 'missing'"):
+        writePipeline(tmp_path, [[{"task": "a", "needs": ["missing"]}]])
+
+
+def test_needsLaterStage(tmp_path):
+    for x in "ab":
+        writeTask(tmp_path, x)
+    with pytest.raises(RuntimeError, match="unknown task 'b'"):
+        writePipeline(tmp_path, [[{"task": "a", "needs": ["b"]}], ["b"]])
+
+
+def test_duplicateTask(tmp_path):
+    writeTask(tmp_path, "a")
+    with pytest.raises(RuntimeError, match="more than once"):
+        writePipeline(tmp_path, [["a"], ["a"]])
+
+
+def test_runLinksNeeds(tmp_path):
+    for x in "abc":
+        writeTask(tmp_path, x)
+    pipelineDef = writePipeline(tmp_path, [
+        ["a", "b"],
+        [{"task": "c", "needs": ["a"]}],
+    ])
+    tasks = {x.meta.name: x for x in makePipeline(tmp_path, pipelineDef).tasks()}
+    assert tasks["c"].needs == [tasks["a"]]
+    assert tasks["a"].needs == [] and tasks["b"].needs == []
+
+
+def test_archiveSourceMustBeAncestor(tmp_path):
+    for x in "ab":
+        writeTask(tmp_path, x)
+    writeTask(tmp_path, "c",
+              steps=[{"type": "get-archive", "task": "a", "path": "out"}])
+    pipelineDef = writePipeline(tmp_path, [["a"], ["b"], ["c"]])
+    tasks = {x.meta.name: x for x in makePipeline(tmp_path, pipelineDef).tasks()}
+    assert tasks["c"].meta.archiveSources == {"a"}
+    with pytest.raises(RuntimeError, match="doesn't depend on"):
+        writePipeline(tmp_path, [["a", "b"], [{"task": "c", "needs": ["b"]}]])
@@ -0,0 +1,108 @@
+import os
+import time
+
+import pytest
+from conftest import writeTask, writePipeline, makePipeline
+
+from tubular.enums import PipelineStatus
+from tubular.pipeline_db import PipelineDB, RemoteArtifact
+from tubular.repo import Repo
+from tubular_controller.controller import ControllerState, _PipelineRun
+
+CACHE_KEY = "1" * 64
+REMOTE_FILES = {os.path.join("out", "a.txt"): 5}
+
+
+@pytest.fixture
+def db(tmp_path) -> PipelineDB:
+    return PipelineDB(os.path.join(tmp_path, "db.sqlite"))
+
+
+def test_taskStateRoundTrip(db):
+    db.setTaskState(1, 2, "a", "abc", "node1", 0, PipelineStatus.Running,
+                    CACHE_KEY)
+    db.setTaskState(1, 2, "b", "def", None, None, PipelineStatus.Queued)
+    states = {x.name: x for x in db.getTaskStates(1, 2)}
+    assert states["a"].taskId == "abc"
+    assert (states["a"].node, states["a"].slot) == ("node1", 0)
+    assert states["a"].status == PipelineStatus.Running
+    assert states["a"].cacheKey == CACHE_KEY
+    assert states["b"].cacheKey is None
+
+    # later states replace earlier ones
+    db.setTaskState(1, 2, "a", "abc", None, None, PipelineStatus.Success,
+                    CACHE_KEY)
+    states = {x.name: x for x in db.getTaskStates(1, 2)}
+    assert states["a"].status == PipelineStatus.Success
+    assert db.getTaskStates(1, 3) == []
+
+
+def test_activeRunRoundTrip(db):
+    db.addActiveRun(1, 2, "{}", b"\x01\x02", 10.0)
+    runs = db.getActiveRuns()
+    assert len(runs) == 1
+    assert (runs[0].pipelineId, runs[0].runNum) == (1, 2)
+    assert bytes(runs[0].commit) == b"\x01\x02"
+    db.removeActiveRun(1, 2)
+    assert db.getActiveRuns() == []
+
+
+class _Run:
+    """
+    A run of a pipeline whose task b gets the archive of task a, stopped
+    after a finished with its files left on its node
+    """
+
+    def __init__(self, path: str) -> None:
+        writeTask(path, "a", meta={"cache": True})
+        writeTask(path, "b",
+                  steps=[{"type": "get-archive", "task": "a", "path": "out"}])
+        pipeline = makePipeline(path, writePipeline(path, [["a"], ["b"]]))
+        pipeline.id, pipeline.runNum = 1, 1
+
+        self.db = PipelineDB(os.path.join(path, "db.sqlite"))
+        self.db.addActiveRun(1, 1, "{}", b"", time.time())
+        self.db.setTaskState(1, 1, "a", "abc", None, None,
+                             PipelineStatus.Success, CACHE_KEY)
+        self.db.addRemoteArtifact(
+            RemoteArtifact(1, 1, "a", "abc", "node1", pipeline.archive,
+                           REMOTE_FILES))
+
+        self.ctrl = ControllerState()
+        self.ctrl._db = self.db
+        self.ctrl._getNodeClasses = lambda task: []
+        self.run = _PipelineRun(pipeline, Repo("", "", path), path,
+                                time.time(), [])
+        self.run.statuses = {x.meta.name: {} for x in pipeline.tasks()}
+        self.tasks = {x.meta.name: x for x in pipeline.tasks()}
+
+    def resume(self):
+        self.ctrl._restoreTasks(self.run, self.db.getActiveRuns()[0])
+
+
+@pytest.fixture
+def run(tmp_path):
+    out = _Run(os.fspath(tmp_path))
+    yield out
+    out.ctrl.stop()
+
+
+def test_resumeRestoresFinishedTasks(run):
+    run.resume()
+    a = run.tasks["a"]
+    assert a.status == PipelineStatus.Success
+    assert a.id == "abc"
+    # so b's cache key and archive sources can still be worked out
+    assert a.cacheKey == CACHE_KEY
+    assert a.remoteNode == "node1"
+    assert a.remoteFiles == REMOTE_FILES
+    assert run.run.remoteFiles == REMOTE_FILES
+    assert run.run.pending == [run.tasks["b"]]
+
+
+def test_resumeWithoutStatesRunsEverything(run):
+    run.db.removeRemoteArtifact(1, 1, "a")
+    run.ctrl._restoreTasks(run.run, None)
+    assert run.tasks["a"].cacheKey is None
+    assert run.run.remoteFiles == {}
+    assert run.run.pending == [run.tasks["a"], run.tasks["b"]]
@@ -0,0 +1,127 @@
+import os
+import time
+
+import pytest
+
+from tubular.pipeline_db import PipelineDB, StoredRun
+from tubular_controller.controller import ControllerState
+from tubular_controller.retention import RetentionLimits, selectExpiredRuns, SECONDS_PER_DAY
+
+
+def _makeRun(runNum: int,
+             ageDays: float = 0,
+             size: int = 0,
+             pinned: bool = False,
+             active: bool = False,
+             keepRuns: int = 0,
+             keepDays: float = 0,
+             maxBytes: int = 0,
+             pipelineId: int = 1) -> StoredRun:
+    return StoredRun(pipelineId, "p.yaml", "main", runNum,
+                     time.time() - ageDays * SECONDS_PER_DAY + runNum, size,
+                     pinned, active, keepRuns, keepDays, maxBytes)
+
+
+def _runNums(runs: list[StoredRun]) -> list[int]:
+    return [x.runNum for x in runs]
+
+
+def test_keepRunsSkipsNewestAndPinned():
+    # newest first, like the db returns them
+    runs = [
+        _makeRun(4, keepRuns=1),
+        _makeRun(3, keepRuns=1, pinned=True),
+        _makeRun(2, keepRuns=1),
+        _makeRun(1, keepRuns=1, active=True),
+        _makeRun(0, keepRuns=1),
+    ]
+    assert _runNums(selectExpiredRuns(runs, RetentionLimits())) == [0, 2]
+
+
+def test_keepDaysNeverRemovesNewest():
+    runs = [
+        _makeRun(2, ageDays=10, keepDays=1),
+        _makeRun(1, ageDays=10, keepDays=1, pinned=True),
+        _makeRun(0, ageDays=10, keepDays=1),
+    ]
+    assert _runNums(selectExpiredRuns(runs, RetentionLimits())) == [0]
+
+
+def test_globalKeepDaysOnlyWithoutOwn():
+    runs = [
+        _makeRun(2, ageDays=5),
+        _makeRun(1, ageDays=5, keepDays=10),
+        _makeRun(0, ageDays=5),
+    ]
+    assert _runNums(selectExpiredRuns(runs,
+                                      RetentionLimits(keepDays=1))) == [0]
+
+
+def test_pipelineQuotaCountsKeptRuns():
+    runs = [
+        _makeRun(2, size=60, maxBytes=100),
+        _makeRun(1, size=30, maxBytes=100, pinned=True),
+        _makeRun(0, size=20, maxBytes=100),
+    ]
+    assert _runNums(selectExpiredRuns(runs, RetentionLimits())) == [0]
+
+
+def test_globalQuotaRemovesOldestFirst():
+    runs = [
+        _makeRun(2, size=100, pipelineId=1),
+        _makeRun(1, size=100, pipelineId=1),
+        _makeRun(0, size=100, pipelineId=1),
+        _makeRun(5, size=100, pipelineId=2),
+        _makeRun(4, size=100, pipelineId=2, ageDays=1),
+    ]
+    expired = selectExpiredRuns(runs, RetentionLimits(maxBytes=300))
+    assert [(x.pipelineId, x.runNum) for x in expired] == [(2, 4), (1, 0)]
+
+
+def test_globalQuotaNeverRemovesNewest():
+    runs = [
+        _makeRun(1, size=1000, pipelineId=1),
+        _makeRun(0, size=1000, pipelineId=2),
+    ]
+    assert selectExpiredRuns(runs, RetentionLimits(maxBytes=10)) == []
+
+
+def _writeFile(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def ctrl(tmp_path):
+    out = ControllerState()
+    out.pipelineRepoPath = os.path.join(tmp_path, "pipelines")
+    out.blobStore.setWorkspace(os.path.join(tmp_path, "blobs"))
+    out._db = PipelineDB(os.path.join(tmp_path, "db.sqlite"))
+    yield out
+    out.stop()
+
+
+def test_runSizeCountsSharedBlobsOnce(ctrl):
+    sizes = []
+    for runNum in (1, 2):
+        archivePath = ctrl._getArchivePath("main", "p", runNum)
+        outputPath = ctrl._getOutputPath("main", "p", runNum)
+        _writeFile(os.path.join(archivePath, "shared.bin"), b"x" * 1000)
+        _writeFile(os.path.join(outputPath, "a.output"), b"output\n")
+        _, storedBytes = ctrl.blobStore.dedupe(archivePath)
+        sizes.append(ctrl._measureRun(archivePath, outputPath) + storedBytes)
+    manifest = len(f"{'0' * 64}\n")
+    assert sizes == [1000 + 7 + manifest, 7 + manifest]
+
+
+def test_addRunSize(tmp_path):
+    db = PipelineDB(os.path.join(tmp_path, "db.sqlite"))
+    pId, runNum = db.getPipelineIDAndNextRun("p.yaml")
+    db.addRun(pId, runNum, "main", b"", time.time())
+    # runs without a recorded size get measured later
+    db.addRunSize(pId, runNum, 10)
+    assert db.getStoredRuns()[0].size is None
+    db.setRunSize(pId, runNum, 100)
+    db.addRunSize(pId, runNum, 10)
+    assert db.getStoredRuns()[0].size == 110
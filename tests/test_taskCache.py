@@ -0,0 +1,143 @@
+import os
+import time
+
+import pytest
+from conftest import writeTask, writePipeline, makePipeline, commitRepo
+
+from tubular.task import Task
+from tubular_controller.taskCache import TaskCache, SECONDS_PER_DAY
+
+
+class _Run:
+    """
+    A run of a pipeline whose task b gets the archive of task a
+    """
+
+    def __init__(self, path: str, cache: bool = True) -> None:
+        meta = {"cache": cache, "inputs": ["src"]}
+        writeTask(path, "a", meta=meta)
+        writeTask(path, "b",
+                  steps=[{"type": "get-archive", "task": "a", "path": "out"}],
+                  meta=meta)
+        os.makedirs(os.path.join(path, "src"), exist_ok=True)
+        with open(os.path.join(path, "src", "main.c"), mode='w') as f:
+            f.write("int main() {}\n")
+        self.path = path
+        self.update()
+
+    def update(self):
+        self.repo, commit = commitRepo(self.path)
+        pipeline = makePipeline(self.path,
+                                writePipeline(self.path, [["a"], ["b"]]),
+                                commit=commit)
+        self.tasks = {x.meta.name: x for x in pipeline.tasks()}
+
+    def getKey(self, cache: TaskCache, name: str,
+               args: dict[str, str] | None = None) -> str | None:
+        sources = [self.tasks[x] for x in self.tasks[name].meta.archiveSources]
+        return cache.getKey(self.tasks[name], self.repo, args or {}, sources)
+
+
+@pytest.fixture
+def cache(tmp_path) -> TaskCache:
+    out = TaskCache()
+    out.setWorkspace(os.path.join(tmp_path, "cache"))
+    return out
+
+
+@pytest.fixture
+def run(tmp_path) -> _Run:
+    return _Run(os.path.join(tmp_path, "repo"))
+
+
+def _writeResults(task: Task, data: bytes):
+    for path in (task.archiveZipFile, task.outputZipFile):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode='wb') as f:
+            f.write(data)
+
+
+def test_keyOnlyWhenCached(tmp_path, cache):
+    run = _Run(os.path.join(tmp_path, "repo"), cache=False)
+    assert run.getKey(cache, "a") is None
+
+
+def test_keyIsStable(cache, run):
+    key = run.getKey(cache, "a")
+    assert key is not None
+    run.update()
+    assert run.getKey(cache, "a") == key
+
+
+def test_keyChangesWithArgs(cache, run):
+    assert run.getKey(cache, "a", {"x": "1"}) != run.getKey(
+        cache, "a", {"x": "2"})
+
+
+def test_keyOnlyFollowsInputs(cache, run):
+    key = run.getKey(cache, "a")
+    with open(os.path.join(run.path, "README"), mode='w') as f:
+        f.write("not an input\n")
+    run.update()
+    assert run.getKey(cache, "a") == key
+
+    with open(os.path.join(run.path, "src", "main.c"), mode='a') as f:
+        f.write("// changed\n")
+    run.update()
+    assert run.getKey(cache, "a") != key
+
+
+def test_keyNeedsCachedSources(cache, run):
+    # a hasn't been looked up in the cache, so its archive is unknown
+    assert run.getKey(cache, "b") is None
+
+    run.tasks["a"].cacheKey = "1" * 64
+    key = run.getKey(cache, "b")
+    assert key is not None
+    run.tasks["a"].cacheKey = "2" * 64
+    assert run.getKey(cache, "b") != key
+
+
+def test_storeAndRestore(cache, run):
+    task = run.tasks["a"]
+    assert not cache.restore("key", task)
+
+    _writeResults(task, b"results")
+    cache.store("key", task)
+    os.remove(task.archiveZipFile)
+    os.remove(task.outputZipFile)
+
+    assert cache.restore("key", task)
+    for path in (task.archiveZipFile, task.outputZipFile):
+        with open(path, mode='rb') as f:
+            assert f.read() == b"results"
+
+
+def _addEntry(cache: TaskCache, run: _Run, key: str, size: int, age: float):
+    task = run.tasks["a"]
+    _writeResults(task, b"x" * size)
+    cache.store(key, task)
+    os.remove(task.archiveZipFile)
+    os.remove(task.outputZipFile)
+    mtime = time.time() - age
+    os.utime(os.path.join(cache.path, key), (mtime, mtime))
+
+
+def test_trimOldEntries(cache, run):
+    cache.keepDays = 1
+    _addEntry(cache, run, "old", 10, 2 * SECONDS_PER_DAY)
+    _addEntry(cache, run, "new", 10, 0)
+    cache.trim()
+    assert sorted(os.listdir(cache.path)) == ["new"]
+
+
+def test_trimLeastRecentlyUsed(cache, run):
+    cache.keepDays = 0
+    cache.maxBytes = 250
+    for idx, key in enumerate("abcd"):
+        # a is the oldest, each entry is 100 bytes
+        _addEntry(cache, run, key, 50, 100 - idx)
+    # using an entry makes it the newest
+    assert cache.restore("a", run.tasks["a"])
+    cache.trim()
+    assert sorted(os.listdir(cache.path)) == ["a", "d"]
@@ -0,0 +1,167 @@
+import os
+
+import pytest
+from conftest import REPO_URL, BRANCH, writeTask, writePipeline, makePipeline
+
+from tubular_controller import taskQueue
+from tubular_controller.taskQueue import TaskQueue, QueueTask, AFFINITY_WINDOW, MAX_CRITICAL_PATH_BOOST, PRIORITY_DELAY
+from tubular.enums import Priority
+from tubular.pipeline import Pipeline
+from tubular.task import Task, TaskDef
+
+NODE_CLASS = frozenset(["linux"])
+
+
+class _Clock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> _Clock:
+    out = _Clock()
+    monkeypatch.setattr(taskQueue.time, "time", out)
+    return out
+
+
+class _Repo:
+    """
+    Makes pipelines and tasks with any name to queue
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        writeTask(path, "t")
+        self._pipelineDef = writePipeline(path, [["t"]])
+
+    def makePipeline(self, priority: Priority = Priority.Manual) -> Pipeline:
+        return makePipeline(self.path, self._pipelineDef,
+                            priority.name.lower())
+
+    def push(self,
+             queue: TaskQueue,
+             pipeline: Pipeline,
+             name: str,
+             rank: float = 0.0) -> QueueTask:
+        writeTask(self.path, name)
+        task = Task(REPO_URL, BRANCH, TaskDef(self.path, f"{name}.yaml"),
+                    pipeline.archive, pipeline.outputDir)
+        item = QueueTask(pipeline, task, [NODE_CLASS], rank)
+        queue.push(item)
+        return item
+
+
+@pytest.fixture
+def repo(tmp_path) -> _Repo:
+    return _Repo(os.fspath(tmp_path))
+
+
+def _popAll(queue: TaskQueue) -> list[str]:
+    out = []
+    while (item := queue.popFor(NODE_CLASS)) is not None:
+        out.append(item.task.meta.name)
+    return out
+
+
+def test_waitingTaskBeatsNewerHigherPriority(clock, repo):
+    queue = TaskQueue()
+    repo.push(queue, repo.makePipeline(Priority.Schedule), "old")
+    clock.now = PRIORITY_DELAY[Priority.Schedule] + 1
+    repo.push(queue, repo.makePipeline(Priority.Manual), "new")
+
+    assert _popAll(queue) == ["old", "new"]
+
+
+def test_higherPriorityGoesFirstBeforeAging(clock, repo):
+    queue = TaskQueue()
+    repo.push(queue, repo.makePipeline(Priority.Schedule), "schedule")
+    clock.now = PRIORITY_DELAY[Priority.Schedule] - 1
+    repo.push(queue, repo.makePipeline(Priority.Manual), "manual")
+
+    assert _popAll(queue) == ["manual", "schedule"]
+
+
+def test_fairShareInterleavesPipelines(clock, repo):
+    queue = TaskQueue()
+    wide = repo.makePipeline()
+    for x in range(3):
+        repo.push(queue, wide, f"wide{x}")
+    clock.now = 1
+    repo.push(queue, repo.makePipeline(), "narrow")
+
+    assert _popAll(queue) == ["wide0", "narrow", "wide1", "wide2"]
+
+
+def test_fairShareOnlyCountsQueuedTasks(clock, repo):
+    queue = TaskQueue()
+    pipeline = repo.makePipeline()
+    repo.push(queue, pipeline, "a")
+    assert _popAll(queue) == ["a"]
+
+    second = repo.push(queue, pipeline, "b")
+    assert second.key == clock.now
+
+
+def test_criticalPathStartsFirst(clock, repo):
+    queue = TaskQueue()
+    # both above the default estimate of tasks without any history
+    repo.push(queue, repo.makePipeline(), "short", rank=5 * 60)
+    clock.now = 1
+    repo.push(queue, repo.makePipeline(), "long", rank=30 * 60)
+
+    assert _popAll(queue) == ["long", "short"]
+
+
+def test_criticalPathKeepsOrder(clock, repo):
+    queue = TaskQueue()
+    for rank in (60, 61, 120, 600, 1800, 36000):
+        repo.push(queue, repo.makePipeline(), str(rank), rank=rank)
+
+    assert _popAll(queue) == ["36000", "1800", "600", "120", "61", "60"]
+
+
+def test_criticalPathBoostIsBounded(clock, repo):
+    queue = TaskQueue()
+    repo.push(queue, repo.makePipeline(), "waiting")
+    clock.now = MAX_CRITICAL_PATH_BOOST
+    repo.push(queue, repo.makePipeline(), "long", rank=1e9)
+
+    assert _popAll(queue) == ["waiting", "long"]
+
+
+def test_affinityWithinWindow(clock, repo):
+    queue = TaskQueue()
+    repo.push(queue, repo.makePipeline(), "head")
+    clock.now = AFFINITY_WINDOW - 1
+    repo.push(queue, repo.makePipeline(), "warm")
+
+    item = queue.popFor(NODE_CLASS, lambda x: int(x.task.meta.name == "warm"))
+    assert item is not None and item.task.meta.name == "warm"
+    assert _popAll(queue) == ["head"]
+
+
+def test_affinityDoesNotStarveHead(clock, repo):
+    queue = TaskQueue()
+    repo.push(queue, repo.makePipeline(), "head")
+    clock.now = AFFINITY_WINDOW + 1
+    repo.push(queue, repo.makePipeline(), "warm")
+
+    item = queue.popFor(NODE_CLASS, lambda x: int(x.task.meta.name == "warm"))
+    assert item is not None and item.task.meta.name == "head"
+
+
+def test_requeueKeepsPlace(clock, repo):
+    queue = TaskQueue()
+    repo.push(queue, repo.makePipeline(), "first")
+    clock.now = 1
+    repo.push(queue, repo.makePipeline(), "second")
+
+    item = queue.popFor(NODE_CLASS)
+    assert item is not None
+    queue.requeue(item)
+    assert _popAll(queue) == ["first", "second"]
+    assert len(queue) == 0
@@ -0,0 +1,156 @@
+import os
+import shutil
+import threading
+import uuid
+from typing import TextIO
+from urllib.parse import quote
+
+import requests
+from pydantic import BaseModel
+
+from tubular.file_utils import STREAM_CHUNK_SIZE, ensureParents, hashFile
+
+FETCH_TIMEOUT = 30
+# default size of a node's artifact cache, can be overridden with
+# TUBULAR_ARTIFACT_CACHE_MB
+ARTIFACT_CACHE_MB = 10240
+
+
+class ArtifactSource(BaseModel):
+    """
+    Where a node can get the archived files of an earlier task in the
+    same run, sent along with tasks that have get-archive steps
+    """
+    # name of the task in the run
+    task: str
+    task_id: str
+    # url of the node still holding the task's files, empty if it doesn't
+    peer_url: str = ""
+    # controller urls for the run's archive, file= or path= is appended
+    archive_url: str = ""
+    manifest_url: str = ""
+
+
+class ArtifactCache:
+    """
+    Files fetched by get-archive steps, stored by content hash so every
+    task on the node that needs the same file only downloads it once
+    """
+
+    def __init__(self) -> None:
+        self.path = ""
+        self.maxBytes = ARTIFACT_CACHE_MB * 1024 * 1024
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+
+    def setWorkspace(self, path: str):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            self.maxBytes = int(
+                float(os.environ["TUBULAR_ARTIFACT_CACHE_MB"]) * 1024 * 1024)
+        except KeyError:
+            pass
+
+    def _getEntryPath(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def getManifest(self, source: ArtifactSource, path: str,
+                    out: TextIO) -> tuple[list[dict], bool]:
+        """
+        Returns the files under the path in the task's archive, with
+        their sizes and hashes, and whether they come from the peer
+        """
+        if len(source.peer_url) > 0:
+            try:
+                r = self._session.get(
+                    url=f'{source.peer_url}/retained/{source.task_id}/manifest',
+                    timeout=FETCH_TIMEOUT)
+                r.raise_for_status()
+                return [x for x in r.json() if _isUnder(x["path"], path)], True
+            except requests.RequestException as err:
+                out.write(f"Unable to reach the node of {source.task}: {err}\n")
+
+        if len(source.manifest_url) == 0:
+            raise RuntimeError(
+                f"No way to get the files of {source.task}, set "
+                "TUBULAR_CONTROLLER_URL on the controller")
+        r = self._session.get(url=f'{source.manifest_url}&path={quote(path)}',
+                              timeout=FETCH_TIMEOUT)
+        r.raise_for_status()
+        return r.json(), False
+
+    def fetch(self, source: ArtifactSource, file: dict, fromPeer: bool,
+              dest: str, out: TextIO):
+        """
+        Copy the file to dest, from the cache if it's there
+        """
+        ensureParents(dest)
+        digest = file.get("sha256", "")
+        if len(digest) > 0:
+            entry = self._getEntryPath(digest)
+            with self._lock:
+                hit = os.path.isfile(entry)
+                if hit:
+                    # marks it as recently used
+                    os.utime(entry)
+            if hit:
+                shutil.copyfile(entry, dest)
+                return
+
+        if fromPeer:
+            url = f'{source.peer_url}/retained/{source.task_id}/archive?file={quote(file["path"])}'
+        else:
+            url = f'{source.archive_url}&file={quote(file["path"])}'
+        out.write(f"Fetching {file['path']}\n")
+
+        temp = os.path.join(self.path, f".{uuid.uuid4().hex}")
+        try:
+            with self._session.get(url=url, stream=True,
+                                   timeout=FETCH_TIMEOUT) as r:
+                r.raise_for_status()
+                with open(temp, mode='wb') as f:
+                    for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                        f.write(chunk)
+
+            if len(digest) == 0:
+                shutil.move(temp, dest)
+                return
+            if hashFile(temp) != digest:
+                raise RuntimeError(f"Checksum mismatch for {file['path']}")
+            shutil.copyfile(temp, dest)
+            entry = self._getEntryPath(digest)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            with self._lock:
+                os.replace(temp, entry)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def trim(self):
+        """
+        Remove the least recently used files until the cache fits
+        """
+        with self._lock:
+            entries: list[tuple[float, int, str]] = []
+            total = 0
+            for root, _, files in os.walk(self.path):
+                for x in files:
+                    # downloads in progress
+                    if x.startswith("."):
+                        continue
+                    stat = os.stat(os.path.join(root, x))
+                    entries.append(
+                        (stat.st_mtime, stat.st_size, os.path.join(root, x)))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.maxBytes:
+                    break
+                os.remove(path)
+                total -= size
+
+
+def _isUnder(file: str, path: str) -> bool:
+    path = path.strip("/")
+    return len(path) == 0 or file == path or file.startswith(f"{path}/")
@@ -21,3 +21,22 @@ class NodeStatus(enum.IntEnum):
     Idle = enum.auto()
     Active = enum.auto()
     Archiving = enum.auto()
+
+
+class Priority(enum.IntEnum):
+    # lower values are scheduled first
+    Manual = 0
+    Commit = 1
+    Schedule = 2
+
+
+def strToPriority(e: str) -> Priority:
+    match e.lower():
+        case 'manual':
+            return Priority.Manual
+        case 'commit':
+            return Priority.Commit
+        case 'schedule':
+            return Priority.Schedule
+        case _:
+            raise RuntimeError(f"Invalid priority string: {e}")
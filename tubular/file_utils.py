@@ -1,32 +1,133 @@
+import hashlib
+import io
 import zipfile
+import zlib
 import os
 import glob
+import queue
+import tarfile
+import threading
+from typing import IO, Generator
 
+STREAM_CHUNK_SIZE = 1024 * 1024
 
-def compressArchive(archivePath: str, out: str):
-    with zipfile.ZipFile(out, mode='w', compression=zipfile.ZIP_LZMA) as f:
+# header files are served with their sha256 in
+CHECKSUM_HEADER = "X-Tubular-SHA256"
+# chunks buffered between packing and sending
+_STREAM_QUEUE_SIZE = 8
+
+DEFAULT_COMPRESSION = "lzma"
+
+# archived files at least this big are stored whatever the compression,
+# so ranges of them can be read out of the zip without decompressing it
+# from the start
+SEEKABLE_SIZE = 64 * 1024 * 1024
+
+# adaptive compression checks this much of each file, and stores it
+# if compressing doesn't save at least 5%
+_SAMPLE_SIZE = 64 * 1024
+_MIN_SAVINGS = 0.05
+
+# files that are already compressed, adaptive compression stores these
+_COMPRESSED_EXTS = {
+    ".zip", ".jar", ".war", ".ear", ".whl", ".apk", ".nupkg", ".gz", ".tgz",
+    ".bz2", ".xz", ".lzma", ".zst", ".7z", ".rar", ".deb", ".rpm", ".png",
+    ".jpg", ".jpeg", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".mov", ".avi",
+    ".pdf", ".woff", ".woff2"
+}
+
+
+class Compression:
+    """
+    Compression of a zip, parsed from strings like "deflate:6". One of
+    store, deflate, bz2, lzma, zstd or adaptive, which stores files that
+    are already compressed and deflates the rest
+    """
+
+    def __init__(self, spec: str) -> None:
+        self.spec = spec
+        name, _, level = spec.partition(":")
+        self.adaptive = name == "adaptive"
+        self.level: int | None = None
+        if len(level) > 0:
+            try:
+                self.level = int(level)
+            except ValueError:
+                raise RuntimeError(f"Invalid compression level: {spec}")
+
+        match name:
+            case "store":
+                self.type = zipfile.ZIP_STORED
+            case "deflate" | "adaptive":
+                self.type = zipfile.ZIP_DEFLATED
+            case "bz2":
+                self.type = zipfile.ZIP_BZIP2
+            case "lzma":
+                self.type = zipfile.ZIP_LZMA
+            case "zstd":
+                # only in newer versions of python
+                try:
+                    self.type = getattr(zipfile, "ZIP_ZSTANDARD")
+                except AttributeError:
+                    raise RuntimeError(
+                        "zstd compression is not supported by this python")
+            case _:
+                raise RuntimeError(f"Invalid compression: {spec}")
+
+    def getType(self, path: str) -> int:
+        if self.adaptive and not _isCompressible(path):
+            return zipfile.ZIP_STORED
+        return self.type
+
+
+def _isCompressible(path: str) -> bool:
+    if os.path.splitext(path)[1].lower() in _COMPRESSED_EXTS:
+        return False
+    if not os.path.isfile(path):
+        return True
+    with open(path, mode='rb') as f:
+        sample = f.read(_SAMPLE_SIZE)
+    if len(sample) == 0:
+        return True
+    compressed = len(zlib.compress(sample, 1))
+    return compressed < len(sample) * (1 - _MIN_SAVINGS)
+
+
+def compressArchive(archivePath: str,
+                    out: str,
+                    compression: str = DEFAULT_COMPRESSION):
+    comp = Compression(compression)
+    with zipfile.ZipFile(out, mode='w', compression=comp.type,
+                         compresslevel=comp.level) as f:
         for x in glob.iglob(f"**", root_dir=archivePath, recursive=True):
             fullPath = os.path.join(archivePath, x)
-            f.write(fullPath, x)
+            compressType = comp.getType(fullPath)
+            if os.path.isfile(fullPath) and \
+                    os.path.getsize(fullPath) >= SEEKABLE_SIZE:
+                compressType = zipfile.ZIP_STORED
+            f.write(fullPath, x, compress_type=compressType)
 
 
 def decompressArchive(archiveZip: str, archivePath: str):
-    with zipfile.ZipFile(archiveZip, mode='r',
-                         compression=zipfile.ZIP_LZMA) as f:
+    with zipfile.ZipFile(archiveZip, mode='r') as f:
         f.extractall(archivePath)
 
 
-def compressOutputFile(outputFile: str) -> str:
+def compressOutputFile(outputFile: str,
+                       compression: str = DEFAULT_COMPRESSION) -> str:
+    comp = Compression(compression)
     outpath = f'{outputFile}.zip'
-    with zipfile.ZipFile(outpath, mode='w', compression=zipfile.ZIP_LZMA) as f:
+    with zipfile.ZipFile(outpath, mode='w', compression=comp.type,
+                         compresslevel=comp.level) as f:
         innerfile = os.path.split(outputFile)[1]
-        f.write(outputFile, innerfile)
+        f.write(outputFile,
+                innerfile,
+                compress_type=comp.getType(outputFile))
     return outpath
 
 
 def decompressOutputFile(zippedOutput: str, outputDir: str):
-    with zipfile.ZipFile(zippedOutput, mode='r',
-                         compression=zipfile.ZIP_LZMA) as f:
+    with zipfile.ZipFile(zippedOutput, mode='r') as f:
         # strip .zip
         innerFile = os.path.splitext(zippedOutput)[0]
         # remove parents
@@ -37,6 +138,37 @@ def decompressOutputFile(zippedOutput: str, outputDir: str):
         f.extract(innerFile, realOutputDir)
 
 
+def hashFile(path: str) -> str:
+    """
+    Returns the hex sha256 of the file
+    """
+    out = hashlib.sha256()
+    with open(path, mode='rb') as f:
+        while True:
+            data = f.read(STREAM_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            out.update(data)
+    return out.hexdigest()
+
+
+def writeChecksum(path: str):
+    """
+    Store the file's hash next to it, so it doesn't need to be
+    recomputed every time the file is served
+    """
+    with open(f"{path}.sha256", mode='w') as f:
+        f.write(hashFile(path))
+
+
+def readChecksum(path: str) -> str | None:
+    try:
+        with open(f"{path}.sha256", mode='r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
 def sanitizeFilepath(parent, path) -> str:
     fullpath = os.path.realpath(os.path.join(parent, path))
 
@@ -51,3 +183,127 @@ def ensureParents(path: str):
     parents = os.path.split(path)[0]
     if not os.path.exists(parents):
         os.makedirs(parents, exist_ok=True)
+
+
+class _QueueWriter(io.RawIOBase):
+    """
+    File-like object that hands the written data to a queue in chunks
+    """
+
+    def __init__(self, chunks: queue.Queue, stopped: threading.Event) -> None:
+        self._chunks = chunks
+        self._stopped = stopped
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+        self._put(bytes(self._buffer))
+        self._buffer.clear()
+
+    def _put(self, item):
+        while True:
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                if self._stopped.is_set():
+                    raise RuntimeError("Stream closed")
+
+
+def streamArchive(archivePath: str) -> Generator[bytes, None, None]:
+    """
+    Packs the directory into an uncompressed tar stream as it walks it,
+    without writing anything to disk
+    """
+    chunks: queue.Queue = queue.Queue(maxsize=_STREAM_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def _pack():
+        out = _QueueWriter(chunks, stopped)
+        try:
+            with tarfile.open(fileobj=out, mode="w|") as tar:
+                for root, dirs, files in os.walk(archivePath):
+                    dirs.sort()
+                    for name in sorted(dirs) + sorted(files):
+                        fullPath = os.path.join(root, name)
+                        tar.add(fullPath,
+                                os.path.relpath(fullPath, archivePath),
+                                recursive=False)
+            out.flush()
+            out._put(None)
+        except Exception as err:
+            # nothing more is sent, even when the writer gets closed
+            out._buffer.clear()
+            if not stopped.is_set():
+                out._put(err)
+
+    threading.Thread(target=_pack, daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+
+def extractArchiveStream(stream: IO[bytes], archivePath: str):
+    """
+    Unpacks a tar stream from streamArchive straight into the directory
+    """
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        # don't let the archive write outside of the directory
+        if hasattr(tarfile, "data_filter"):
+            tar.extraction_filter = tarfile.data_filter
+            tar.extractall(archivePath)
+            return
+        # older Pythons without extraction filters
+        for member in tar:
+            _checkMember(member, archivePath)
+            tar.extract(member, archivePath)
+
+
+def _checkMember(member: tarfile.TarInfo, archivePath: str):
+    """
+    Reject members that would end up outside of the directory, or that
+    aren't plain files, directories or links within it
+    """
+    root = os.path.realpath(archivePath)
+
+    def isInside(path: str) -> bool:
+        # resolves links that were already extracted
+        path = os.path.realpath(path)
+        return path == root or path.startswith(root + os.sep)
+
+    if os.path.isabs(member.name) or not isInside(
+            os.path.join(root, member.name)):
+        raise RuntimeError(
+            f"Archive member outside of the archive: {member.name}")
+    if member.issym():
+        target = os.path.join(root, os.path.dirname(member.name),
+                              member.linkname)
+    elif member.islnk():
+        target = os.path.join(root, member.linkname)
+    elif member.isfile() or member.isdir():
+        # no setuid, setgid or sticky bits
+        member.mode &= 0o777
+        return
+    else:
+        raise RuntimeError(f"Unsupported archive member: {member.name}")
+    if os.path.isabs(member.linkname) or not isInside(target):
+        raise RuntimeError(
+            f"Archive link points outside of the archive: {member.name}")
+
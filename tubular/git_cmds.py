@@ -49,6 +49,41 @@ def pull(repo: Repo, outputFile: TextIO | None):
     # _runCmd(["git", "clean", "-dfx"], path)
 
 
+def checkoutCommit(repo: Repo,
+                   commit: bytes,
+                   outputFile: TextIO | None = None):
+    """
+    Fetch and hard reset to a specific commit, the remote must allow
+    fetching by commit hash since the clones are shallow
+    """
+    _runCmd(["git", "fetch", "--depth=1", "origin",
+             commit.hex()], repo.path, outputFile)
+    _runCmd(["git", "reset", "--hard", commit.hex()], repo.path, outputFile)
+
+
+def fetchCommit(repo: Repo, commit: bytes):
+    """
+    Fetch a specific commit without touching the working tree
+    """
+    _runCmd(["git", "fetch", "--depth=1", "origin", commit.hex()], repo.path)
+
+
+def addWorktree(repo: Repo, path: str, commit: bytes):
+    """
+    Creates a detached worktree at path, sharing the repo's object store
+    """
+    _runCmd(["git", "worktree", "add", "--detach", path,
+             commit.hex()], repo.path)
+
+
+def removeWorktree(repo: Repo, path: str):
+    _runCmd(["git", "worktree", "remove", "--force", path], repo.path)
+
+
+def pruneWorktrees(repo: Repo):
+    _runCmd(["git", "worktree", "prune"], repo.path)
+
+
 def cloneOrPull(repo: Repo, outputFile: TextIO | None = None):
     if not os.path.exists(repo.path):
         clone(repo, outputFile)
@@ -81,6 +116,18 @@ def getCurrentLocalCommit(repo: Repo) -> bytearray:
     return bytearray.fromhex(output.strip())
 
 
+def getObjectHash(repo: Repo, commit: bytes, path: str = "") -> str:
+    """
+    Returns the hash of the tree or file at path in the commit, or
+    of the whole tree if path is empty
+    """
+    if len(path) == 0:
+        target = f"{commit.hex()}^{{tree}}"
+    else:
+        target = f"{commit.hex()}:{path}"
+    return _captureCmd(["git", "rev-parse", target], repo.path).strip()
+
+
 def getLatestRemoteCommit(repo: Repo) -> bytearray:
     output = _captureCmd(
         ["git", "ls-remote", "--heads", repo.url, repo.branch])
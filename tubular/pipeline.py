@@ -1,18 +1,22 @@
-from typing import Any
+from typing import Any, Iterator
 import os
 
 from pydantic import BaseModel
 
 from tubular.stage import StageDef, Stage
+from tubular.task import Task
 from tubular import git_cmds
 from tubular.yaml import loadYAML
-from tubular.enums import PipelineStatus
+from tubular.enums import PipelineStatus, strToPriority
+from tubular.file_utils import Compression
 
 
 class PipelineReq(BaseModel):
     branch: str
     pipeline_path: str
     args: list[dict[str, str]]
+    # manual, commit, or schedule, runs from the UI are manual
+    priority: str = "manual"
 
 
 def formatPipelineName(pipelineFile: str) -> str:
@@ -43,40 +47,159 @@ class PipelineDef:
             meta = config['meta']
             self.display = str(meta.get('display', self.name))
             self.maxRuns = int(meta.get('keep-runs', 0))
+            self.keepDays = float(meta.get('keep-days', 0))
+            self.maxSizeMB = float(meta.get('max-size-mb', 0))
+            self.coalesce = bool(meta.get('coalesce', True))
+            self.compression: str | None = None
+            if 'compression' in meta:
+                self.compression = Compression(str(meta['compression'])).spec
         except KeyError:
             self.display = self.name
             self.maxRuns = 0
+            self.keepDays = 0.0
+            self.maxSizeMB = 0.0
+            self.coalesce = True
+            self.compression = None
 
         self.stages: list[StageDef] = []
         for stageConfig in config['stages']:
             self.stages.append(StageDef(repoPath, stageConfig))
 
+        self.needs = self._resolveNeeds()
+
+    def getArgs(self, req: PipelineReq) -> dict[str, str]:
+        """
+        The default args overwritten by the ones in the request
+        """
+        out = {key: val for key, val in self.args}
+        for kvPair in req.args:
+            out[kvPair["k"]] = kvPair["v"]
+        return out
+
+    def _resolveNeeds(self) -> dict[str, list[str]]:
+        """
+        Builds the task dependency graph. Tasks without explicit needs
+        depend on every task in the previous stage, keeping stages as
+        barriers, explicit needs can only reference tasks in the same
+        or earlier stages.
+        """
+        out: dict[str, list[str]] = {}
+        prevStage: list[str] = []
+        for stage in self.stages:
+            curStage = [x.name for x in stage.tasks]
+            for name in curStage:
+                if name in out:
+                    raise RuntimeError(
+                        f"Task '{name}' is used more than once in '{self.file}'"
+                    )
+                out[name] = []
+            for name in curStage:
+                try:
+                    needs = stage.needs[name]
+                except KeyError:
+                    out[name] = list(prevStage)
+                    continue
+                for dep in needs:
+                    if dep not in out:
+                        raise RuntimeError(
+                            f"Task '{name}' needs unknown task '{dep}'")
+                out[name] = needs
+            prevStage = curStage
+
+        # check for cycles within stages
+        visited: set[str] = set()
+        visiting: set[str] = set()
+
+        def _visit(name: str):
+            if name in visited:
+                return
+            if name in visiting:
+                raise RuntimeError(
+                    f"Dependency cycle including task '{name}' in '{self.file}'"
+                )
+            visiting.add(name)
+            for dep in out[name]:
+                _visit(dep)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in out:
+            _visit(name)
+
+        # get-archive steps can only read tasks that are done by then,
+        # the ancestors of each task are only worked out once
+        ancestors: dict[str, set[str]] = {}
+
+        def _getAncestors(name: str) -> set[str]:
+            try:
+                return ancestors[name]
+            except KeyError:
+                pass
+            found: set[str] = set()
+            for dep in out[name]:
+                found.add(dep)
+                found.update(_getAncestors(dep))
+            ancestors[name] = found
+            return found
+
+        for stage in self.stages:
+            for task in stage.tasks:
+                for source in task.archiveSources:
+                    if source not in _getAncestors(task.name):
+                        raise RuntimeError(
+                            f"Task '{task.name}' gets the archive of "
+                            f"'{source}', which it doesn't depend on")
+
+        return out
+
 
 class Pipeline:
     """
     Encapsulates a single run of a pipeline
     """
 
-    def __init__(self, repoUrl: str, pipelineDef: PipelineDef,
-                 req: PipelineReq, archivePath: str, outputPath: str) -> None:
+    def __init__(self,
+                 repoUrl: str,
+                 pipelineDef: PipelineDef,
+                 req: PipelineReq,
+                 archivePath: str,
+                 outputPath: str,
+                 commit: bytes = b"") -> None:
         self.meta = pipelineDef
         self.status = PipelineStatus.Running
 
         self.branch = req.branch
+        self.commit = commit
+        self.priority = strToPriority(req.priority)
+        # set by the controller once the run is in the DB
+        self.id = 0
+        self.runNum = 0
         self.archive = archivePath
         self.outputDir = outputPath
 
         if not os.path.exists(self.archive):
             os.makedirs(self.archive, exist_ok=True)
 
-        self.args = {key: val for key, val in self.meta.args}
-        # Overwrite defaults with user supplied
-        for kvPair in req.args:
-            self.args[kvPair["k"]] = kvPair["v"]
+        self.args = self.meta.getArgs(req)
 
         # TODO catch errors? set status to Error
 
         self.stages: list[Stage] = [
-            Stage(repoUrl, self.branch, x, archivePath, outputPath)
-            for x in self.meta.stages
+            Stage(repoUrl, self.branch, x, archivePath, outputPath,
+                  self.commit) for x in self.meta.stages
         ]
+
+        tasksByName = {x.meta.name: x for x in self.tasks()}
+        for task in tasksByName.values():
+            # tasks without their own use the pipeline's compression
+            if task.meta.compression is None and self.meta.compression is not None:
+                task.compression = self.meta.compression
+        for task in tasksByName.values():
+            task.needs = [
+                tasksByName[x] for x in self.meta.needs[task.meta.name]
+            ]
+
+    def tasks(self) -> Iterator[Task]:
+        for stage in self.stages:
+            for task in stage.tasks:
+                yield task
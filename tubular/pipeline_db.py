@@ -1,4 +1,6 @@
+import json
 import threading
+import time
 import sqlite3
 import os
 
@@ -82,24 +84,37 @@ WHERE
     run = :run
 """
 
-RUNS_GET_NUM_FOR_ID = """
-SELECT
-    count(*)
-FROM
+RUNS_REMOVE = """
+DELETE FROM
     runs
 WHERE
-    pipeline = ?
+    pipeline = :pipeline_id
+    AND
+    run = :run
 """
 
-RUNS_DROP_OLDEST = """
-DELETE FROM
-  runs
-WHERE
-  rowid = (SELECT rowid FROM runs order by rowid limit :count)
-  AND
-  pipeline = :pipeline
-RETURNING
-  run
+# every run with what the garbage collector needs to know about it,
+# newest first for each pipeline
+RUNS_GET_STORED = """
+SELECT
+    r.pipeline, p.path, r.branch, r.run, r.start_ts, s.bytes,
+    EXISTS (
+        SELECT 1 FROM pinned_runs x
+        WHERE x.pipeline = r.pipeline AND x.run = r.run
+    ),
+    EXISTS (
+        SELECT 1 FROM active_runs a
+        WHERE a.pipeline = r.pipeline AND a.run = r.run
+    ),
+    IFNULL(pol.keep_runs, 0), IFNULL(pol.keep_days, 0),
+    IFNULL(pol.max_bytes, 0)
+FROM
+    runs r
+    JOIN pipelines p ON p.id = r.pipeline
+    LEFT JOIN run_storage s ON s.pipeline = r.pipeline AND s.run = r.run
+    LEFT JOIN retention_policies pol ON pol.pipeline = r.pipeline
+ORDER BY
+    r.pipeline, r.run DESC
 """
 
 RUNS_GET_LAST_FOR_PIPELINE = """
@@ -135,6 +150,7 @@ ORDER BY
 LIMIT 50
 """
 
+# only runs that can't be resumed
 RUNS_SET_RUNNING_ERROR = """
 UPDATE
     runs
@@ -142,6 +158,14 @@ SET
     status = 0
 WHERE
     status = 2
+    AND
+    NOT EXISTS (
+        SELECT 1 FROM active_runs
+        WHERE
+            active_runs.pipeline = runs.pipeline
+            AND
+            active_runs.run = runs.run
+    )
 """
 
 RUNS_GET_META = """
@@ -156,6 +180,332 @@ WHERE
 LIMIT 1
 """
 
+QUEUED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queued_requests
+(
+    id INTEGER PRIMARY KEY,
+    request TEXT
+)
+"""
+
+QUEUED_ADD = """
+INSERT INTO
+    queued_requests
+    (request)
+VALUES
+    (?)
+RETURNING
+    id
+"""
+
+QUEUED_REMOVE = """
+DELETE FROM
+    queued_requests
+WHERE
+    id = ?
+"""
+
+QUEUED_GET_ALL = """
+SELECT
+    id, request
+FROM
+    queued_requests
+ORDER BY
+    id
+"""
+
+ACTIVE_RUNS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS active_runs
+(
+    pipeline INTEGER,
+    run INTEGER,
+    request TEXT,
+    commit_hash BLOB,
+    start_ts INTEGER,
+    FOREIGN KEY(pipeline) REFERENCES pipelines(id)
+)
+"""
+
+ACTIVE_RUNS_ADD = """
+INSERT INTO active_runs
+    (pipeline, run, request, commit_hash, start_ts)
+VALUES
+    (:pipeline_id, :run, :request, :commit_hash, :start_ts)
+"""
+
+ACTIVE_RUNS_REMOVE = """
+DELETE FROM
+    active_runs
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+ACTIVE_RUNS_GET_ALL = """
+SELECT
+    pipeline, run, request, commit_hash, start_ts
+FROM
+    active_runs
+"""
+
+TASKS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS run_tasks
+(
+    pipeline INTEGER,
+    run INTEGER,
+    task TEXT,
+    task_id TEXT,
+    node TEXT,
+    slot INTEGER,
+    status INTEGER,
+    cache_key TEXT,
+    PRIMARY KEY(pipeline, run, task),
+    FOREIGN KEY(pipeline) REFERENCES pipelines(id)
+)
+"""
+
+TASKS_SET = """
+INSERT OR REPLACE INTO run_tasks
+    (pipeline, run, task, task_id, node, slot, status, cache_key)
+VALUES
+    (:pipeline_id, :run, :task, :task_id, :node, :slot, :status, :cache_key)
+"""
+
+TASKS_GET_FOR_RUN = """
+SELECT
+    task, task_id, node, slot, status, cache_key
+FROM
+    run_tasks
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+TASKS_REMOVE_FOR_RUN = """
+DELETE FROM
+    run_tasks
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+DURATIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS task_durations
+(
+    task TEXT PRIMARY KEY,
+    estimate_ms INTEGER,
+    last_ms INTEGER,
+    samples INTEGER
+)
+"""
+
+DURATIONS_SET = """
+INSERT OR REPLACE INTO task_durations
+    (task, estimate_ms, last_ms, samples)
+VALUES
+    (:task, :estimate_ms, :last_ms, :samples)
+"""
+
+DURATIONS_GET_ALL = """
+SELECT
+    task, estimate_ms, samples
+FROM
+    task_durations
+"""
+
+PINS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pinned_runs
+(
+    pipeline INTEGER,
+    run INTEGER,
+    PRIMARY KEY(pipeline, run),
+    FOREIGN KEY(pipeline) REFERENCES pipelines(id)
+)
+"""
+
+PINS_ADD = """
+INSERT OR IGNORE INTO pinned_runs
+    (pipeline, run)
+VALUES
+    (:pipeline_id, :run)
+"""
+
+PINS_REMOVE = """
+DELETE FROM
+    pinned_runs
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+PINS_GET_FOR_PIPELINE = """
+SELECT
+    run
+FROM
+    pinned_runs
+WHERE
+    pipeline = ?
+"""
+
+# requests that were merged into an identical run instead of
+# starting their own
+MERGED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS merged_requests
+(
+    id INTEGER PRIMARY KEY,
+    pipeline INTEGER,
+    run INTEGER,
+    request TEXT,
+    ts INTEGER,
+    FOREIGN KEY(pipeline) REFERENCES pipelines(id)
+)
+"""
+
+MERGED_ADD = """
+INSERT INTO merged_requests
+    (pipeline, run, request, ts)
+VALUES
+    (:pipeline_id, :run, :request, :ts)
+"""
+
+MERGED_REMOVE = """
+DELETE FROM
+    merged_requests
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+MERGED_COUNT_FOR_PIPELINE = """
+SELECT
+    run, COUNT(*)
+FROM
+    merged_requests
+WHERE
+    pipeline = ?
+GROUP BY
+    run
+"""
+
+RETENTION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS retention_policies
+(
+    pipeline INTEGER PRIMARY KEY,
+    keep_runs INTEGER,
+    keep_days REAL,
+    max_bytes INTEGER,
+    FOREIGN KEY(pipeline) REFERENCES pipelines(id)
+)
+"""
+
+RETENTION_SET = """
+INSERT OR REPLACE INTO retention_policies
+    (pipeline, keep_runs, keep_days, max_bytes)
+VALUES
+    (:pipeline_id, :keep_runs, :keep_days, :max_bytes)
+"""
+
+STORAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS run_storage
+(
+    pipeline INTEGER,
+    run INTEGER,
+    bytes INTEGER,
+    PRIMARY KEY(pipeline, run),
+    FOREIGN KEY(pipeline) REFERENCES pipelines(id)
+)
+"""
+
+STORAGE_SET = """
+INSERT OR REPLACE INTO run_storage
+    (pipeline, run, bytes)
+VALUES
+    (:pipeline_id, :run, :bytes)
+"""
+
+STORAGE_ADD = """
+UPDATE
+    run_storage
+SET
+    bytes = bytes + :bytes
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+STORAGE_REMOVE = """
+DELETE FROM
+    run_storage
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+REMOTE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS remote_artifacts
+(
+    pipeline INTEGER,
+    run INTEGER,
+    task TEXT,
+    task_id TEXT,
+    node TEXT,
+    archive TEXT,
+    files TEXT,
+    PRIMARY KEY(pipeline, run, task),
+    FOREIGN KEY(pipeline) REFERENCES pipelines(id)
+)
+"""
+
+REMOTE_ADD = """
+INSERT OR REPLACE INTO remote_artifacts
+    (pipeline, run, task, task_id, node, archive, files)
+VALUES
+    (:pipeline_id, :run, :task, :task_id, :node, :archive, :files)
+"""
+
+REMOTE_REMOVE = """
+DELETE FROM
+    remote_artifacts
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+    AND
+    task = :task
+"""
+
+REMOTE_GET_FOR_RUN = """
+SELECT
+    pipeline, run, task, task_id, node, archive, files
+FROM
+    remote_artifacts
+WHERE
+    pipeline = :pipeline_id
+    AND
+    run = :run
+"""
+
+REMOTE_GET_INACTIVE = """
+SELECT
+    r.pipeline, r.run, r.task, r.task_id, r.node, r.archive, r.files
+FROM
+    remote_artifacts r
+WHERE
+    NOT EXISTS (
+        SELECT 1 FROM active_runs a
+        WHERE a.pipeline = r.pipeline AND a.run = r.run
+    )
+ORDER BY
+    r.pipeline, r.run
+"""
+
 # yapf: enable
 
 
@@ -183,6 +533,83 @@ class Run:
         self.status = PipelineStatus(status)
 
 
+class ActiveRun:
+    """
+    A run that was in progress when the controller stopped
+    """
+
+    def __init__(self, pipelineId: int, runNum: int, request: str,
+                 commit: bytes, startTime: float) -> None:
+        self.pipelineId = pipelineId
+        self.runNum = runNum
+        self.request = request
+        self.commit = bytes(commit)
+        self.startTime = startTime
+
+
+class TaskState:
+    """
+    Last known state of a task in an active run
+    """
+
+    def __init__(self,
+                 name: str,
+                 taskId: str,
+                 node: str | None,
+                 slot: int | None,
+                 status: int,
+                 cacheKey: str | None = None) -> None:
+        self.name = name
+        self.taskId = taskId
+        self.node = node
+        self.slot = slot
+        self.status = PipelineStatus(status)
+        # the task's key in the task cache, if it's cached
+        self.cacheKey = cacheKey
+
+
+class RemoteArtifact:
+    """
+    A task's archive that is still on the node that ran it
+    """
+
+    def __init__(self, pipelineId: int, runNum: int, task: str, taskId: str,
+                 node: str, archivePath: str, files: dict[str, int]) -> None:
+        self.pipelineId = pipelineId
+        self.runNum = runNum
+        self.task = task
+        self.taskId = taskId
+        self.node = node
+        # the run's archive directory
+        self.archivePath = archivePath
+        # paths relative to the run's archive -> sizes
+        self.files = files
+
+
+class StoredRun:
+    """
+    A run that may have files on disk, with its pipeline's retention
+    policy, limits of 0 are unlimited
+    """
+
+    def __init__(self, pipelineId: int, pipelinePath: str, branch: str,
+                 runNum: int, startTime: float, size: int | None,
+                 pinned: bool, active: bool, keepRuns: int, keepDays: float,
+                 maxBytes: int) -> None:
+        self.pipelineId = pipelineId
+        self.pipelinePath = pipelinePath
+        self.branch = branch
+        self.runNum = runNum
+        self.startTime = startTime
+        # bytes of archive and output, None if not measured yet
+        self.size = size
+        self.pinned = pinned
+        self.active = active
+        self.keepRuns = keepRuns
+        self.keepDays = keepDays
+        self.maxBytes = maxBytes
+
+
 class PipelineDB:
 
     def __init__(self, path: str) -> None:
@@ -190,17 +617,24 @@ class PipelineDB:
         self._refs = 0
         self._lock = threading.Semaphore()
 
-        initDB = not os.path.exists(path)
-
         self._dbCon = sqlite3.connect(path, check_same_thread=False)
         self._dbCur = self._dbCon.cursor()
 
-        if initDB:
-            self._dbCur.execute(PIPELINES_SCHEMA)
-            self._dbCur.execute(RUNS_SCHEMA)
-        else:
-            # Make any running pipelines set to error
-            self._dbCur.execute(RUNS_SET_RUNNING_ERROR)
+        # these are no-ops if the tables exist
+        self._dbCur.execute(PIPELINES_SCHEMA)
+        self._dbCur.execute(RUNS_SCHEMA)
+        self._dbCur.execute(QUEUED_SCHEMA)
+        self._dbCur.execute(ACTIVE_RUNS_SCHEMA)
+        self._dbCur.execute(TASKS_SCHEMA)
+        self._dbCur.execute(DURATIONS_SCHEMA)
+        self._dbCur.execute(REMOTE_SCHEMA)
+        self._dbCur.execute(PINS_SCHEMA)
+        self._dbCur.execute(MERGED_SCHEMA)
+        self._dbCur.execute(RETENTION_SCHEMA)
+        self._dbCur.execute(STORAGE_SCHEMA)
+
+        # Set any running pipelines that can't be resumed to error
+        self._dbCur.execute(RUNS_SET_RUNNING_ERROR)
         self._dbCon.commit()
 
     @lock
@@ -208,21 +642,22 @@ class PipelineDB:
         res = self._dbCur.execute(PIPELINES_GET_NEXT_RUN, (pipelinePath, ))
         out = res.fetchone()
         if out is None:
-            res = self._dbCur.execute(PIPELINES_ADD, (pipelinePath, ))
-            pId = res.fetchone()[0]
-            run = 1
-        else:
-            pId = out[0]
-            run = out[1]
+            self._dbCur.execute(PIPELINES_ADD, (pipelinePath, )).fetchone()
+            # bump the new row so the next call doesn't reuse run 1
+            res = self._dbCur.execute(PIPELINES_GET_NEXT_RUN,
+                                      (pipelinePath, ))
+            out = res.fetchone()
+        pId = out[0]
+        run = out[1]
         self._dbCon.commit()
         return pId, run
 
     @lock
     def addRun(self, pipelineID: int, runNum: int, branch: str, commit: bytes,
-               start: float, maxRuns: int) -> list[int]:
+               start: float):
         """
-        Adds a new run, and removes any rows over the max number.
-        Returns the runNum for removed rows.
+        Adds a new run, old runs are removed by the controller's garbage
+        collector
         """
         values = {
             "pipeline_id": pipelineID,
@@ -233,23 +668,89 @@ class PipelineDB:
         }
 
         self._dbCur.execute(RUNS_ADD, values)
+        self._dbCon.commit()
 
-        out: list[int] = []
+    @lock
+    def removeRun(self, pipelineID: int, runNum: int):
+        """
+        Forget a run once its files are gone
+        """
+        values = {"pipeline_id": pipelineID, "run": runNum}
+        self._dbCur.execute(RUNS_REMOVE, values)
+        self._dbCur.execute(STORAGE_REMOVE, values)
+        self._dbCur.execute(PINS_REMOVE, values)
+        self._dbCur.execute(MERGED_REMOVE, values)
+        self._dbCur.execute(TASKS_REMOVE_FOR_RUN, values)
+        self._dbCon.commit()
 
-        if maxRuns > 0:
-            res = self._dbCur.execute(RUNS_GET_NUM_FOR_ID, (pipelineID, ))
-            count = res.fetchone()[0]
-            if count > maxRuns:
-                values = {
-                    "count": count - maxRuns,
-                    "pipeline": pipelineID,
-                }
-                res = self._dbCur.execute(RUNS_DROP_OLDEST, values)
-                for x in res.fetchall():
-                    out.append(x[0])
+    @lock
+    def getStoredRuns(self) -> list[StoredRun]:
+        res = self._dbCur.execute(RUNS_GET_STORED)
+        out = []
+        for x in res.fetchall():
+            out.append(
+                StoredRun(int(x[0]), str(x[1]), str(x[2]), int(x[3]),
+                          float(x[4] / 1000),
+                          None if x[5] is None else int(x[5]), bool(x[6]),
+                          bool(x[7]), int(x[8]), float(x[9]), int(x[10])))
+        return out
 
+    @lock
+    def setRunSize(self, pipelineID: int, runNum: int, size: int):
+        values = {"pipeline_id": pipelineID, "run": runNum, "bytes": size}
+        self._dbCur.execute(STORAGE_SET, values)
+        self._dbCon.commit()
+
+    @lock
+    def addRunSize(self, pipelineID: int, runNum: int, size: int):
+        """
+        Grow the recorded size of the run, if it has one
+        """
+        values = {"pipeline_id": pipelineID, "run": runNum, "bytes": size}
+        self._dbCur.execute(STORAGE_ADD, values)
+        self._dbCon.commit()
+
+    @lock
+    def setRetentionPolicy(self, pipelineID: int, keepRuns: int,
+                           keepDays: float, maxBytes: int):
+        values = {
+            "pipeline_id": pipelineID,
+            "keep_runs": keepRuns,
+            "keep_days": keepDays,
+            "max_bytes": maxBytes,
+        }
+        self._dbCur.execute(RETENTION_SET, values)
+        self._dbCon.commit()
+
+    @lock
+    def setRunPinned(self, pipelineID: int, runNum: int, pinned: bool):
+        values = {"pipeline_id": pipelineID, "run": runNum}
+        self._dbCur.execute(PINS_ADD if pinned else PINS_REMOVE, values)
+        self._dbCon.commit()
+
+    @lock
+    def getPinnedRuns(self, pipelineID: int) -> set[int]:
+        res = self._dbCur.execute(PINS_GET_FOR_PIPELINE, (pipelineID, ))
+        return {int(x[0]) for x in res.fetchall()}
+
+    @lock
+    def addMergedRequest(self, pipelineID: int, runNum: int, request: str):
+        values = {
+            "pipeline_id": pipelineID,
+            "run": runNum,
+            "request": request,
+            "ts": int(time.time() * 1000),
+        }
+        self._dbCur.execute(MERGED_ADD, values)
         self._dbCon.commit()
-        return out
+
+    @lock
+    def getMergedCounts(self, pipelineID: int) -> dict[int, int]:
+        """
+        Run number -> how many requests were merged into it
+        """
+        res = self._dbCur.execute(MERGED_COUNT_FOR_PIPELINE, (pipelineID, ))
+        return {int(x[0]): int(x[1]) for x in res.fetchall()}
 
     @lock
     def setRunStatus(self, pipelineID: int, runNum: int, duration: float,
@@ -321,3 +822,144 @@ class PipelineDB:
         data = {"pipeline": pipelineId, "run": run}
         res = self._dbCur.execute(RUNS_GET_META, data)
         return res.fetchone()[0]
+
+    @lock
+    def addQueuedRequest(self, request: str) -> int:
+        res = self._dbCur.execute(QUEUED_ADD, (request, ))
+        out = res.fetchone()[0]
+        self._dbCon.commit()
+        return out
+
+    @lock
+    def removeQueuedRequest(self, requestId: int):
+        self._dbCur.execute(QUEUED_REMOVE, (requestId, ))
+        self._dbCon.commit()
+
+    @lock
+    def getQueuedRequests(self) -> list[tuple[int, str]]:
+        res = self._dbCur.execute(QUEUED_GET_ALL)
+        return [(int(x[0]), str(x[1])) for x in res.fetchall()]
+
+    @lock
+    def addActiveRun(self, pipelineID: int, runNum: int, request: str,
+                     commit: bytes, start: float):
+        values = {
+            "pipeline_id": pipelineID,
+            "run": runNum,
+            "request": request,
+            "commit_hash": commit,
+            "start_ts": int(start * 1000),
+        }
+        self._dbCur.execute(ACTIVE_RUNS_ADD, values)
+        self._dbCon.commit()
+
+    @lock
+    def removeActiveRun(self, pipelineID: int, runNum: int):
+        values = {"pipeline_id": pipelineID, "run": runNum}
+        self._dbCur.execute(TASKS_REMOVE_FOR_RUN, values)
+        self._dbCur.execute(ACTIVE_RUNS_REMOVE, values)
+        self._dbCon.commit()
+
+    @lock
+    def getActiveRuns(self) -> list[ActiveRun]:
+        res = self._dbCur.execute(ACTIVE_RUNS_GET_ALL)
+        return [
+            ActiveRun(int(x[0]), int(x[1]), str(x[2]), x[3],
+                      float(x[4] / 1000)) for x in res.fetchall()
+        ]
+
+    @lock
+    def setTaskState(self,
+                     pipelineID: int,
+                     runNum: int,
+                     task: str,
+                     taskId: str,
+                     node: str | None,
+                     slot: int | None,
+                     status: PipelineStatus,
+                     cacheKey: str | None = None):
+        values = {
+            "pipeline_id": pipelineID,
+            "run": runNum,
+            "task": task,
+            "task_id": taskId,
+            "node": node,
+            "slot": slot,
+            "status": status.value,
+            "cache_key": cacheKey,
+        }
+        self._dbCur.execute(TASKS_SET, values)
+        self._dbCon.commit()
+
+    @lock
+    def getTaskStates(self, pipelineID: int, runNum: int) -> list[TaskState]:
+        values = {"pipeline_id": pipelineID, "run": runNum}
+        res = self._dbCur.execute(TASKS_GET_FOR_RUN, values)
+        return [
+            TaskState(str(x[0]), str(x[1]), x[2], x[3], x[4], x[5])
+            for x in res.fetchall()
+        ]
+
+    @lock
+    def setTaskDuration(self, task: str, estimate: float, last: float,
+                        samples: int):
+        values = {
+            "task": task,
+            "estimate_ms": int(estimate * 1000),
+            "last_ms": int(last * 1000),
+            "samples": samples,
+        }
+        self._dbCur.execute(DURATIONS_SET, values)
+        self._dbCon.commit()
+
+    @lock
+    def getTaskDurations(self) -> dict[str, tuple[float, int]]:
+        """
+        Returns task file -> (estimated duration, number of samples)
+        """
+        res = self._dbCur.execute(DURATIONS_GET_ALL)
+        return {
+            str(x[0]): (float(x[1] / 1000), int(x[2]))
+            for x in res.fetchall()
+        }
+
+    @lock
+    def addRemoteArtifact(self, artifact: RemoteArtifact):
+        values = {
+            "pipeline_id": artifact.pipelineId,
+            "run": artifact.runNum,
+            "task": artifact.task,
+            "task_id": artifact.taskId,
+            "node": artifact.node,
+            "archive": artifact.archivePath,
+            "files": json.dumps(artifact.files),
+        }
+        self._dbCur.execute(REMOTE_ADD, values)
+        self._dbCon.commit()
+
+    @lock
+    def removeRemoteArtifact(self, pipelineID: int, runNum: int, task: str):
+        values = {"pipeline_id": pipelineID, "run": runNum, "task": task}
+        self._dbCur.execute(REMOTE_REMOVE, values)
+        self._dbCon.commit()
+
+    @lock
+    def getRemoteArtifacts(self, pipelineID: int,
+                           runNum: int) -> list[RemoteArtifact]:
+        values = {"pipeline_id": pipelineID, "run": runNum}
+        res = self._dbCur.execute(REMOTE_GET_FOR_RUN, values)
+        return [self._makeRemoteArtifact(x) for x in res.fetchall()]
+
+    @lock
+    def getInactiveRemoteArtifacts(self) -> list[RemoteArtifact]:
+        """
+        Returns the remote artifacts of runs that are no longer running
+        """
+        res = self._dbCur.execute(REMOTE_GET_INACTIVE)
+        return [self._makeRemoteArtifact(x) for x in res.fetchall()]
+
+    @staticmethod
+    def _makeRemoteArtifact(x) -> RemoteArtifact:
+        return RemoteArtifact(int(x[0]), int(x[1]), str(x[2]), str(x[3]),
+                              str(x[4]), str(x[5]), json.loads(x[6]))
+
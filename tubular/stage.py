@@ -3,6 +3,13 @@ import os
 import uuid
 
 from tubular.task import TaskDef, Task, TaskRequest
+from tubular.yaml import getStr
+
+
+def formatTaskFile(task: str) -> str:
+    if task.endswith(".yaml"):
+        return task
+    return f'{task}.yaml'
 
 
 class StageDef:
@@ -10,25 +17,51 @@ class StageDef:
     def __init__(self, repoPath: str, config: Dict[str, Any]) -> None:
         self.display = config["display"]
         self.tasks: list[TaskDef] = []
+        # task name -> names of the tasks it needs, tasks that don't
+        # specify any depend on the entire previous stage
+        self.needs: dict[str, list[str]] = {}
         for task in config['tasks']:
-            if not isinstance(task, str):
-                # TODO
-                raise RuntimeError()
-            if task.endswith(".yaml"):
-                taskFile = task
+            if isinstance(task, str):
+                taskFile = formatTaskFile(task)
+                needs = None
+            elif isinstance(task, dict):
+                try:
+                    taskFile = formatTaskFile(getStr(task, "task"))
+                except KeyError:
+                    raise RuntimeError(
+                        f"Stage '{self.display}' task missing path [stages.*.tasks.*.task]"
+                    )
+                try:
+                    needs = task["needs"]
+                except KeyError:
+                    needs = None
+                if needs is not None and not isinstance(needs, list):
+                    raise RuntimeError(
+                        f"Invalid needs for task '{taskFile}', expected a list"
+                    )
             else:
-                taskFile = f'{task}.yaml'
+                raise RuntimeError(
+                    f"Invalid task entry in stage '{self.display}': {task}")
             t = TaskDef(repoPath, taskFile)
             self.tasks.append(t)
+            if needs is not None:
+                self.needs[t.name] = [
+                    os.path.splitext(formatTaskFile(str(x)))[0] for x in needs
+                ]
 
 
 class Stage:
 
-    def __init__(self, repoUrl: str, branch: str, stageDef: StageDef,
-                 archivePath: str, outputPath: str) -> None:
+    def __init__(self,
+                 repoUrl: str,
+                 branch: str,
+                 stageDef: StageDef,
+                 archivePath: str,
+                 outputPath: str,
+                 commit: bytes = b"") -> None:
         self.meta = stageDef
         self.tasks: list[Task] = [
-            Task(repoUrl, branch, x, archivePath, outputPath)
+            Task(repoUrl, branch, x, archivePath, outputPath, commit)
             for x in stageDef.tasks
         ]
 
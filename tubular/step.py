@@ -17,7 +17,8 @@ class StepType(enum.IntEnum):
     Script = enum.auto()
     Exec = enum.auto()
     Archive = enum.auto()
-    # TODO GetArchive, copy paths from previous stages archives
+    # copy paths from the archives of earlier tasks in the run
+    GetArchive = enum.auto()
 
 
 def strToStepType(e: str) -> StepType:
@@ -30,6 +31,8 @@ def strToStepType(e: str) -> StepType:
             return StepType.Exec
         case 'archive':
             return StepType.Archive
+        case 'get-archive':
+            return StepType.GetArchive
         case _:
             raise RuntimeError(f"Invalid Step type string: {e}")
 
@@ -49,6 +52,12 @@ class Step:
     def run(self, taskEnv: TaskEnv, out: TextIO):
         raise NotImplementedError()
 
+    def getArchiveSources(self) -> list[str]:
+        """
+        Names of the earlier tasks whose archives the step reads
+        """
+        return []
+
 
 class _StepActionClone(Step):
 
@@ -169,6 +178,52 @@ class _StepActionArchive(Step):
         out.flush()
 
 
+class _StepActionGetArchive(Step):
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        super().__init__(config)
+        # the earlier task that archived the files
+        self.task = getStr(config, "task")
+        self.path = getStr(config, "path")
+        try:
+            self.target = getStr(config, "target")
+        except KeyError:
+            self.target = self.path
+
+    def getArchiveSources(self) -> list[str]:
+        return [self.task]
+
+    def run(self, taskEnv: TaskEnv, out: TextIO):
+        path = taskEnv.replace(self.path).strip("/")
+        target = taskEnv.replace(self.target)
+        out.write(
+            f'[ Get Archive {self.task}: {path} ] ({taskEnv.getTime()})\n')
+        out.flush()
+
+        try:
+            source = taskEnv.artifacts[self.task]
+        except KeyError:
+            raise RuntimeError(f"No archive from task '{self.task}' in this run")
+        cache = taskEnv.artifactCache
+        if cache is None:
+            raise RuntimeError("get-archive steps can only run on a node")
+
+        files, fromPeer = cache.getManifest(source, path, out)
+        if len(files) == 0:
+            raise RuntimeError(
+                f"'{path}' is not in the archive of '{self.task}'")
+
+        for file in files:
+            relPath = file["path"]
+            if len(path) > 0:
+                relPath = os.path.relpath(relPath, path)
+            dest = sanitizeFilepath(taskEnv.workspace,
+                                    os.path.join(target, relPath))
+            cache.fetch(source, file, fromPeer, dest, out)
+        out.write(f"Got {len(files)} files\n")
+        out.flush()
+
+
 def makeStep(config: Dict[str, Any]) -> Step:
     val = getStr(config, "type")
     stepType = strToStepType(val)
@@ -182,3 +237,5 @@ def makeStep(config: Dict[str, Any]) -> Step:
             return _StepActionExec(config)
         case StepType.Archive:
             return _StepActionArchive(config)
+        case StepType.GetArchive:
+            return _StepActionGetArchive(config)
@@ -1,7 +1,8 @@
-from typing import Dict, Any
+from typing import Dict, Any, Callable
 import threading
 import os
 import datetime
+import uuid
 
 from pydantic import BaseModel
 
@@ -10,6 +11,8 @@ from tubular.taskEnv import TaskEnv
 from tubular.yaml import loadYAML
 from tubular import git_cmds
 from tubular.enums import PipelineStatus
+from tubular.file_utils import Compression, DEFAULT_COMPRESSION
+from tubular.artifacts import ArtifactSource
 
 
 class TaskRequest(BaseModel):
@@ -17,11 +20,43 @@ class TaskRequest(BaseModel):
     branch: str
     task_path: str
     args: Dict[str, str]
+    # which executor slot on the node should run this task
+    slot: int = 0
+    # unique ID for this run of the task
+    task_id: str = ""
+    # hex commit hash to run against, empty for the head of the branch
+    commit: str = ""
+    # where the node should post its NodeEvents, empty to only be polled
+    callback_url: str = ""
+    # zip to download compressed files, stream to pack them while they
+    # are downloaded, or lazy to leave the archive on the node until
+    # the controller asks for it
+    transfer: str = "zip"
+    # how zipped files get compressed, see file_utils.Compression
+    compression: str = DEFAULT_COMPRESSION
+    # archives of earlier tasks used by get-archive steps
+    artifacts: list[ArtifactSource] = []
 
     def getRepoPath(self):
         return os.path.join(git_cmds.getRepoName(self.repo_url), self.branch)
 
 
+class NodeEvent(BaseModel):
+    """
+    State change of a slot, pushed by the node to the controller
+    """
+    # started, step or ready once the task files can be downloaded
+    event: str
+    slot: int
+    status: str
+    task_status: str
+    task_id: str
+    # index of the step that's starting
+    step: int = -1
+    # task workspaces kept in the slot
+    workspaces: list[Dict[str, str]] = []
+
+
 class TaskDef:
 
     def __init__(self, repoPath: str, taskPath: str) -> None:
@@ -35,6 +70,22 @@ class TaskDef:
         except KeyError:
             self.display = self.name
 
+        # reuse the results of an earlier run with the same inputs
+        self.cache = False
+        # paths in the repo the results depend on, empty for all of it
+        self.inputs: list[str] = []
+        # None to use the pipeline's
+        self.compression: str | None = None
+        try:
+            meta = config['meta']
+            self.cache = bool(meta.get('cache', False))
+            self.inputs = [str(x).strip("/") for x in meta.get('inputs', [])]
+            if 'compression' in meta:
+                # validate it here instead of on the node
+                self.compression = Compression(str(meta['compression'])).spec
+        except KeyError:
+            pass
+
         # whitelist tags
         self.whiteTags: set[str] = set()
         # blacklist tags
@@ -59,17 +110,49 @@ class TaskDef:
         for step in stepConfigs:
             self.steps.append(makeStep(step))
 
+        # tasks whose archives the get-archive steps use
+        self.archiveSources: set[str] = set()
+        for step in self.steps:
+            self.archiveSources.update(step.getArchiveSources())
+
 
 class Task:
 
-    def __init__(self, repoUrl: str, branch: str, taskDef: TaskDef,
-                 archivePath: str, outputPath: str) -> None:
+    def __init__(self,
+                 repoUrl: str,
+                 branch: str,
+                 taskDef: TaskDef,
+                 archivePath: str,
+                 outputPath: str,
+                 commit: bytes = b"") -> None:
         self.repoUrl = repoUrl
         self.branch = branch
+        self.commit = commit
         self.meta = taskDef
+        self.id = uuid.uuid4().hex
         self.status = PipelineStatus.NotRun
         self._statusNotify = threading.Condition()
-
+        # tasks that must succeed before this one can start
+        self.needs: list[Task] = []
+        # called once the task is no longer running
+        self.onComplete: Callable[[Task], None] | None = None
+        # when the task was sent to a node, 0 if unknown
+        self.startTime = 0.0
+        # key of the task's results in the controller's cache, if cached
+        self.cacheKey: str | None = None
+        # node still holding the task's archive, for lazy transfers
+        self.remoteNode = ""
+        # the files in that archive, path -> size
+        self.remoteFiles: dict[str, int] = {}
+        # where the node gets the archives its get-archive steps use
+        self.artifacts: list[ArtifactSource] = []
+
+        # how the node sends the task's files, see TaskRequest.transfer
+        self.transfer = "zip"
+        self.compression = DEFAULT_COMPRESSION \
+            if taskDef.compression is None else taskDef.compression
+
+        self.archivePath = archivePath
         self.archiveZipFile = os.path.join(archivePath,
                                            f'{self.meta.name}.archive.zip')
 
@@ -81,16 +164,23 @@ class Task:
             self.status = status
             if self.status != PipelineStatus.Running:
                 self._statusNotify.notify_all()
+        if status != PipelineStatus.Running and self.onComplete is not None:
+            self.onComplete(self)
 
-    def run(self, taskEnv: TaskEnv):
+    def run(self,
+            taskEnv: TaskEnv,
+            onStep: Callable[[int], None] | None = None):
         self.status = PipelineStatus.Running
-        with open(taskEnv.output, mode='w') as f:
+        # line buffered so the output can be followed while it runs
+        with open(taskEnv.output, mode='w', buffering=1) as f:
             f.write(
                 f"[ Run Task {self.meta.name} ] ({datetime.datetime.now().isoformat()})\n"
             )
             for idx, step in enumerate(self.meta.steps):
                 print(f"Running step {step.display}")
                 taskEnv.taskStep = idx
+                if onStep is not None:
+                    onStep(idx)
                 try:
                     step.run(taskEnv, f)
                     f.write("\n")
@@ -109,8 +199,16 @@ class Task:
                 self._statusNotify.wait()
             return self.status
 
-    def toTaskReq(self, args: dict[str, Any] = {}) -> TaskRequest:
+    def toTaskReq(self,
+                  args: dict[str, Any] = {},
+                  slot: int = 0) -> TaskRequest:
         return TaskRequest(repo_url=self.repoUrl,
                            branch=self.branch,
                            task_path=self.meta.file,
-                           args=args)
+                           args=args,
+                           slot=slot,
+                           task_id=self.id,
+                           transfer=self.transfer,
+                           compression=self.compression,
+                           artifacts=self.artifacts,
+                           commit=self.commit.hex())
@@ -2,6 +2,7 @@ import os
 from typing import Dict
 import time
 
+from tubular.artifacts import ArtifactCache, ArtifactSource
 from tubular.constantManager import ConstManager
 
 
@@ -20,6 +21,9 @@ class TaskEnv:
         args["workspace"] = os.path.abspath(workspace)
         self.taskStep = 0
         self.startTime = 0.0
+        # task name -> where to get its archive, for get-archive steps
+        self.artifacts: Dict[str, ArtifactSource] = {}
+        self.artifactCache: ArtifactCache | None = None
 
     def replace(self, text: str) -> str:
         return ConstManager.replace(text, self.args)
@@ -11,9 +11,11 @@ from tubular.pipeline import PipelineReq
 from tubular.constantManager import ConstManager
 from tubular.tempManager import TempManager
 from tubular.yaml import getStr
+from tubular.enums import Priority, strToPriority
 
 
 class Trigger:
+    DEFAULT_PRIORITY = Priority.Manual
 
     def __init__(self, config: dict[str, Any]) -> None:
         self.piplines: list[PipelineReq] = []
@@ -23,6 +25,11 @@ class Trigger:
         except KeyError:
             raise RuntimeError("Trigger missing name [triggers.*.name]")
 
+        try:
+            priority = strToPriority(getStr(config, "priority"))
+        except KeyError:
+            priority = self.DEFAULT_PRIORITY
+
         try:
             pipelineConfigs = config["pipelines"]
         except KeyError:
@@ -51,7 +58,16 @@ class Trigger:
             for key, val in argsDict.items():
                 args.append({"k": key, "v": val})
 
-            req = PipelineReq(branch="", pipeline_path=target, args=args)
+            # pipelines can override the trigger's priority
+            try:
+                pipelinePriority = strToPriority(getStr(p, "priority"))
+            except KeyError:
+                pipelinePriority = priority
+
+            req = PipelineReq(branch="",
+                              pipeline_path=target,
+                              args=args,
+                              priority=pipelinePriority.name)
             self.piplines.append(req)
 
     def check(self) -> bool:
@@ -59,6 +75,7 @@ class Trigger:
 
 
 class CommitTrigger(Trigger):
+    DEFAULT_PRIORITY = Priority.Commit
 
     def __init__(self, config: dict[str, Any]) -> None:
         super().__init__(config)
@@ -147,6 +164,7 @@ _DAY_MAP = {
 
 
 class ScheduleTrigger(Trigger):
+    DEFAULT_PRIORITY = Priority.Schedule
 
     def __init__(self, config: dict[str, Any]) -> None:
         super().__init__(config)
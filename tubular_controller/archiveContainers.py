@@ -0,0 +1,194 @@
+import hashlib
+import io
+import os
+import shutil
+import struct
+import zipfile
+from typing import IO
+
+from tubular.file_utils import STREAM_CHUNK_SIZE
+
+# task zips of a run are kept in <archive path>.zips instead of being
+# extracted, files are read straight out of them
+CONTAINERS_SUFFIX = ".zips"
+
+# size of the fixed part of a zip's local file header
+_LOCAL_HEADER_SIZE = 30
+
+
+class ArchiveFile:
+    """
+    A file in a run's archive, either on disk or a member of one of the
+    task zips
+    """
+
+    def __init__(self,
+                 path: str,
+                 size: int,
+                 etag: str,
+                 member: str | None = None) -> None:
+        # the file, or the zip holding it
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.member = member
+
+    def open(self) -> IO[bytes]:
+        """
+        Open the file for reading. Stored members are read straight out of
+        the zip, compressed ones are decompressed as they are read and
+        seeking forward in them skips over the data
+        """
+        if self.member is None:
+            return open(self.path, mode='rb')
+        # the zip's file handle stays open until the member is closed
+        with zipfile.ZipFile(self.path, mode='r') as f:
+            info = f.getinfo(self.member)
+            if info.compress_type == zipfile.ZIP_STORED:
+                return _openStored(self.path, info)
+            return f.open(self.member, mode='r')
+
+    def getHash(self) -> str:
+        """
+        Returns the hex sha256 of the file's contents
+        """
+        out = hashlib.sha256()
+        with self.open() as f:
+            while True:
+                data = f.read(STREAM_CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                out.update(data)
+        return out.hexdigest()
+
+
+class _StoredMember(io.RawIOBase):
+    """
+    An uncompressed zip member, seeking goes straight to the position
+    """
+
+    def __init__(self, file: IO[bytes], start: int, size: int) -> None:
+        self._file = file
+        self._start = start
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = min(max(offset, 0), self._size)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        self._file.seek(self._start + self._pos)
+        data = self._file.read(min(len(buffer), self._size - self._pos))
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def _openStored(path: str, info: zipfile.ZipInfo) -> IO[bytes]:
+    f = open(path, mode='rb')
+    try:
+        f.seek(info.header_offset)
+        header = f.read(_LOCAL_HEADER_SIZE)
+        if len(header) != _LOCAL_HEADER_SIZE or header[:4] != b"PK\x03\x04":
+            raise RuntimeError(f"Bad zip entry: {info.filename}")
+        nameSize, extraSize = struct.unpack("<HH", header[26:30])
+    except:
+        f.close()
+        raise
+    start = info.header_offset + _LOCAL_HEADER_SIZE + nameSize + extraSize
+    return io.BufferedReader(_StoredMember(f, start, info.file_size),
+                             buffer_size=STREAM_CHUNK_SIZE)
+
+
+def getContainerDir(archivePath: str) -> str:
+    return f"{archivePath}{CONTAINERS_SUFFIX}"
+
+
+def addContainer(archivePath: str, name: str, archiveZip: str):
+    """
+    Move a task's archive zip into the run's containers, replacing the
+    zip from an earlier attempt at the task
+    """
+    dest = _getContainerPath(archivePath, name)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(archiveZip, dest)
+
+
+def removeContainers(archivePath: str):
+    shutil.rmtree(getContainerDir(archivePath), ignore_errors=True)
+
+
+def _getContainerPath(archivePath: str, name: str) -> str:
+    # task names can have directories in them
+    return os.path.join(getContainerDir(archivePath), f"{name}.zip")
+
+
+def _getContainers(archivePath: str, task: str | None = None) -> list[str]:
+    """
+    The run's zips, newest first, so a file written by several tasks
+    comes from the last one like it would when extracting them in order.
+    Only the task's zip if one is given
+    """
+    if task is not None:
+        path = _getContainerPath(archivePath, task)
+        return [path] if os.path.isfile(path) else []
+    out: list[str] = []
+    for root, _, files in os.walk(getContainerDir(archivePath)):
+        out.extend(os.path.join(root, x) for x in files if x.endswith(".zip"))
+    out.sort(key=lambda x: os.stat(x).st_mtime_ns, reverse=True)
+    return out
+
+
+def listMembers(archivePath: str, task: str | None = None) -> dict[str, int]:
+    """
+    Returns the files in the run's zips with their sizes, or only the
+    ones in the task's zip
+    """
+    out: dict[str, int] = {}
+    for container in _getContainers(archivePath, task):
+        with zipfile.ZipFile(container, mode='r') as f:
+            for info in f.infolist():
+                if info.is_dir():
+                    continue
+                out.setdefault(os.path.normpath(info.filename),
+                               info.file_size)
+    return out
+
+
+def findMember(archivePath: str,
+               file: str,
+               task: str | None = None) -> ArchiveFile | None:
+    """
+    Find the zip holding the file, None if none of them have it. Only
+    looks in the task's zip if one is given
+    """
+    # zips always use / as their separator
+    name = os.path.normpath(file).replace(os.sep, "/")
+    for container in _getContainers(archivePath, task):
+        with zipfile.ZipFile(container, mode='r') as f:
+            try:
+                info = f.getinfo(name)
+            except KeyError:
+                continue
+        etag = f"{info.CRC:08x}-{info.file_size:x}"
+        return ArchiveFile(container, info.file_size, etag, name)
+    return None
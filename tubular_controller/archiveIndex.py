@@ -0,0 +1,179 @@
+import fnmatch
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from tubular.file_utils import hashFile
+from tubular_controller.archiveContainers import listMembers
+
+# number of loaded indexes kept in memory
+MAX_CACHED_INDEXES = 16
+
+# (relative path, size, hex sha256 or "" if unknown)
+IndexEntry = tuple[str, int, str]
+
+
+class ArchiveIndex:
+    """
+    The files of an archive or output directory, written once when a run
+    finishes so listing them doesn't need to walk the tree. Entries are
+    grouped by directory for listing one level at a time
+    """
+
+    def __init__(self, files: list[IndexEntry]) -> None:
+        self.files = files
+        # dir -> sub directory names
+        self._dirs: dict[str, set[str]] = {"": set()}
+        # dir -> (name, size, hash) of the files in it
+        self._files: dict[str, list[IndexEntry]] = {}
+        for path, size, digest in files:
+            parent, name = os.path.split(path)
+            self._files.setdefault(parent, []).append((name, size, digest))
+            self._addDir(parent)
+        for x in self._files.values():
+            x.sort()
+
+    def _addDir(self, path: str):
+        while path not in self._dirs:
+            self._dirs[path] = set()
+            parent, name = os.path.split(path)
+            self._dirs.setdefault(parent, set()).add(name)
+            path = parent
+
+    @staticmethod
+    def getPath(root: str) -> str:
+        return f"{root}.index"
+
+    @staticmethod
+    def build(root: str,
+              hashes: dict[str, str] = {},
+              remoteFiles: dict[str, int] = {},
+              hashMissing: bool = True) -> "ArchiveIndex":
+        """
+        Walk the directory and the run's task zips, hashes are reused from
+        the given ones or an existing index before hashing the file again.
+        Members of zips aren't hashed. Remote files are ones that aren't
+        in the directory, like those still on a node
+        """
+        known = dict(hashes)
+        old = ArchiveIndex._read(root)
+        if old is not None:
+            for path, _, digest in old.files:
+                if len(digest) > 0:
+                    known.setdefault(path, digest)
+
+        files: dict[str, IndexEntry] = {}
+        for path, size in remoteFiles.items():
+            files[path] = (path, size, "")
+        for path, size in listMembers(root).items():
+            files[path] = (path, size, "")
+
+        if os.path.isdir(root):
+            for curRoot, _, names in os.walk(root):
+                for x in names:
+                    full = os.path.join(curRoot, x)
+                    path = os.path.relpath(full, root)
+                    digest = known.get(path, "")
+                    if len(digest) == 0 and hashMissing:
+                        digest = hashFile(full)
+                    files[path] = (path, os.path.getsize(full), digest)
+
+        return ArchiveIndex(sorted(files.values()))
+
+    def write(self, root: str):
+        out = ArchiveIndex.getPath(root)
+        temp = f"{out}.{uuid.uuid4().hex}"
+        with open(temp, mode='w') as f:
+            json.dump({"files": self.files}, f)
+        os.replace(temp, out)
+
+    @staticmethod
+    def remove(root: str):
+        try:
+            os.remove(ArchiveIndex.getPath(root))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _read(root: str) -> "ArchiveIndex | None":
+        try:
+            with open(ArchiveIndex.getPath(root), mode='r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return ArchiveIndex([tuple(x) for x in data["files"]])
+
+    @staticmethod
+    def load(root: str) -> "ArchiveIndex | None":
+        """
+        Returns the index of the directory if it has one, recently used
+        indexes are kept in memory until their file changes
+        """
+        try:
+            mtime = os.stat(ArchiveIndex.getPath(root)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        with _cacheLock:
+            try:
+                cachedTime, index = _cache[root]
+                if cachedTime == mtime:
+                    _cache.move_to_end(root)
+                    return index
+            except KeyError:
+                pass
+
+        index = ArchiveIndex._read(root)
+        if index is None:
+            return None
+
+        with _cacheLock:
+            _cache[root] = (mtime, index)
+            _cache.move_to_end(root)
+            while len(_cache) > MAX_CACHED_INDEXES:
+                _cache.popitem(last=False)
+        return index
+
+    def listDir(self, path: str, offset: int, limit: int,
+                pattern: str | None) -> tuple[int, list[dict]]:
+        """
+        Returns the number of matching entries in the directory and the
+        requested page of them, directories first
+        """
+        path = os.path.normpath(path).strip(os.sep)
+        if path == ".":
+            path = ""
+        if path not in self._dirs:
+            raise RuntimeError(f"Path not found: '{path}'")
+
+        entries: list[dict] = []
+        for name in sorted(self._dirs[path]):
+            if pattern is None or fnmatch.fnmatchcase(name, pattern):
+                entries.append({
+                    "label": name,
+                    "path": os.path.join(path, name),
+                    "dir": True,
+                })
+        for name, size, digest in self._files.get(path, []):
+            if pattern is None or fnmatch.fnmatchcase(name, pattern):
+                entries.append({
+                    "label": name,
+                    "path": os.path.join(path, name),
+                    "size": size,
+                    "sha256": digest,
+                })
+
+        return len(entries), entries[offset:offset + limit]
+
+    def getSize(self) -> int:
+        return sum(x[1] for x in self.files)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+
+_cacheLock = threading.Lock()
+# root -> (index mtime, index)
+_cache: OrderedDict[str, tuple[int, ArchiveIndex]] = OrderedDict()
@@ -1,39 +1,42 @@
-import os
+from tubular_controller.archiveIndex import ArchiveIndex
+
+# entries returned per page when the request doesn't say
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
 
 
 class ArchiveLister:
 
-    def __init__(self, pipeline: str, branch: str, run: int, archivePath: str,
+    def __init__(self, pipeline: str, branch: str, run: int,
                  api: str) -> None:
         self.pipeline = pipeline
         self.branch = branch
         self.run = run
-        self.archivePath = archivePath
         self.api = api
 
-    def getArchiveList(self) -> dict:
-        out = {}
-        self._buildArchiveList("", self.archivePath, out)
-        return out
-
-    def _buildArchiveList(self, parentPath: str, curPath: str, out: dict):
-        out['label'] = curPath
-
-        children = []
-        out['children'] = children
-
-        fullPath = os.path.join(parentPath, curPath)
-
-        for x in os.scandir(fullPath):
-            child = {}
-
-            if x.is_file():
-                child['label'] = x.name
-                relPath = os.path.relpath(os.path.join(fullPath, x.name),
-                                          self.archivePath)
-                child[
-                    'href'] = f'/api/{self.api}?pipeline={self.pipeline}&branch={self.branch}&run={self.run}&file={relPath}'
-            else:
-                self._buildArchiveList(fullPath, x.name, child)
-
-            children.append(child)
+    def getArchiveList(self,
+                       index: ArchiveIndex,
+                       path: str = "",
+                       offset: int = 0,
+                       limit: int = DEFAULT_PAGE_SIZE,
+                       pattern: str | None = None) -> dict:
+        """
+        One page of a single directory level, sub directories are
+        listed by requesting their path
+        """
+        offset = max(offset, 0)
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+        total, children = index.listDir(path, offset, limit, pattern)
+        for child in children:
+            if "dir" not in child:
+                child['href'] = self._makeHref(child['path'])
+
+        return {
+            "path": path,
+            "total": total,
+            "offset": offset,
+            "children": children,
+        }
+
+    def _makeHref(self, relPath: str) -> str:
+        return f'/api/{self.api}?pipeline={self.pipeline}&branch={self.branch}&run={self.run}&file={relPath}'
@@ -0,0 +1,116 @@
+import os
+import shutil
+import uuid
+
+from tubular.file_utils import hashFile
+
+
+class BlobStore:
+    """
+    Archived files stored once by content hash. Run archives are made of
+    hardlinks to the blobs, so the link count of a blob is its reference
+    count, and a blob with a single link is only referenced by the store
+    """
+
+    def __init__(self) -> None:
+        self.path = ""
+
+    def setWorkspace(self, path: str):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def getManifestPath(archivePath: str) -> str:
+        return f"{archivePath}.blobs"
+
+    def _getBlobPath(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _linkBlob(self, file: str, digest: str) -> bool:
+        """
+        Replace the file with a link to the blob, or make the file the
+        blob if there isn't one yet. Returns whether it became the blob
+        """
+        blob = self._getBlobPath(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        # the blob can be collected between these, so retry once
+        for _ in range(2):
+            try:
+                os.link(file, blob)
+                return True
+            except FileExistsError:
+                pass
+            temp = f"{file}.{uuid.uuid4().hex}"
+            try:
+                os.link(blob, temp)
+            except FileNotFoundError:
+                continue
+            os.replace(temp, file)
+            return False
+        return False
+
+    def dedupe(self, archivePath: str) -> tuple[dict[str, str], int]:
+        """
+        Move the files of a finished run into the store and add the
+        blobs it uses to its manifest. Returns the hashes of the files
+        that were moved, by their path relative to the archive, and the
+        bytes of the blobs that weren't in the store yet
+        """
+        digests: list[str] = []
+        hashes: dict[str, str] = {}
+        storedBytes = 0
+        for root, _, files in os.walk(archivePath):
+            for x in files:
+                file = os.path.join(root, x)
+                if os.path.islink(file) or os.path.getsize(file) == 0:
+                    continue
+                # already in the store, i.e. from an earlier dedupe
+                if os.stat(file).st_nlink > 1:
+                    continue
+                digest = hashFile(file)
+                try:
+                    if self._linkBlob(file, digest):
+                        storedBytes += os.path.getsize(file)
+                except OSError as err:
+                    # i.e. no hardlinks on this filesystem, keep the copy
+                    print(f"Unable to dedupe {file}:", err)
+                    continue
+                digests.append(digest)
+                hashes[os.path.relpath(file, archivePath)] = digest
+
+        # files can arrive later, i.e. lazily transferred ones
+        with open(self.getManifestPath(archivePath), mode='a') as f:
+            for digest in digests:
+                f.write(f"{digest}\n")
+        return hashes, storedBytes
+
+    def removeTree(self, archivePath: str):
+        """
+        Remove a run's archive and any blobs nothing else uses anymore
+        """
+        shutil.rmtree(archivePath, ignore_errors=True)
+        manifest = self.getManifestPath(archivePath)
+        try:
+            with open(manifest, mode='r') as f:
+                digests = set(f.read().split())
+        except FileNotFoundError:
+            return
+        for digest in digests:
+            self._collect(self._getBlobPath(digest))
+        os.remove(manifest)
+
+    def _collect(self, blob: str):
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+    def collectAll(self):
+        """
+        Remove every unused blob, catches anything left behind when the
+        controller stopped partway through removing a run
+        """
+        for root, _, files in os.walk(self.path):
+            for x in files:
+                self._collect(os.path.join(root, x))
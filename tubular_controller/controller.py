@@ -1,33 +1,79 @@
 import os
 import shutil
-from typing import Any
+from typing import Any, AsyncIterator, Callable, Iterator
+import asyncio
 import threading
 import time
 import glob
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 import json
+import requests
+from urllib.parse import urlencode
 
 from tubular_controller.nodeConnection import NodeConnection
+from tubular_controller.nodePool import NodePool, NodeClass
 from tubular_controller.taskQueue import TaskQueue, QueueTask
-from tubular_controller.archiveLister import ArchiveLister
+from tubular_controller.durations import DurationEstimates
+from tubular_controller.taskCache import TaskCache
+from tubular_controller.blobStore import BlobStore
+from tubular_controller.archiveIndex import ArchiveIndex
+from tubular_controller import archiveContainers
+from tubular_controller.archiveContainers import ArchiveFile
+from tubular_controller.archiveLister import ArchiveLister, DEFAULT_PAGE_SIZE
+from tubular_controller.retention import RetentionLimits, selectExpiredRuns
+from tubular_controller import logStore
+from tubular_controller.logStore import Log
 
 from tubular import git_cmds
 from tubular.pipeline import Pipeline, PipelineReq, PipelineDef, formatPipelineName
-from tubular.stage import Stage
+from tubular.task import Task, NodeEvent
+from tubular.artifacts import ArtifactSource
 from tubular_node.node import NodeStatus, PipelineStatus
-from tubular.pipeline_db import PipelineDB
-from tubular.file_utils import decompressArchive, decompressOutputFile, sanitizeFilepath
+from tubular.pipeline_db import PipelineDB, ActiveRun, TaskState, RemoteArtifact, StoredRun
+from tubular.file_utils import decompressOutputFile, sanitizeFilepath
 from tubular.repo import Repo
 from tubular.trigger import Trigger, makeTrigger
 from tubular.yaml import loadYAML
 from tubular.constantManager import ConstManager
+from tubular.enums import strToPriority
 from tubular.tempManager import TempManager
 
 NODE_UPDATE_PERIOD = 2
+# how often to poll when the nodes push their events, only
+# needed to notice nodes going offline
+NODE_LIVENESS_PERIOD = 10
+# how often to look for lazily transferred archives to pull in
+REPLICATE_PERIOD = 30
+# how often old runs are looked for when nothing else triggers it
+GC_PERIOD = 300
+# old runs are removed this many at a time with a pause in between, so
+# the disk isn't kept busy with deletes
+GC_BATCH_SIZE = 10
+GC_BATCH_DELAY = 1
+# how often live output followers check on tasks that haven't started
+LIVE_OUTPUT_POLL = 1
 PIPELINE_UPDATE_PERIOD = 30
 TRIGGER_UPDATE_PERIOD = 30
 
+# Pipeline runs don't get a thread each, their setup and completion
+# handling run as short jobs on a small pool
+ORCHESTRATOR_WORKERS = 4
+# Fetching and setting up runs, and deduping and indexing the finished
+# ones, run on their own pool so slow disks or remotes don't hold up task
+# completions and dispatch
+IO_WORKERS = 4
+# Runs past this limit wait for a running one to finish before they are
+# set up, can be overridden with TUBULAR_MAX_ACTIVE_RUNS
+MAX_ACTIVE_RUNS = 32
+# node status requests are sent in parallel, threads are only started
+# as needed
+MAX_HEARTBEAT_WORKERS = 64
+# live output followers wait on the nodes in threads of their own so they
+# can't tie up the API's, followers past the limit are turned away
+MAX_LIVE_FOLLOWERS = 32
+
 
 class _PipelineCache:
 
@@ -42,11 +88,50 @@ class _PipelineCache:
         return None
 
 
+# (pipeline file, branch, commit, args), identical requests have the
+# same key
+_RunKey = tuple[str, str, bytes, tuple[tuple[str, str], ...]]
+# (pipeline id, run number)
+_RunID = tuple[int, int]
+
+
+class _PipelineRun:
+    """
+    State of a pipeline run that is in progress, advanced by the
+    orchestrator pool each time one of its tasks completes
+    """
+
+    def __init__(self, pipeline: Pipeline, repo: Repo, worktreePath: str,
+                 startTime: float, stageStatuses: list[dict]) -> None:
+        self.pipeline = pipeline
+        self.repo = repo
+        self.worktreePath = worktreePath
+        self.startTime = startTime
+        self.stageStatuses = stageStatuses
+        # task name -> its entry in stageStatuses
+        self.statuses: dict[str, dict] = {}
+        self.nodeClasses: dict[Task, list[NodeClass]] = {}
+        # estimated time from each task starting to the run ending
+        self.ranks: dict[Task, float] = {}
+        # tasks waiting on their needs
+        self.pending: list[Task] = []
+        self.numRunning = 0
+        # archived files still on the nodes, path -> size
+        self.remoteFiles: dict[str, int] = {}
+        # tasks that get-archive steps get files from
+        self.archiveSources: set[str] = set()
+        self.finished = False
+        # keys that identical requests are merged into this run under
+        self.runKeys: list[_RunKey] = []
+        # serializes the completion handling of the run's tasks
+        self.lock = threading.Lock()
+
+
 class ControllerState:
 
     def __init__(self) -> None:
         self.workspace = ""
-        self.nodes: list[NodeConnection] = []
+        self.nodePool = NodePool()
 
         self.configRepo: Repo = Repo("", "", "")
         self.configCommit = bytearray()
@@ -56,23 +141,82 @@ class ControllerState:
         self.pipelinePaths: list[str] = []
         self.pipelineRepoDefBranch: str = "main"
 
+        # url nodes can reach the controller at, nodes are
+        # only polled when this isn't set
+        self.controllerUrl = ""
+        # how task files are sent back, stream, zip or lazy
+        self.transferMode = "stream"
+        # keep task outputs compressed in blocks once they are indexed,
+        # set with TUBULAR_COMPRESS_LOGS=1
+        self.compressLogs = False
+
         self.shouldRun = True
         self._workerThread = threading.Thread()
 
         self.taskQueueCV = threading.Condition()
         self.taskQueue = TaskQueue()
+        # task ID -> queue entry, for every task that hasn't completed
+        self._queuedTasks: dict[str, QueueTask] = {}
+        self.durations = DurationEstimates()
+        self.taskCache = TaskCache()
+        self.blobStore = BlobStore()
+
+        self._nodeMonitorThread = threading.Thread()
+        self._nodeMonitorCV = threading.Condition()
+        self._sweepRequested = False
+        self._updateConfigsRequested = False
+        self._heartbeatPool = ThreadPoolExecutor(
+            max_workers=MAX_HEARTBEAT_WORKERS, thread_name_prefix="heartbeat")
+        self._followerPool = ThreadPoolExecutor(
+            max_workers=MAX_LIVE_FOLLOWERS, thread_name_prefix="follower")
+        self._followers = threading.BoundedSemaphore(MAX_LIVE_FOLLOWERS)
+
+        self._orchestrator = ThreadPoolExecutor(
+            max_workers=ORCHESTRATOR_WORKERS,
+            thread_name_prefix="orchestrator")
+        self._ioPool = ThreadPoolExecutor(max_workers=IO_WORKERS,
+                                          thread_name_prefix="io")
+        self.maxActiveRuns = MAX_ACTIVE_RUNS
+        self._admissionLock = threading.Lock()
+        self._numActiveRuns = 0
+        # (setup job, args) for the runs waiting to be admitted
+        self._admissionQueue: deque[tuple[Callable, tuple]] = deque()
 
         self.triggerLock = threading.Semaphore()
         self._triggerThread = threading.Thread()
         self.triggers: list[Trigger] = []
 
-        self._lastNodeCheck = 0
+        self._replicatorThread = threading.Thread()
+        self._replicatorCV = threading.Condition()
+
+        self.retentionLimits = RetentionLimits()
+        self._gcThread = threading.Thread()
+        self._gcCV = threading.Condition()
+        self._gcRequested = False
+        # held while a run's archive is being changed from the background
+        # threads, so the collector doesn't remove it halfway through
+        self._archiveLock = threading.Lock()
+
         self._tasksWaiting = 0
 
+        # (pipeline id, run number) -> runs in progress, for showing them
+        # while they run
+        self._activeRunsLock = threading.Lock()
+        self._activeRuns: dict[tuple[int, int], _PipelineRun] = {}
+
         self._pipelineCache: dict[str, _PipelineCache] = {}
 
         self._branchLocks: dict[str, threading.Semaphore] = defaultdict(
             threading.Semaphore)
+        self._cleanedBranches: set[str] = set()
+        # key -> run for the coalescing runs in progress, they're only
+        # added with the run's branch lock held
+        self._runKeysLock = threading.Lock()
+        self._runKeys: dict[_RunKey, _RunID] = {}
+        # the same runs keyed by the args as they were requested rather
+        # than with the defaults filled in, so identical requests can be
+        # merged before they are admitted and the branch is fetched
+        self._requestKeys: dict[_RunKey, _RunID] = {}
 
         self._lastConfigUpdate = time.time()
 
@@ -86,10 +230,61 @@ class ControllerState:
         if not os.path.exists(self.workspace):
             os.makedirs(self.workspace, exist_ok=True)
 
+        try:
+            self.controllerUrl = os.environ["TUBULAR_CONTROLLER_URL"].rstrip(
+                "/")
+        except KeyError:
+            pass
+
+        try:
+            self.transferMode = os.environ["TUBULAR_TRANSFER_MODE"]
+        except KeyError:
+            pass
+        if self.transferMode not in ("stream", "zip", "lazy"):
+            raise RuntimeError(
+                f"Invalid TUBULAR_TRANSFER_MODE: {self.transferMode}")
+
+        try:
+            self.compressLogs = os.environ["TUBULAR_COMPRESS_LOGS"] == "1"
+        except KeyError:
+            pass
+
+        try:
+            self.maxActiveRuns = int(os.environ["TUBULAR_MAX_ACTIVE_RUNS"])
+        except KeyError:
+            pass
+        if self.maxActiveRuns < 1:
+            raise RuntimeError("TUBULAR_MAX_ACTIVE_RUNS must be at least 1")
+
+        try:
+            self.taskCache.maxBytes = int(
+                float(os.environ["TUBULAR_CACHE_MAX_MB"]) * 1024 * 1024)
+        except KeyError:
+            pass
+        try:
+            self.taskCache.keepDays = float(
+                os.environ["TUBULAR_CACHE_KEEP_DAYS"])
+        except KeyError:
+            pass
+
+        try:
+            self.retentionLimits.keepDays = float(
+                os.environ["TUBULAR_KEEP_DAYS"])
+        except KeyError:
+            pass
+        try:
+            self.retentionLimits.maxBytes = int(
+                float(os.environ["TUBULAR_MAX_STORAGE_MB"]) * 1024 * 1024)
+        except KeyError:
+            pass
+
         dbFile = os.path.join(self.workspace, "tubular.db")
         self._db = PipelineDB(dbFile)
+        self.durations.load(self._db)
 
         TempManager.setWorkspace(os.path.join(self.workspace, "temp"))
+        self.taskCache.setWorkspace(os.path.join(self.workspace, "cache"))
+        self.blobStore.setWorkspace(os.path.join(self.workspace, "blobs"))
 
         try:
             configRepoUrl = os.environ["TUBULAR_CONFIG_REPO"]
@@ -105,20 +300,41 @@ class ControllerState:
         self.configRepo = Repo(configRepoUrl, configBranch, configDir)
 
         self.loadConfigs()
+        self._resumeRuns()
+        self._submitIO(self.blobStore.collectAll)
 
         self._workerThread = threading.Thread(
             target=self.queueManagementThread, daemon=True)
         self._workerThread.start()
 
+        self._nodeMonitorThread = threading.Thread(
+            target=self.nodeMonitorThread, daemon=True)
+        self._nodeMonitorThread.start()
+
         self._triggerThread = threading.Thread(
             target=self.triggerManagementThread, daemon=True)
         self._triggerThread.start()
 
+        self._replicatorThread = threading.Thread(
+            target=self.replicatorThread, daemon=True)
+        self._replicatorThread.start()
+
+        self._gcThread = threading.Thread(target=self.gcThread, daemon=True)
+        self._gcThread.start()
+        self._requestGC()
+
     def stop(self):
         print("Shutting down")
         self.shouldRun = False
-        with self.taskQueueCV:
-            self.taskQueueCV.notify()
+        self._notifyDispatcher()
+        self._notifyNodeMonitor()
+        with self._replicatorCV:
+            self._replicatorCV.notify()
+        self._requestGC()
+        self._orchestrator.shutdown(wait=False, cancel_futures=True)
+        self._ioPool.shutdown(wait=False, cancel_futures=True)
+        self._heartbeatPool.shutdown(wait=False, cancel_futures=True)
+        self._followerPool.shutdown(wait=False, cancel_futures=True)
 
     def loadConfigs(self):
         # TODO revert if config load fails
@@ -162,7 +378,7 @@ class ControllerState:
             nodeConfigs = loadYAML(
                 os.path.join(self.configRepo.path, "nodes.yaml"))['nodes']
 
-            self.nodes = []
+            nodes: list[NodeConnection] = []
 
             for name, args in nodeConfigs.items():
                 try:
@@ -171,8 +387,23 @@ class ControllerState:
                     hostname = name
                 port = args["port"]
                 tags = args["tags"]
-                n = NodeConnection(name, hostname, port, tags)
-                self.nodes.append(n)
+                numSlots = int(args.get("slots", 1))
+
+                # keep existing connections so we don't lose track
+                # of the tasks running on them
+                n = self.nodePool.getNode(name)
+                if n is not None and n.hostname == hostname and n.port == port and len(n.slots) == numSlots:
+                    n.tags = set(tags)
+                else:
+                    n = NodeConnection(name, hostname, port, tags, numSlots,
+                                       self._notifyDispatcher,
+                                       self._requeueLostTask)
+                if len(self.controllerUrl) > 0:
+                    n.callbackUrl = f"{self.controllerUrl}/api/nodes/{name}/events"
+                nodes.append(n)
+
+            self.nodePool.rebuild(nodes)
+            self.taskQueue.reindex(self.nodePool)
 
             self.updateNodeStatus(True)
 
@@ -194,179 +425,1011 @@ class ControllerState:
             time.sleep(TRIGGER_UPDATE_PERIOD)
 
     def queueManagementThread(self):
-        while True:
-            needSleep = False
-            with self.taskQueueCV:
-                if len(self.taskQueue) == 0 and self._tasksWaiting == 0:
+        with self.taskQueueCV:
+            while self.shouldRun:
+                # Sleep until something changes, i.e. a task is pushed,
+                # a node goes idle, or an archive download completes
+                if not self._dispatchTask():
                     self.taskQueueCV.wait()
-                if not self.shouldRun:
-                    break
-                self.updateNodeStatus()
-
-                cur = self.taskQueue.front
-                while cur != None:
-                    for node in cur.availableNodes:
-                        if node.status == NodeStatus.Idle:
-                            node.sendTask(cur.pipeline, cur.task)
-                            self.taskQueue.unlink(cur)
-                            node.status = NodeStatus.Active
-                            break
-                    cur = cur.next
 
-                if len(self.taskQueue) > 0:
-                    # Force sleep while waiting for nodes?
-                    # TODO probably better ways of doing this
-                    needSleep = True
+    def _dispatchTask(self) -> bool:
+        """
+        Send a queued task to an idle node, taskQueueCV must be held.
+        It's released while the node is contacted, so returns True if it
+        was, since anything may have changed in the meantime
+        """
+        for node in self.nodePool.nodes:
+            if node.getIdleSlot() is None:
+                continue
+            nodeClass = self.nodePool.getNodeClass(node)
+            # prefer tasks the node already has a workspace for
+            item = self.taskQueue.popFor(nodeClass,
+                                         lambda x: node.getWarmth(x.task))
+            if item is None:
+                continue
+            # but send them to whichever idle node has the warmest
+            # workspace for them
+            node = self.nodePool.getWarmestNode(item.task, item.nodeClasses,
+                                                node)
+            slot = node.reserveSlot(item.task)
+            if slot is None:
+                self.taskQueue.requeue(item)
+                continue
+
+            self.taskQueueCV.release()
+            try:
+                sent = node.sendTask(item.pipeline, item.task, slot)
+            finally:
+                self.taskQueueCV.acquire()
+
+            if not sent:
+                self.taskQueue.requeue(item)
+                return True
+            item.task.startTime = time.time()
+            self._db.setTaskState(item.pipeline.id, item.pipeline.runNum,
+                                  item.task.meta.name, item.task.id,
+                                  node.name, slot.idx, PipelineStatus.Running,
+                                  item.task.cacheKey)
+            return True
+        return False
+
+    def _pushTask(self, item: QueueTask):
+        with self.taskQueueCV:
+            self._queuedTasks[item.task.id] = item
+            self.taskQueue.push(item)
+            self._db.setTaskState(item.pipeline.id, item.pipeline.runNum,
+                                  item.task.meta.name, item.task.id, None,
+                                  None, PipelineStatus.Queued,
+                                  item.task.cacheKey)
+            self.taskQueueCV.notify()
+        self._notifyNodeMonitor()
+
+    def _requeueLostTask(self, task: Task):
+        with self.taskQueueCV:
+            try:
+                item = self._queuedTasks[task.id]
+            except KeyError:
+                return
+        self._pushTask(item)
+
+    def _notifyDispatcher(self):
+        with self.taskQueueCV:
+            self.taskQueueCV.notify()
+
+    def nodeMonitorThread(self):
+        """
+        Polls the nodes while there is outstanding work, this is how
+        we find out about nodes going idle and tasks completing. Other
+        callers request a sweep through updateNodeStatus()
+        """
+        while True:
+            with self._nodeMonitorCV:
+                while self.shouldRun and self._tasksWaiting == 0 and not self._sweepRequested:
+                    self._nodeMonitorCV.wait()
+                updateConfigs = self._updateConfigsRequested
+                self._sweepRequested = False
+                self._updateConfigsRequested = False
+            if not self.shouldRun:
+                break
+
+            self._sweepNodes(updateConfigs)
+            if len(self.controllerUrl) > 0:
+                time.sleep(NODE_LIVENESS_PERIOD)
+            else:
+                time.sleep(NODE_UPDATE_PERIOD)
+
+    def _sweepNodes(self, updateConfigs: bool):
+        """
+        Check the status of every node at once, so a sweep takes about
+        one round trip no matter how many nodes there are
+        """
+
+        def _update(node: NodeConnection):
+            try:
+                node.updateStatus(updateConfigs)
+            except Exception as err:
+                print(f"Error updating status of {node.name}:", err)
+
+        # wait for the whole sweep so they don't overlap
+        list(self._heartbeatPool.map(_update, self.nodePool.nodes))
+
+    def _notifyNodeMonitor(self):
+        with self._nodeMonitorCV:
+            self._nodeMonitorCV.notify()
+
+    def _submit(self, func: Callable, *args):
+        """
+        Run a short orchestration job on the worker pool
+        """
+        self._orchestrator.submit(self._runJob, func, args)
+
+    def _submitIO(self, func: Callable, *args):
+        """
+        Run a job that waits on git or the disk on the I/O pool
+        """
+        self._ioPool.submit(self._runJob, func, args)
+
+    @staticmethod
+    def _runJob(func: Callable, args: tuple):
+        try:
+            func(*args)
+        except Exception as err:
+            print("Exception in orchestrator job")
+            traceback.print_exception(err, chain=True)
+
+    def _admitRun(self, func: Callable, *args):
+        """
+        Start setting up a run if we're under the active run limit,
+        otherwise wait for a running one to finish. Every admitted run
+        must call _releaseRun() once it's done
+        """
+        with self._admissionLock:
+            if self._numActiveRuns < self.maxActiveRuns:
+                self._numActiveRuns += 1
+            else:
+                self._admissionQueue.append((func, args))
+                return
+        self._submitIO(func, *args)
 
-            # do this outside the mutex
-            if needSleep:
-                time.sleep(1)
+    def _releaseRun(self):
+        with self._admissionLock:
+            if len(self._admissionQueue) == 0:
+                self._numActiveRuns -= 1
+                return
+            # hand our spot straight to the next waiting run
+            func, args = self._admissionQueue.popleft()
+        self._submitIO(func, *args)
 
-    def queuePipeline(self, pipelineReq: PipelineReq):
+    def queuePipeline(self, pipelineReq: PipelineReq) -> _RunID | None:
+        """
+        Returns the run the request was merged into if an identical one
+        is already going
+        """
         if len(pipelineReq.branch.strip()) == 0:
             pipelineReq.branch = self.pipelineRepoDefBranch
+        # validate here so bad requests get rejected immediately
+        strToPriority(pipelineReq.priority)
+
+        runID = self._findIdenticalRun(pipelineReq)
+        if runID is not None:
+            self._mergeRequest(pipelineReq, runID)
+            return runID
+
         # TODO reject queue requests if pipeline repo has an update
-        threading.Thread(target=self._runPipelineThread,
-                         args=(pipelineReq, )).start()
+        requestID = self._db.addQueuedRequest(pipelineReq.model_dump_json())
+        self._admitRun(self._startRun, pipelineReq, requestID)
+        return None
+
+    def _findIdenticalRun(self, pipelineReq: PipelineReq) -> _RunID | None:
+        """
+        Look for a run of the same request at the branch's current
+        commit, without waiting for admission or the branch lock
+        """
+        with self._runKeysLock:
+            if len(self._requestKeys) == 0:
+                return None
+
+        repo = Repo(self.pipelineRepoUrl, pipelineReq.branch,
+                    self._getRepoPath(pipelineReq.branch))
+        try:
+            commit = bytes(git_cmds.getLatestRemoteCommit(repo))
+        except Exception:
+            # leave it to the run setup to report
+            return None
+
+        requestKey = self._getRequestKey(pipelineReq, commit)
+        with self._runKeysLock:
+            return self._requestKeys.get(requestKey)
+
+    def _mergeRequest(self, pipelineReq: PipelineReq, runID: _RunID):
+        pipelineID, runNum = runID
+        print(f"Merged request for {pipelineReq.pipeline_path} into run "
+              f"{runNum}")
+        self._db.addMergedRequest(pipelineID, runNum,
+                                  pipelineReq.model_dump_json())
+
+    def _resumeRuns(self):
+        """
+        Pick back up the requests and runs that were in progress
+        when the controller stopped
+        """
+        for run in self._db.getActiveRuns():
+            pipelineReq = PipelineReq.model_validate_json(run.request)
+            print(f"Resuming {pipelineReq.pipeline_path} run {run.runNum}")
+            self._admitRun(self._resumeRun, pipelineReq, run)
 
-    def _runPipelineThread(self, pipelineReq: PipelineReq):
+        for requestID, request in self._db.getQueuedRequests():
+            pipelineReq = PipelineReq.model_validate_json(request)
+            print(f"Requeueing {pipelineReq.pipeline_path}")
+            self._admitRun(self._startRun, pipelineReq, requestID)
+
+    def _resumeRun(self, pipelineReq: PipelineReq, activeRun: ActiveRun):
+        path = self._getRepoPath(pipelineReq.branch)
+        try:
+            with self._branchLocks[path]:
+                repo = self._cloneOrPullRepo(pipelineReq.branch)
+                # the commit may not be in the shallow clone anymore
+                git_cmds.fetchCommit(repo, activeRun.commit)
+                pipelineDef = PipelineDef(repo.path, pipelineReq.pipeline_path)
+                worktreePath = self._getWorktreePath(pipelineReq.branch,
+                                                     pipelineDef.name,
+                                                     activeRun.runNum)
+                git_cmds.addWorktree(repo, worktreePath, activeRun.commit)
+                # use the definition from the run's commit
+                pipelineDef = PipelineDef(worktreePath,
+                                          pipelineReq.pipeline_path)
+                runKeys = self._addRunKeys(
+                    pipelineDef, pipelineReq, activeRun.commit,
+                    (activeRun.pipelineId, activeRun.runNum))
+        except Exception as err:
+            print("Unable to resume run, marking as error")
+            traceback.print_exception(err, chain=True)
+            self._db.setRunStatus(activeRun.pipelineId, activeRun.runNum,
+                                  time.time() - activeRun.startTime,
+                                  PipelineStatus.Error, "{}")
+            self._db.removeActiveRun(activeRun.pipelineId, activeRun.runNum)
+            self._releaseRun()
+            return
+
+        self._beginRun(pipelineReq, activeRun.pipelineId, activeRun.runNum,
+                       activeRun.commit, repo, worktreePath, runKeys, None,
+                       activeRun)
+
+    def _startRun(self, pipelineReq: PipelineReq, requestID: int):
+        try:
+            prepared = self._prepareRun(pipelineReq)
+        except Exception as err:
+            print("Unable to start pipeline")
+            traceback.print_exception(err, chain=True)
+            self._db.removeQueuedRequest(requestID)
+            self._releaseRun()
+            return
+
+        if prepared is None:
+            # merged into an identical run
+            self._db.removeQueuedRequest(requestID)
+            self._releaseRun()
+            return
+
+        pipelineID, runNum, commit, repo, worktreePath, runKeys = prepared
+        self._beginRun(pipelineReq, pipelineID, runNum, commit, repo,
+                       worktreePath, runKeys, requestID)
+
+    def _prepareRun(
+        self, pipelineReq: PipelineReq
+    ) -> tuple[int, int, bytes, Repo, str, list[_RunKey]] | None:
+        """
+        Fetch the branch and reserve a run number and worktree for the
+        request, None if an identical run is already going
+        """
         path = self._getRepoPath(pipelineReq.branch)
 
+        # Only hold the branch lock while fetching, each run gets its own
+        # worktree pinned to the resolved commit so that runs of the same
+        # branch can execute concurrently
         with self._branchLocks[path]:
             repo = self._cloneOrPullRepo(pipelineReq.branch)
-            commit = git_cmds.getCurrentLocalCommit(repo)
+            commit = bytes(git_cmds.getCurrentLocalCommit(repo))
             pipelineDef = PipelineDef(repo.path, pipelineReq.pipeline_path)
 
+            # runs of the same branch are only registered under
+            # this lock, so this can't race another identical request
+            runKey = self._getRunKey(pipelineDef, pipelineReq, commit)
+            with self._runKeysLock:
+                runID = self._runKeys.get(runKey)
+            if pipelineDef.coalesce and runID is not None:
+                self._mergeRequest(pipelineReq, runID)
+                return None
+
             pipelineID, runNum = self._db.getPipelineIDAndNextRun(
                 pipelineDef.file)
+            worktreePath = self._getWorktreePath(pipelineReq.branch,
+                                                 pipelineDef.name, runNum)
+            git_cmds.addWorktree(repo, worktreePath, commit)
+            runKeys = self._addRunKeys(pipelineDef, pipelineReq, commit,
+                                       (pipelineID, runNum))
+
+        return pipelineID, runNum, commit, repo, worktreePath, runKeys
+
+    @staticmethod
+    def _getRunKey(pipelineDef: PipelineDef, pipelineReq: PipelineReq,
+                   commit: bytes) -> _RunKey:
+        args = pipelineDef.getArgs(pipelineReq)
+        return (pipelineDef.file, pipelineReq.branch, bytes(commit),
+                tuple(sorted(args.items())))
+
+    @staticmethod
+    def _getRequestKey(pipelineReq: PipelineReq, commit: bytes) -> _RunKey:
+        args = {x["k"]: x["v"] for x in pipelineReq.args}
+        return (pipelineReq.pipeline_path, pipelineReq.branch, bytes(commit),
+                tuple(sorted(args.items())))
+
+    def _addRunKeys(self, pipelineDef: PipelineDef, pipelineReq: PipelineReq,
+                    commit: bytes, runID: _RunID) -> list[_RunKey]:
+        """
+        Register a run so identical requests get merged into it, the
+        branch lock must be held
+        """
+        if not pipelineDef.coalesce:
+            return []
+        runKeys = [
+            self._getRunKey(pipelineDef, pipelineReq, commit),
+            self._getRequestKey(pipelineReq, commit)
+        ]
+        with self._runKeysLock:
+            self._runKeys[runKeys[0]] = runID
+            self._requestKeys[runKeys[1]] = runID
+        return runKeys
+
+    def _removeRunKeys(self, runKeys: list[_RunKey]):
+        if len(runKeys) == 0:
+            return
+        with self._runKeysLock:
+            self._runKeys.pop(runKeys[0], None)
+            self._requestKeys.pop(runKeys[1], None)
+
+    def _beginRun(self,
+                  pipelineReq: PipelineReq,
+                  pipelineID: int,
+                  runNum: int,
+                  commit: bytes,
+                  repo: Repo,
+                  worktreePath: str,
+                  runKeys: list[_RunKey],
+                  requestID: int | None,
+                  resumeRun: ActiveRun | None = None):
+        try:
+            run = self._createRun(pipelineReq, pipelineID, runNum, commit,
+                                  repo, worktreePath, requestID, resumeRun)
+            run.runKeys = runKeys
+        except Exception as err:
+            print("Unable to start pipeline")
+            traceback.print_exception(err, chain=True)
+            if requestID is not None:
+                self._db.removeQueuedRequest(requestID)
+            self._removeRunKeys(runKeys)
+            with self._branchLocks[repo.path]:
+                git_cmds.removeWorktree(repo, worktreePath)
+            self._releaseRun()
+            return
+
+        with run.lock:
+            try:
+                self._restoreTasks(run, resumeRun)
+            except Exception as err:
+                print("Exception occurred while running pipeline")
+                traceback.print_exception(err, chain=True)
+                run.pipeline.status = PipelineStatus.Fail
+            self._advanceRun(run)
+
+    def _createRun(self, pipelineReq: PipelineReq, pipelineID: int,
+                   runNum: int, commit: bytes, repo: Repo,
+                   worktreePath: str, requestID: int | None,
+                   resumeRun: ActiveRun | None) -> _PipelineRun:
+        # reload the definition from the pinned commit
+        pipelineDef = PipelineDef(worktreePath, pipelineReq.pipeline_path)
+
+        archivePath = self._getArchivePath(pipelineReq.branch,
+                                           pipelineDef.name, runNum)
+        outputPath = self._getOutputPath(pipelineReq.branch, pipelineDef.name,
+                                         runNum)
+
+        os.makedirs(archivePath, exist_ok=resumeRun is not None)
+        os.makedirs(outputPath, exist_ok=resumeRun is not None)
+
+        pipeline = Pipeline(
+            self.pipelineRepoUrl,
+            pipelineDef,
+            pipelineReq,
+            archivePath,
+            outputPath,
+            commit,
+        )
+
+        pipeline.id = pipelineID
+        pipeline.runNum = runNum
+
+        if resumeRun is None:
+            start = time.time()
+            self._db.addRun(pipelineID, runNum, pipelineReq.branch, commit,
+                            start)
+            self._db.addActiveRun(pipelineID, runNum,
+                                  pipelineReq.model_dump_json(), commit, start)
+        else:
+            start = resumeRun.startTime
+
+        # the run is now tracked in the DB
+        if requestID is not None:
+            self._db.removeQueuedRequest(requestID)
+
+        # old runs are removed in the background
+        self._db.setRetentionPolicy(
+            pipelineID, pipeline.meta.maxRuns, pipeline.meta.keepDays,
+            int(pipeline.meta.maxSizeMB * 1024 * 1024))
+        self._requestGC()
+
+        print(pipeline.stages)
+
+        stageStatuses = [{
+            "display":
+            stage.meta.display,
+            "stages": [{
+                "display": task.meta.display,
+                "output": os.path.relpath(task.outputFile, outputPath),
+                "status": task.status,
+                "cached": False,
+            } for task in stage.tasks]
+        } for stage in pipeline.stages]
+
+        run = _PipelineRun(pipeline, repo, worktreePath, start, stageStatuses)
+        for sIdx, stage in enumerate(pipeline.stages):
+            for tIdx, task in enumerate(stage.tasks):
+                run.statuses[task.meta.name] = stageStatuses[sIdx]['stages'][
+                    tIdx]
+
+        with self._activeRunsLock:
+            self._activeRuns[(pipelineID, runNum)] = run
+        return run
+
+    def _getNodeClasses(self, task: Task) -> list[NodeClass]:
+        nodeClasses = self.nodePool.getEligibleClasses(
+            task.meta.whiteTags, task.meta.blackTags)
+
+        if len(nodeClasses) == 0:
+            raise RuntimeError(f"No available nodes for {task.meta.name}")
+
+        return nodeClasses
+
+    def _restoreTasks(self, run: _PipelineRun, resumeRun: ActiveRun | None):
+        """
+        Work out which tasks still need to run, when resuming a run the
+        finished tasks are skipped and the running ones are re-adopted.
+        The run lock must be held
+        """
+        pipeline = run.pipeline
 
-            archivePath = self._getArchivePath(pipelineReq.branch,
-                                               pipelineDef.name, runNum)
-            outputPath = self._getOutputPath(pipelineReq.branch,
-                                             pipelineDef.name, runNum)
+        # the pool gets rebuilt under this lock when the configs reload
+        with self.taskQueueCV:
+            for task in pipeline.tasks():
+                run.nodeClasses[task] = self._getNodeClasses(task)
+        run.ranks = self.durations.getRanks(pipeline)
+        run.archiveSources = {
+            x
+            for task in pipeline.tasks() for x in task.meta.archiveSources
+        }
 
-            os.makedirs(archivePath)
-            os.makedirs(outputPath)
+        taskStates: dict[str, TaskState] = {}
+        remoteArtifacts: dict[str, RemoteArtifact] = {}
+        if resumeRun is not None:
+            taskStates = {
+                x.name: x
+                for x in self._db.getTaskStates(pipeline.id, pipeline.runNum)
+            }
+            remoteArtifacts = {
+                x.task: x
+                for x in self._db.getRemoteArtifacts(pipeline.id,
+                                                     pipeline.runNum)
+            }
 
-            pipeline = Pipeline(
-                self.pipelineRepoUrl,
-                pipelineDef,
-                pipelineReq,
-                archivePath,
-                outputPath,
-            )
+        def onComplete(task: Task):
+            self._submit(self._onTaskComplete, run, task)
 
-            start = time.time()
+        for task in pipeline.tasks():
+            task.onComplete = onComplete
+            try:
+                state = taskStates[task.meta.name]
+            except KeyError:
+                run.pending.append(task)
+                continue
+
+            task.id = state.taskId
+            # later tasks' cache keys are made from it
+            task.cacheKey = state.cacheKey
+            if task.meta.name in remoteArtifacts:
+                artifact = remoteArtifacts[task.meta.name]
+                task.remoteNode = artifact.node
+                task.remoteFiles = artifact.files
+                run.remoteFiles.update(artifact.files)
+            match state.status:
+                case PipelineStatus.Success | PipelineStatus.Fail | PipelineStatus.Error:
+                    # already done, and its files are already unpacked
+                    task.status = state.status
+                    run.statuses[task.meta.name]["status"] = state.status
+                    if state.status != PipelineStatus.Success:
+                        pipeline.status = state.status
+                    continue
+                case PipelineStatus.Running:
+                    node = self.nodePool.getNode(str(state.node))
+                    if node is None or state.slot is None or state.slot >= len(
+                            node.slots):
+                        run.pending.append(task)
+                        continue
+                    print(f"Re-adopting {task.meta.name} on {node.name}")
+                    task.transfer = self._getTransfer(run, task)
+                    run.numRunning += 1
+                    with self.taskQueueCV:
+                        self._tasksWaiting += 1
+                        self._queuedTasks[task.id] = QueueTask(
+                            pipeline, task, run.nodeClasses[task],
+                            run.ranks[task])
+                    node.adoptTask(state.slot, task)
+                    self._notifyNodeMonitor()
+                case _:
+                    run.pending.append(task)
+
+    def _advanceRun(self, run: _PipelineRun):
+        """
+        Queue every task whose needs have succeeded, and finish the run
+        once nothing is left running. The run lock must be held
+        """
+        pipeline = run.pipeline
+        # cached tasks complete right away, which can make more ready
+        progress = True
+        # don't start anything new once something has failed
+        while progress and pipeline.status == PipelineStatus.Running:
+            progress = False
+            stillPending: list[Task] = []
+            for task in run.pending:
+                if not all(x.status == PipelineStatus.Success
+                           for x in task.needs):
+                    stillPending.append(task)
+                    continue
+
+                if self._useCachedResult(run, task):
+                    progress = True
+                    continue
+
+                task.transfer = self._getTransfer(run, task)
+                task.artifacts = self._getArtifactSources(run, task)
+
+                run.numRunning += 1
+                with self.taskQueueCV:
+                    self._tasksWaiting += 1
+                self._pushTask(
+                    QueueTask(pipeline, task, run.nodeClasses[task],
+                              run.ranks[task]))
+            run.pending = stillPending
+
+        if run.numRunning == 0:
+            self._finishRun(run)
+
+    def _getTransfer(self, run: _PipelineRun, task: Task) -> str:
+        """
+        How the node sends the task's files, see TaskRequest.transfer
+        """
+        # the cache stores the zips, and streamed archives are merged into
+        # the run's so they can't be told apart by task
+        if task.cacheKey is not None or (self.transferMode == "stream" and
+                                         task.meta.name in run.archiveSources):
+            return "zip"
+        return self.transferMode
+
+    def _getArtifactSources(self, run: _PipelineRun,
+                            task: Task) -> list[ArtifactSource]:
+        """
+        Where the task's get-archive steps can get their files, the node
+        that ran the earlier task if it still has them, otherwise the
+        controller. Only lazily transferred tasks leave their files on the
+        node. The run lock must be held
+        """
+        pipeline = run.pipeline
+        tasksByName = {x.meta.name: x for x in run.nodeClasses}
+        out: list[ArtifactSource] = []
+        for name in task.meta.archiveSources:
+            source = tasksByName[name]
+            archiveUrl = ""
+            manifestUrl = ""
+            if len(self.controllerUrl) > 0:
+                query = urlencode({
+                    "pipeline": pipeline.meta.file,
+                    "branch": pipeline.branch,
+                    "run": pipeline.runNum,
+                    "task": name,
+                })
+                archiveUrl = f"{self.controllerUrl}/api/archive?{query}"
+                manifestUrl = f"{self.controllerUrl}/api/archive_manifest?{query}"
+            peerUrl = ""
+            if len(source.remoteNode) > 0:
+                node = self.nodePool.getNode(source.remoteNode)
+                if node is not None and node.status != NodeStatus.Offline:
+                    peerUrl = node.getUrl()
+            out.append(
+                ArtifactSource(task=name,
+                               task_id=source.id,
+                               peer_url=peerUrl,
+                               archive_url=archiveUrl,
+                               manifest_url=manifestUrl))
+        return out
 
-            oldRuns = self._db.addRun(pipelineID, runNum, pipelineReq.branch,
-                                      commit, start, pipeline.meta.maxRuns)
-
-            for x in oldRuns:
-                oldArch = self._getArchivePath(pipelineReq.branch,
-                                               pipeline.meta.name, x)
-                oldOut = self._getOutputPath(pipelineReq.branch,
-                                             pipeline.meta.name, x)
-                if os.path.exists(oldArch):
-                    print("Removing archive for", x)
-                    shutil.rmtree(oldArch)
-                    shutil.rmtree(oldOut)
-
-            print(pipeline.stages)
-
-            stageStatuses = [{
-                "display":
-                stage.meta.display,
-                "stages": [{
-                    "display":
-                    task.meta.display,
-                    "output":
-                    os.path.relpath(task.outputFile, outputPath),
-                    "status":
-                    task.status
-                } for task in stage.tasks]
-            } for stage in pipeline.stages]
+    def _useCachedResult(self, run: _PipelineRun, task: Task) -> bool:
+        """
+        Complete the task from the cache if it has already been run with
+        the same inputs. The run lock must be held
+        """
+        pipeline = run.pipeline
+        try:
+            tasksByName = {x.meta.name: x for x in pipeline.tasks()}
+            task.cacheKey = self.taskCache.getKey(
+                task, run.repo, pipeline.args,
+                [tasksByName[x] for x in task.meta.archiveSources])
+            if task.cacheKey is None or not self.taskCache.restore(
+                    task.cacheKey, task):
+                return False
+            archiveContainers.addContainer(pipeline.archive, task.meta.name,
+                                           task.archiveZipFile)
+            decompressOutputFile(task.outputZipFile, pipeline.outputDir)
+            os.remove(task.outputZipFile)
+        except Exception as err:
+            print(f"Unable to use cached result for {task.meta.name}:", err)
+            return False
+        self._indexOutput(pipeline, task)
+
+        print(f"Using cached result for {task.meta.name}")
+        task.status = PipelineStatus.Success
+        run.statuses[task.meta.name]["status"] = task.status
+        run.statuses[task.meta.name]["cached"] = True
+        self._db.setTaskState(pipeline.id, pipeline.runNum, task.meta.name,
+                              task.id, None, None, task.status, task.cacheKey)
+        return True
+
+    def _indexOutput(self, pipeline: Pipeline, task: Task):
+        """
+        Index the task's output so parts of it can be read on their own
+        """
+        if not os.path.isfile(task.outputFile):
+            return
+        try:
+            logStore.indexLog(pipeline.outputDir,
+                              os.path.relpath(task.outputFile,
+                                              pipeline.outputDir),
+                              self.compressLogs)
+        except Exception as err:
+            print(f"Unable to index the output of {task.meta.name}:", err)
+
+    def _onTaskComplete(self, run: _PipelineRun, task: Task):
+        pipeline = run.pipeline
+        with run.lock:
+            run.numRunning -= 1
+            with self.taskQueueCV:
+                self._tasksWaiting -= 1
+                self._queuedTasks.pop(task.id, None)
 
             try:
-                for sIdx, stage in enumerate(pipeline.stages):
-                    statuses = stageStatuses[sIdx]['stages']
-                    self.runStage(pipeline, stage, statuses)
-                    if pipeline.status != PipelineStatus.Running:
-                        print("Pipeline error")
-                        break
+                if task.cacheKey is not None and task.status == PipelineStatus.Success:
+                    self.taskCache.store(task.cacheKey, task)
+                # these won't exist if the download failed
+                if os.path.exists(task.archiveZipFile):
+                    # kept as is, files are served out of the zip
+                    archiveContainers.addContainer(pipeline.archive,
+                                                   task.meta.name,
+                                                   task.archiveZipFile)
+                if os.path.exists(task.outputZipFile):
+                    decompressOutputFile(task.outputZipFile,
+                                         pipeline.outputDir)
+                if len(task.remoteNode) > 0:
+                    self._db.addRemoteArtifact(
+                        RemoteArtifact(pipeline.id, pipeline.runNum,
+                                       task.meta.name, task.id,
+                                       task.remoteNode, pipeline.archive,
+                                       task.remoteFiles))
+                    run.remoteFiles.update(task.remoteFiles)
             except Exception as err:
-                print("Exception occurred while running pipeline")
+                print("Exception occurred while unpacking task files")
                 traceback.print_exception(err, chain=True)
-                pipeline.status = PipelineStatus.Fail
-
-            if pipeline.status == PipelineStatus.Running:
-                pipeline.status = PipelineStatus.Success
-
-            end = time.time()
+                task.status = PipelineStatus.Error
+            finally:
+                for x in (task.archiveZipFile, task.outputZipFile):
+                    if os.path.exists(x):
+                        os.remove(x)
+            self._indexOutput(pipeline, task)
+
+            if task.status != PipelineStatus.Success:
+                print(f"Task failed: {task.meta.name}")
+                pipeline.status = task.status
+
+            # only successful runs say how long the task takes
+            if task.status == PipelineStatus.Success and task.startTime > 0:
+                self.durations.record(task, time.time() - task.startTime)
+
+            run.statuses[task.meta.name]["status"] = task.status
+            self._db.setTaskState(pipeline.id, pipeline.runNum,
+                                  task.meta.name, task.id, None, None,
+                                  task.status, task.cacheKey)
+
+            print(f"Task complete: {task.meta.name}")
+            self._advanceRun(run)
+
+    def _finishRun(self, run: _PipelineRun):
+        """
+        Settle the run's status and hand it off to be recorded, the run
+        lock must be held
+        """
+        if run.finished:
+            return
+        run.finished = True
+        if run.pipeline.status == PipelineStatus.Running:
+            run.pipeline.status = PipelineStatus.Success
+        self._submitIO(self._recordRun, run, time.time())
+
+    def _recordRun(self, run: _PipelineRun, end: float):
+        """
+        Dedupe and index the finished run's files, record its final state
+        and free its admission spot
+        """
+        pipeline = run.pipeline
 
-            numArchived = 0
-            for x in glob.iglob("**/*", root_dir=archivePath, recursive=True):
-                if not os.path.isdir(os.path.join(archivePath, x)):
-                    numArchived += 1
+        try:
 
-            metadata = {"stages": stageStatuses, "numArchived": numArchived}
+            hashes: dict[str, str] = {}
+            storedBytes = 0
+            try:
+                hashes, storedBytes = self.blobStore.dedupe(pipeline.archive)
+            except Exception as err:
+                print("Unable to dedupe archive")
+                traceback.print_exception(err, chain=True)
 
-            self._db.setRunStatus(pipelineID, runNum, end - start,
-                                  pipeline.status, json.dumps(metadata))
+            archiveIndex = ArchiveIndex.build(pipeline.archive, hashes,
+                                              run.remoteFiles)
+            archiveIndex.write(pipeline.archive)
+            outputIndex = ArchiveIndex.build(
+                pipeline.outputDir,
+                remoteFiles=logStore.listCompressedLogs(pipeline.outputDir))
+            outputIndex.write(pipeline.outputDir)
+
+            numArchived = len(archiveIndex)
+            self._db.setRunSize(
+                pipeline.id, pipeline.runNum,
+                self._measureRun(pipeline.archive, pipeline.outputDir) +
+                storedBytes)
+
+            metadata = {"stages": run.stageStatuses, "numArchived": numArchived}
+
+            self._db.setRunStatus(pipeline.id, pipeline.runNum,
+                                  end - run.startTime, pipeline.status,
+                                  json.dumps(metadata))
+            self._db.removeActiveRun(pipeline.id, pipeline.runNum)
+            with self._activeRunsLock:
+                self._activeRuns.pop((pipeline.id, pipeline.runNum), None)
+            # the run's size may put its pipeline over its quota
+            self._requestGC()
 
             print(f"Pipeline complete: {pipeline.meta.display}")
+        finally:
+            try:
+                self._removeRunKeys(run.runKeys)
+                with self._branchLocks[run.repo.path]:
+                    git_cmds.removeWorktree(run.repo, run.worktreePath)
+            finally:
+                self._releaseRun()
 
-    def runStage(self, pipeline: Pipeline, stage: Stage, statuses: list[dict]):
-        for task in stage.tasks:
-            availableNodes: list[NodeConnection] = []
-            for x in self.nodes:
-                # make sure all of the whitelisted tags are present
-                if len(task.meta.whiteTags - x.tags) > 0:
+    def replicatorThread(self):
+        """
+        Pulls in the lazily transferred archives of finished runs, one at
+        a time, so the nodes can free them
+        """
+        while True:
+            with self._replicatorCV:
+                self._replicatorCV.wait(REPLICATE_PERIOD)
+            if not self.shouldRun:
+                break
+
+            for artifact in self._db.getInactiveRemoteArtifacts():
+                if not self.shouldRun:
+                    break
+                node = self.nodePool.getNode(artifact.node)
+                if node is None:
+                    print(f"Node {artifact.node} was removed, dropping the "
+                          f"archive of {artifact.task}")
+                    self._db.removeRemoteArtifact(artifact.pipelineId,
+                                                  artifact.runNum,
+                                                  artifact.task)
                     continue
-                # make sure none of the blacklisted are there
-                if len(task.meta.blackTags & x.tags) > 0:
+                if node.status == NodeStatus.Offline:
                     continue
-                availableNodes.append(x)
+                with self._archiveLock:
+                    self._replicate(node, artifact)
+
+    def _replicate(self, node: NodeConnection, artifact: RemoteArtifact):
+        # the run may have been removed since it was listed
+        if not any(x.task == artifact.task for x in self._db.getRemoteArtifacts(
+                artifact.pipelineId, artifact.runNum)):
+            return
+        paths = self._getArchivePaths(artifact.archivePath)
+        sizeBefore = self._measure(paths)
+        try:
+            node.fetchRetainedArchive(artifact.taskId, artifact.archivePath)
+            hashes, storedBytes = self.blobStore.dedupe(artifact.archivePath)
+            node.releaseRetained(artifact.taskId)
+        except Exception as err:
+            print(f"Unable to replicate archive of {artifact.task}:", err)
+            return
+        self._db.removeRemoteArtifact(artifact.pipelineId, artifact.runNum,
+                                      artifact.task)
+
+        remoteFiles = self._getRemoteFiles(artifact.pipelineId,
+                                           artifact.runNum)
+        ArchiveIndex.build(artifact.archivePath, hashes,
+                           remoteFiles).write(artifact.archivePath)
+        self._db.addRunSize(
+            artifact.pipelineId, artifact.runNum,
+            self._measure(paths) - sizeBefore + storedBytes)
+
+    def _requestGC(self):
+        with self._gcCV:
+            self._gcRequested = True
+            self._gcCV.notify()
+
+    def gcThread(self):
+        """
+        Removes the runs that are past their pipeline's retention policy
+        or the global limits, a batch at a time, then trims the task cache
+        """
+        while self.shouldRun:
+            with self._gcCV:
+                if not self._gcRequested:
+                    self._gcCV.wait(GC_PERIOD)
+                self._gcRequested = False
+            if not self.shouldRun:
+                break
 
-            if len(availableNodes) == 0:
-                raise RuntimeError("No available nodes")
+            try:
+                runs = self._db.getStoredRuns()
+                for run in runs:
+                    if run.size is None and not run.active:
+                        run.size = self._measureRun(*self._getRunPaths(run))
+                        self._db.setRunSize(run.pipelineId, run.runNum,
+                                            run.size)
+                expired = selectExpiredRuns(runs, self.retentionLimits)
+            except Exception as err:
+                print("Unable to look for old runs")
+                traceback.print_exception(err, chain=True)
+                continue
 
-            with self.taskQueueCV:
-                self._tasksWaiting += 1
-                self.taskQueue.push(
-                    QueueTask(pipeline, task, set(availableNodes)))
-                self.taskQueueCV.notify()
-
-        # wait for every task to complete
-        for tIdx, task in enumerate(stage.tasks):
-            status = task.waitForComplete()
-            self._tasksWaiting -= 1
-
-            decompressArchive(task.archiveZipFile, pipeline.archive)
-            os.remove(task.archiveZipFile)
-            decompressOutputFile(task.outputZipFile, pipeline.outputDir)
-            os.remove(task.outputZipFile)
+            for idx, run in enumerate(expired):
+                if not self.shouldRun:
+                    break
+                if idx > 0 and idx % GC_BATCH_SIZE == 0:
+                    time.sleep(GC_BATCH_DELAY)
+                try:
+                    with self._archiveLock:
+                        self._removeRun(run)
+                except Exception as err:
+                    print(f"Unable to remove run {run.runNum} of "
+                          f"{run.pipelinePath}")
+                    traceback.print_exception(err, chain=True)
 
-            if status != PipelineStatus.Success:
-                pipeline.status = status
+            try:
+                self.taskCache.trim()
+            except Exception as err:
+                print("Unable to trim the task cache")
+                traceback.print_exception(err, chain=True)
 
-            statuses[tIdx]["status"] = status
+    def _getRunPaths(self, run: StoredRun) -> tuple[str, str]:
+        pipelineName = formatPipelineName(run.pipelinePath)
+        return (self._getArchivePath(run.branch, pipelineName, run.runNum),
+                self._getOutputPath(run.branch, pipelineName, run.runNum))
+
+    @staticmethod
+    def _getArchivePaths(archivePath: str) -> list[str]:
+        return [
+            archivePath,
+            archiveContainers.getContainerDir(archivePath),
+            ArchiveIndex.getPath(archivePath),
+            BlobStore.getManifestPath(archivePath),
+        ]
+
+    def _measureRun(self, archivePath: str, outputPath: str) -> int:
+        """
+        Bytes the run's files take up on disk, without its deduped files
+        """
+        return self._measure(
+            self._getArchivePaths(archivePath) + [
+                outputPath,
+                logStore.getLogDir(outputPath),
+                ArchiveIndex.getPath(outputPath),
+            ])
+
+    @staticmethod
+    def _measure(paths: list[str]) -> int:
+        """
+        Bytes of the files and directories, files with other links are
+        left out. Those are blobs, which count toward the run that stored
+        them, or results shared with the task cache, which has its own
+        limits
+        """
+        out = 0
+        for path in paths:
+            if os.path.isfile(path):
+                files = [path]
+            else:
+                files = [
+                    os.path.join(root, x)
+                    for root, _, names in os.walk(path) for x in names
+                ]
+            for file in files:
+                stat = os.lstat(file)
+                if stat.st_nlink == 1:
+                    out += stat.st_size
+        return out
 
-        print(f"Stage complete: {stage.meta.display}")
+    def _removeRun(self, run: StoredRun):
+        archivePath, outputPath = self._getRunPaths(run)
+        print(f"Removing run {run.runNum} of {run.pipelinePath}")
+        self._releaseRemoteArtifacts(run.pipelineId, run.runNum)
+        self.blobStore.removeTree(archivePath)
+        archiveContainers.removeContainers(archivePath)
+        shutil.rmtree(outputPath, ignore_errors=True)
+        logStore.removeLogs(outputPath)
+        ArchiveIndex.remove(archivePath)
+        ArchiveIndex.remove(outputPath)
+        self._db.removeRun(run.pipelineId, run.runNum)
+
+    def _releaseRemoteArtifacts(self, pipelineID: int, runNum: int):
+        """
+        Drop the archives of a run that are still on the nodes
+        """
+        for artifact in self._db.getRemoteArtifacts(pipelineID, runNum):
+            node = self.nodePool.getNode(artifact.node)
+            try:
+                if node is not None:
+                    node.releaseRetained(artifact.taskId)
+            except Exception as err:
+                # the node's retention period cleans it up eventually
+                print(f"Unable to release archive of {artifact.task}:", err)
+            self._db.removeRemoteArtifact(pipelineID, runNum, artifact.task)
+
+    def _getRemoteFiles(self, pipelineID: int, runNum: int) -> dict[str, int]:
+        out: dict[str, int] = {}
+        for artifact in self._db.getRemoteArtifacts(pipelineID, runNum):
+            out.update(artifact.files)
+        return out
 
-    def _updateNodeStatusThread(self, updateConfigs: bool):
-        for node in self.nodes:
-            node.updateStatus(updateConfigs)
+    def _fetchRemoteFile(self,
+                         pipeline: str,
+                         run: int,
+                         file: str,
+                         fullpath: str,
+                         task: str | None = None) -> bool:
+        """
+        Download an archived file that was left on its node, returns
+        False if the run has no such file. Only the task's files are
+        looked at if one is given
+        """
+        pId = self._db.getPipelineId(pipeline)
+        file = os.path.normpath(file)
+        for artifact in self._db.getRemoteArtifacts(pId, run):
+            if file not in artifact.files or task not in (None,
+                                                          artifact.task):
+                continue
+            node = self.nodePool.getNode(artifact.node)
+            if node is None or node.status == NodeStatus.Offline:
+                raise RuntimeError(
+                    f"'{file}' is on node {artifact.node}, which is unavailable"
+                )
+            node.fetchRetainedFile(artifact.taskId, file, fullpath)
+            return True
+        return False
 
     def updateNodeStatus(self, updateConfigs: bool = False):
-        curTime = time.time()
-        if curTime - self._lastNodeCheck > NODE_UPDATE_PERIOD:
-            self._lastNodeCheck = curTime
-            threading.Thread(target=self._updateNodeStatusThread,
-                             args=(updateConfigs, )).start()
+        """
+        Ask the node monitor for a status sweep, the sweeps are already
+        rate limited by the monitor
+        """
+        with self._nodeMonitorCV:
+            self._sweepRequested = True
+            if updateConfigs:
+                self._updateConfigsRequested = True
+            self._nodeMonitorCV.notify()
+
+    def handleNodeEvent(self, name: str, event: NodeEvent):
+        node = self.nodePool.getNode(name)
+        if node is None:
+            raise RuntimeError(f"Unknown node: {name}")
+        node.handleEvent(event)
 
     def getNodeStatus(self) -> dict[str, str]:
         self.updateNodeStatus()
-        return {x.name: x.status.name for x in self.nodes}
+        return {x.name: x.status.name for x in self.nodePool.nodes}
 
     def _getBranchPath(self, branch: str) -> str:
         return os.path.join(self.pipelineRepoPath, branch)
@@ -374,6 +1437,10 @@ class ControllerState:
     def _getRepoPath(self, branch: str) -> str:
         return os.path.join(self._getBranchPath(branch), "repo")
 
+    def _getWorktreePath(self, branch: str, name: str, runNum: int) -> str:
+        return os.path.join(self._getBranchPath(branch), "worktrees",
+                            f'{name}.{runNum}')
+
     def _getArchivePath(self, branch: str, name: str, runNum: int) -> str:
         return os.path.join(self._getBranchPath(branch), "archive",
                             f'{name}.{runNum}')
@@ -384,15 +1451,24 @@ class ControllerState:
 
     def _cloneOrPullRepo(self, branch: str) -> Repo:
         """
-        Returns the path to repo
+        Returns the path to repo, the branch lock must be held
         """
         path = self._getRepoPath(branch)
         repo = Repo(self.pipelineRepoUrl, branch, path)
         git_cmds.cloneOrPull(repo)
+        if branch not in self._cleanedBranches:
+            # nothing can be running yet, clean up after any runs
+            # that were interrupted before removing their worktree
+            shutil.rmtree(os.path.join(self._getBranchPath(branch),
+                                       "worktrees"),
+                          ignore_errors=True)
+            git_cmds.pruneWorktrees(repo)
+            self._cleanedBranches.add(branch)
         return repo
 
     def _updatePipelineCache(self, branch: str) -> _PipelineCache:
-        repo = self._cloneOrPullRepo(branch)
+        with self._branchLocks[self._getRepoPath(branch)]:
+            repo = self._cloneOrPullRepo(branch)
 
         pipelineFiles: list[str] = []
 
@@ -464,6 +1540,8 @@ class ControllerState:
     def getRuns(self, pipelinePath: str) -> list[dict[str, Any]]:
         pId = self._db.getPipelineId(pipelinePath)
         runs = self._db.getRuns(pId)
+        pinned = self._db.getPinnedRuns(pId)
+        merged = self._db.getMergedCounts(pId)
 
         out = []
 
@@ -478,7 +1556,9 @@ class ControllerState:
                 "branch": run.branch,
                 "timestamp": time.strftime("%x %X", timestamp),
                 "duration": round(duration, 3),
-                "status": run.status
+                "status": run.status,
+                "pinned": run.runNum in pinned,
+                "merged": merged.get(run.runNum, 0),
             }
 
             out.append(data)
@@ -488,43 +1568,232 @@ class ControllerState:
     def getBranches(self) -> list[str]:
         return git_cmds.getBranches(self.pipelineRepoUrl)
 
-    def getArchiveList(self, pipeline: str, branch: str, run: int) -> dict:
+    def _getIndex(self, pipeline: str, run: int, root: str,
+                  includeRemote: bool) -> ArchiveIndex:
+        """
+        Returns the index written when the run finished. Running runs are
+        scanned on each request, finished runs from before indexes existed
+        get one written the first time they are listed
+        """
+        index = ArchiveIndex.load(root)
+        if index is not None:
+            return index
+
+        pId = self._db.getPipelineId(pipeline)
+        remoteFiles: dict[str, int] = {}
+        if includeRemote:
+            # include the files that are still on the nodes
+            remoteFiles = self._getRemoteFiles(pId, run)
+        else:
+            # outputs that are only kept compressed
+            remoteFiles = logStore.listCompressedLogs(root)
+
+        isActive = any(x.pipelineId == pId and x.runNum == run
+                       for x in self._db.getActiveRuns())
+        index = ArchiveIndex.build(root,
+                                   remoteFiles=remoteFiles,
+                                   hashMissing=not isActive)
+        if not isActive and os.path.isdir(root):
+            index.write(root)
+        return index
+
+    def getArchiveList(self,
+                       pipeline: str,
+                       branch: str,
+                       run: int,
+                       path: str = "",
+                       offset: int = 0,
+                       limit: int = DEFAULT_PAGE_SIZE,
+                       pattern: str | None = None) -> dict:
         pipelineName = formatPipelineName(pipeline)
         archivePath = self._getArchivePath(branch, pipelineName, run)
 
-        x = ArchiveLister(pipeline, branch, run, archivePath, "archive")
+        index = self._getIndex(pipeline, run, archivePath, True)
+        x = ArchiveLister(pipeline, branch, run, "archive")
 
-        return x.getArchiveList()
+        return x.getArchiveList(index, path, offset, limit, pattern)
 
-    def getArchiveFile(self, pipeline: str, branch: str, run: int,
-                       file: str) -> str:
+    def getArchiveFile(self,
+                       pipeline: str,
+                       branch: str,
+                       run: int,
+                       file: str,
+                       task: str | None = None) -> ArchiveFile:
+        """
+        A file in the run's archive, the one archived by the task if one
+        is given even when a later task archived the same path
+        """
         pipelineName = formatPipelineName(pipeline)
         archivePath = self._getArchivePath(branch, pipelineName, run)
         fullpath = sanitizeFilepath(archivePath, file)
 
-        if not os.path.isfile(fullpath):
+        member = None
+        if task is not None or not os.path.isfile(fullpath):
+            member = archiveContainers.findMember(archivePath, file, task)
+        if member is not None:
+            return member
+        if not os.path.isfile(fullpath) and not self._fetchRemoteFile(
+                pipeline, run, file, fullpath, task):
             raise RuntimeError(f"Path not found: '{file}'")
 
-        return fullpath
+        stat = os.stat(fullpath)
+        return ArchiveFile(fullpath, stat.st_size,
+                           f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+    def getArchiveManifest(self,
+                           pipeline: str,
+                           branch: str,
+                           run: int,
+                           path: str,
+                           task: str | None = None) -> list[dict]:
+        """
+        Every file under the path in the run's archive, with their sizes
+        and hashes, for get-archive steps. Only the files the task
+        archived if one is given
+        """
+        pipelineName = formatPipelineName(pipeline)
+        archivePath = self._getArchivePath(branch, pipelineName, run)
+        if task is None:
+            files = self._getIndex(pipeline, run, archivePath, True).files
+        else:
+            files = [(x, size, "") for x, size in sorted(
+                self._getTaskFiles(pipeline, run, archivePath,
+                                   task).items())]
+
+        path = os.path.normpath(path).strip(os.sep)
+        if path == ".":
+            path = ""
+        out = []
+        for file, size, digest in files:
+            if len(path) > 0 and file != path and not file.startswith(
+                    path + os.sep):
+                continue
+            if len(digest) == 0:
+                digest = self.getArchiveFile(pipeline, branch, run, file,
+                                             task).getHash()
+            out.append({"path": file, "size": size, "sha256": digest})
+        return out
 
-    def getOutputList(self, pipeline: str, branch: str, run: int) -> dict:
+    def _getTaskFiles(self, pipeline: str, run: int, archivePath: str,
+                      task: str) -> dict[str, int]:
+        """
+        The files the task archived with their sizes, from its zip or
+        the node still holding them
+        """
+        files = archiveContainers.listMembers(archivePath, task)
+        if len(files) > 0:
+            return files
+        pId = self._db.getPipelineId(pipeline)
+        for artifact in self._db.getRemoteArtifacts(pId, run):
+            if artifact.task == task:
+                return artifact.files
+        return {}
+
+    def getOutputList(self,
+                      pipeline: str,
+                      branch: str,
+                      run: int,
+                      path: str = "",
+                      offset: int = 0,
+                      limit: int = DEFAULT_PAGE_SIZE,
+                      pattern: str | None = None) -> dict:
         pipelineName = formatPipelineName(pipeline)
         outputPath = self._getOutputPath(branch, pipelineName, run)
 
-        x = ArchiveLister(pipeline, branch, run, outputPath, "output")
+        index = self._getIndex(pipeline, run, outputPath, False)
+        x = ArchiveLister(pipeline, branch, run, "output")
 
-        return x.getArchiveList()
+        return x.getArchiveList(index, path, offset, limit, pattern)
 
     def getOutputFile(self, pipeline: str, branch: str, run: int,
-                      file: str) -> str:
+                      file: str) -> ArchiveFile:
         pipelineName = formatPipelineName(pipeline)
         outputPath = self._getOutputPath(branch, pipelineName, run)
         fullpath = sanitizeFilepath(outputPath, file)
 
         if not os.path.isfile(fullpath):
-            raise RuntimeError(f"Path not found: '{file}'")
+            compressed = logStore.findCompressedLog(
+                outputPath, os.path.relpath(fullpath, outputPath))
+            if compressed is None:
+                raise RuntimeError(f"Path not found: '{file}'")
+            return compressed
+
+        stat = os.stat(fullpath)
+        return ArchiveFile(fullpath, stat.st_size,
+                           f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+    def _openOutputLog(self, pipeline: str, branch: str, run: int,
+                       task: str) -> Log:
+        pId = self._db.getPipelineId(pipeline)
+        pipelineName = formatPipelineName(pipeline)
+        outputPath = self._getOutputPath(branch, pipelineName, run)
+        file = os.path.relpath(
+            sanitizeFilepath(outputPath, f"{task}.output"), outputPath)
+
+        # outputs are still being downloaded until the task's state is final
+        with self._activeRunsLock:
+            isActive = (pId, run) in self._activeRuns
+        isWriting = isActive and any(
+            x.name == task and x.status == PipelineStatus.Running
+            for x in self._db.getTaskStates(pId, run))
+
+        log = logStore.openLog(outputPath, file, writeIndex=not isWriting)
+        if log is None:
+            raise RuntimeError(f"Path not found: '{task}.output'")
+        return log
+
+    def getOutputIndex(self, pipeline: str, branch: str, run: int,
+                       task: str) -> dict:
+        with self._openOutputLog(pipeline, branch, run, task) as log:
+            return {
+                "size": log.index.size,
+                "lines": log.index.numLines,
+                "steps": log.index.getSteps(),
+            }
+
+    def _readLines(
+        self, pipeline: str, branch: str, run: int, task: str,
+        getRange: Callable[[Log], tuple[int, int, int, int]]
+    ) -> tuple[dict, Iterator[bytes]]:
+        """
+        Returns the line numbers and the bytes of the range picked by
+        getRange(log) as (first line, last line, start, end). The log is
+        only open while the range is found and while its bytes are read,
+        so a response that is never sent doesn't leave it open
+        """
+        with self._openOutputLog(pipeline, branch, run, task) as log:
+            first, last, start, end = getRange(log)
+            total = log.index.numLines
+
+        def read():
+            # outputs only get appended to or compressed, the offsets
+            # stay valid
+            with self._openOutputLog(pipeline, branch, run, task) as log:
+                yield from log.readRange(start, end)
+
+        return {"start": first, "end": last, "total": total}, read()
 
-        return fullpath
+    def getOutputTail(self, pipeline: str, branch: str, run: int, task: str,
+                      lines: int) -> tuple[dict, Iterator[bytes]]:
+        return self._readLines(
+            pipeline, branch, run, task,
+            lambda log: log.getLineRange(log.index.numLines - lines, lines))
+
+    def getOutputLines(self, pipeline: str, branch: str, run: int, task: str,
+                       start: int,
+                       count: int) -> tuple[dict, Iterator[bytes]]:
+        return self._readLines(pipeline, branch, run, task,
+                               lambda log: log.getLineRange(start, count))
+
+    def getOutputStep(self, pipeline: str, branch: str, run: int, task: str,
+                      step: int) -> tuple[dict, Iterator[bytes]]:
+
+        def getRange(log: Log) -> tuple[int, int, int, int]:
+            first, start, end = log.index.getStepRange(step)
+            last = first + log.index.getSteps()[step]["lines"]
+            return first, last, start, end
+
+        return self._readLines(pipeline, branch, run, task, getRange)
 
     def getRunsStats(self) -> dict[str, Any]:
         status = self._db.getLast50RunsStatus()
@@ -558,7 +1827,129 @@ class ControllerState:
             }
         }
 
+    def pinRun(self, pipeline: str, run: int, pinned: bool):
+        """
+        Pinned runs are never removed by the garbage collector
+        """
+        pId = self._db.getPipelineId(pipeline)
+        self._db.setRunPinned(pId, run, pinned)
+        if not pinned:
+            self._requestGC()
+
     def getRunMeta(self, pipeline: str, run: int) -> str:
         pId = self._db.getPipelineId(pipeline)
-        metaStr = self._db.getRunMeta(pId, run)
-        return metaStr
+        with self._activeRunsLock:
+            activeRun = self._activeRuns.get((pId, run))
+        if activeRun is None:
+            return self._db.getRunMeta(pId, run)
+
+        # running tasks are only recorded in the DB
+        running = {
+            x.name for x in self._db.getTaskStates(pId, run)
+            if x.status == PipelineStatus.Running
+        }
+        waiting = (PipelineStatus.NotRun, PipelineStatus.Queued)
+        with activeRun.lock:
+            names = {id(v): k for k, v in activeRun.statuses.items()}
+            stages = [{
+                "display": stage["display"],
+                "stages": [
+                    dict(x, status=PipelineStatus.Running)
+                    if x["status"] in waiting and names[id(x)] in running else
+                    dict(x) for x in stage["stages"]
+                ]
+            } for stage in activeRun.stageStatuses]
+        return json.dumps({"stages": stages, "numArchived": 0, "active": True})
+
+    def streamTaskOutput(
+            self, pipeline: str, branch: str, run: int, task: str,
+            offset: int) -> AsyncIterator[tuple[int, bytes]] | None:
+        """
+        Yields (offset after the data, data) for the task's output from the
+        byte offset on, following it from the node while the task runs.
+        Empty data is yielded while waiting so callers can notice dropped
+        clients. Only ever holds a chunk at a time. None if there are
+        already MAX_LIVE_FOLLOWERS
+        """
+        # resolved up front so bad requests fail before the response starts
+        pId = self._db.getPipelineId(pipeline)
+        pipelineName = formatPipelineName(pipeline)
+        outputPath = self._getOutputPath(branch, pipelineName, run)
+        file = os.path.relpath(
+            sanitizeFilepath(outputPath, f"{task}.output"), outputPath)
+        with self._activeRunsLock:
+            isActive = (pId, run) in self._activeRuns
+        if not isActive and not logStore.hasLog(outputPath, file):
+            raise RuntimeError(f"Path not found: '{task}.output'")
+        if not self._followers.acquire(blocking=False):
+            return None
+        return self._followTaskOutput(pId, run, task, outputPath, file,
+                                      offset)
+
+    async def _follow(self, func: Callable, *args) -> Any:
+        """
+        Run the blocking part of a follower on the follower threads, the
+        follower only holds one while it waits on the node or the disk
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._followerPool, func, *args)
+
+    def _getFollowedTask(self, pId: int, run: int,
+                         task: str) -> tuple[bool, TaskState | None]:
+        with self._activeRunsLock:
+            isActive = (pId, run) in self._activeRuns
+        state = next((x for x in self._db.getTaskStates(pId, run)
+                      if x.name == task), None)
+        return isActive, state
+
+    async def _followTaskOutput(
+            self, pId: int, run: int, task: str, outputPath: str, file: str,
+            offset: int) -> AsyncIterator[tuple[int, bytes]]:
+        try:
+            while self.shouldRun:
+                isActive, state = await self._follow(self._getFollowedTask,
+                                                     pId, run, task)
+
+                if (state is not None and state.node is not None and
+                        state.status == PipelineStatus.Running):
+                    node = self.nodePool.getNode(state.node)
+                    sent = 0
+                    if node is not None:
+                        chunks = node.streamOutput(state.taskId, offset)
+                        try:
+                            while (data := await self._follow(
+                                    next, chunks, None)) is not None:
+                                offset += len(data)
+                                sent += len(data)
+                                yield offset, data
+                        except (requests.RequestException,
+                                RuntimeError) as err:
+                            print(f"Unable to follow the output of {task}:",
+                                  err)
+                    if sent == 0:
+                        # done but not collected yet, or the node is
+                        # unreachable
+                        yield offset, b""
+                        await asyncio.sleep(LIVE_OUTPUT_POLL)
+                    continue
+
+                # running tasks without a node are being re-adopted
+                if isActive and (state is None or state.status in (
+                        PipelineStatus.NotRun, PipelineStatus.Queued,
+                        PipelineStatus.Running)):
+                    yield offset, b""
+                    await asyncio.sleep(LIVE_OUTPUT_POLL)
+                    continue
+                break
+
+            log = await self._follow(logStore.openLog, outputPath, file)
+            if log is None:
+                return
+            with log:
+                chunks = log.readRange(offset, log.index.size)
+                while (data := await self._follow(next, chunks,
+                                                  None)) is not None:
+                    offset += len(data)
+                    yield offset, data
+        finally:
+            self._followers.release()
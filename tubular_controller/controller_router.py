@@ -1,14 +1,23 @@
-from fastapi import FastAPI, Response, status, routing
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, Request, Response, status, routing
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 import traceback
+import mimetypes
 import os
 
 from tubular_controller.controller import ControllerState, PipelineReq
+from tubular_controller.archiveLister import DEFAULT_PAGE_SIZE
+from tubular_controller.archiveContainers import ArchiveFile
+from tubular_controller.logStore import DEFAULT_TAIL_LINES
+from tubular.file_utils import STREAM_CHUNK_SIZE
+from tubular.task import NodeEvent
 
 CTRL_STATE = ControllerState()
 
+# seconds live output clients turned away are told to wait
+LIVE_OUTPUT_RETRY = 5
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -35,9 +44,14 @@ async def getPipelines(branch: str | None = None):
 
 
 @apiRouter.post("/pipelines", status_code=status.HTTP_201_CREATED)
-async def queuePipeline(pipelineReq: PipelineReq):
+def queuePipeline(pipelineReq: PipelineReq):
+    # not async, this may ask the remote for the branch's commit
     try:
-        CTRL_STATE.queuePipeline(pipelineReq)
+        runID = CTRL_STATE.queuePipeline(pipelineReq)
+        # identical requests are merged into the run that's already going
+        if runID is not None:
+            return {"merged": True, "run": runID[1]}
+        return {"merged": False}
     except Exception as err:
         traceback.print_exception(err, chain=True)
         return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
@@ -74,39 +88,266 @@ async def getNodeStatus() -> dict[str, str]:
     return CTRL_STATE.getNodeStatus()
 
 
+@apiRouter.post("/nodes/{name}/events")
+def nodeEvent(name: str, event: NodeEvent):
+    # not async, this waits on the node's lock
+    try:
+        CTRL_STATE.handleNodeEvent(name, event)
+    except Exception as err:
+        traceback.print_exception(err, chain=True)
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                            content={"msg": str(err)})
+
+
 @apiRouter.get("/branches")
 async def getBranches() -> list[str]:
     return CTRL_STATE.getBranches()
 
 
 @apiRouter.get("/archive_list")
-async def getArchiveList(pipeline: str, branch: str, run: int) -> dict:
-    return CTRL_STATE.getArchiveList(pipeline, branch, run)
+def getArchiveList(pipeline: str,
+                   branch: str,
+                   run: int,
+                   path: str = "",
+                   offset: int = 0,
+                   limit: int = DEFAULT_PAGE_SIZE,
+                   filter: str | None = None) -> dict:
+    return CTRL_STATE.getArchiveList(pipeline, branch, run, path, offset,
+                                     limit, filter)
 
 
 @apiRouter.get("/archive")
-async def getArchiveFile(pipeline: str, branch: str, run: int, file: str):
-    path = CTRL_STATE.getArchiveFile(pipeline, branch, run, file)
-    return FileResponse(path)
+def getArchiveFile(request: Request,
+                   pipeline: str,
+                   branch: str,
+                   run: int,
+                   file: str,
+                   task: str | None = None):
+    archiveFile = CTRL_STATE.getArchiveFile(pipeline, branch, run, file,
+                                            task)
+    return _makeRangeResponse(request, archiveFile, file)
+
+
+def _parseRange(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Returns the inclusive byte range of a single range header, None if it
+    can't be satisfied. Multiple ranges aren't supported
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError(f"Unsupported range: {header}")
+    startStr, _, endStr = spec.strip().partition("-")
+    if len(startStr) == 0:
+        # the last n bytes
+        length = int(endStr)
+        if length == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(startStr)
+    end = size - 1 if len(endStr) == 0 else min(int(endStr), size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+def _makeRangeResponse(
+        request: Request,
+        archiveFile: ArchiveFile,
+        name: str,
+        defaultType: str = "application/octet-stream") -> Response:
+    etag = f'"{archiveFile.etag}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+    mediaType = mimetypes.guess_type(name)[0] or defaultType
+
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+
+    start, end = 0, archiveFile.size - 1
+    statusCode = status.HTTP_200_OK
+    rangeHeader = request.headers.get("range")
+    # a range for an older version of the file gets the whole file
+    ifRange = request.headers.get("if-range")
+    if rangeHeader is not None and (ifRange is None or ifRange == etag):
+        try:
+            byteRange = _parseRange(rangeHeader, archiveFile.size)
+        except ValueError:
+            byteRange = (start, end)
+        if byteRange is None:
+            headers["Content-Range"] = f"bytes */{archiveFile.size}"
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers=headers)
+        if byteRange != (start, end):
+            start, end = byteRange
+            statusCode = status.HTTP_206_PARTIAL_CONTENT
+            headers["Content-Range"] = \
+                f"bytes {start}-{end}/{archiveFile.size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+
+    def readRange():
+        with archiveFile.open() as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if len(data) == 0:
+                    break
+                remaining -= len(data)
+                yield data
+
+    return StreamingResponse(readRange(),
+                             status_code=statusCode,
+                             headers=headers,
+                             media_type=mediaType)
+
+
+@apiRouter.get("/archive_manifest")
+def getArchiveManifest(pipeline: str,
+                       branch: str,
+                       run: int,
+                       path: str = "",
+                       task: str | None = None) -> list[dict]:
+    return CTRL_STATE.getArchiveManifest(pipeline, branch, run, path, task)
 
 
 @apiRouter.get("/output_list")
-async def getOutputList(pipeline: str, branch: str, run: int) -> dict:
-    return CTRL_STATE.getOutputList(pipeline, branch, run)
+def getOutputList(pipeline: str,
+                  branch: str,
+                  run: int,
+                  path: str = "",
+                  offset: int = 0,
+                  limit: int = DEFAULT_PAGE_SIZE,
+                  filter: str | None = None) -> dict:
+    return CTRL_STATE.getOutputList(pipeline, branch, run, path, offset,
+                                    limit, filter)
 
 
 @apiRouter.get("/output")
-async def getOutputFile(pipeline: str, branch: str, run: int, file: str):
-    path = CTRL_STATE.getOutputFile(pipeline, branch, run, file)
-    return FileResponse(path)
+def getOutputFile(request: Request, pipeline: str, branch: str, run: int,
+                  file: str):
+    outputFile = CTRL_STATE.getOutputFile(pipeline, branch, run, file)
+    # outputs are shown in the browser
+    return _makeRangeResponse(request, outputFile, file, "text/plain")
+
+
+def _makeLinesResponse(lineRange: dict, chunks) -> StreamingResponse:
+    """
+    Part of a task's output, the headers say which lines it is
+    """
+    headers = {
+        "X-Line-Start": str(lineRange["start"]),
+        "X-Line-End": str(lineRange["end"]),
+        "X-Total-Lines": str(lineRange["total"]),
+    }
+    return StreamingResponse(chunks,
+                             headers=headers,
+                             media_type="text/plain; charset=utf-8")
+
+
+@apiRouter.get("/output_index")
+def getOutputIndex(pipeline: str, branch: str, run: int, task: str) -> dict:
+    return CTRL_STATE.getOutputIndex(pipeline, branch, run, task)
+
+
+@apiRouter.get("/output_tail")
+def getOutputTail(pipeline: str,
+                  branch: str,
+                  run: int,
+                  task: str,
+                  lines: int = DEFAULT_TAIL_LINES):
+    return _makeLinesResponse(
+        *CTRL_STATE.getOutputTail(pipeline, branch, run, task, lines))
+
+
+@apiRouter.get("/output_lines")
+def getOutputLines(pipeline: str, branch: str, run: int, task: str,
+                   start: int, count: int):
+    return _makeLinesResponse(*CTRL_STATE.getOutputLines(
+        pipeline, branch, run, task, start, count))
+
+
+@apiRouter.get("/output_step")
+def getOutputStep(pipeline: str, branch: str, run: int, task: str,
+                  step: int):
+    return _makeLinesResponse(
+        *CTRL_STATE.getOutputStep(pipeline, branch, run, task, step))
+
+
+def _formatEvent(offset: int, data: bytes) -> str:
+    """
+    A server-sent event for the output, its id is the byte offset to
+    resume from
+    """
+    text = data.decode(errors="replace").replace("\r\n", "\n").replace(
+        "\r", "\n")
+    lines = "".join(f"data: {x}\n" for x in text.split("\n"))
+    return f"id: {offset}\n{lines}\n"
+
+
+@apiRouter.get("/output_live")
+def getLiveOutput(request: Request,
+                  pipeline: str,
+                  branch: str,
+                  run: int,
+                  task: str,
+                  offset: int = 0):
+    """
+    The task's output as server-sent events, followed while it runs.
+    Reconnecting clients resume from the Last-Event-ID they got
+    """
+    try:
+        offset = int(request.headers.get("last-event-id", offset))
+    except ValueError:
+        pass
+    chunks = CTRL_STATE.streamTaskOutput(pipeline, branch, run, task,
+                                         max(offset, 0))
+    if chunks is None:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"msg": "Too many live output followers"},
+            headers={"Retry-After": str(LIVE_OUTPUT_RETRY)})
+
+    async def makeEvents():
+        end = offset
+        # bytes of a line that isn't complete yet
+        pending = b""
+        async for end, data in chunks:
+            pending += data
+            if len(data) == 0:
+                cut = len(pending)
+            else:
+                # only whole lines are sent unless they get too long, so
+                # resuming never splits a line
+                cut = pending.rfind(b"\n") + 1
+                if cut == 0 and len(pending) >= STREAM_CHUNK_SIZE:
+                    cut = len(pending)
+            if cut > 0:
+                yield _formatEvent(end - len(pending) + cut, pending[:cut])
+                pending = pending[cut:]
+            elif len(data) == 0:
+                yield ": keepalive\n\n"
+        if len(pending) > 0:
+            yield _formatEvent(end, pending)
+        yield "event: end\ndata: \n\n"
+
+    return StreamingResponse(makeEvents(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
 
 
 @apiRouter.get("/run")
-async def getRunStatuses(pipeline: str, run: int):
+def getRunStatuses(pipeline: str, run: int):
     return Response(content=CTRL_STATE.getRunMeta(pipeline, run),
                     media_type="application/json")
 
 
+@apiRouter.post("/run/pin")
+def pinRun(pipeline: str, run: int, pinned: bool = True):
+    CTRL_STATE.pinRun(pipeline, run, pinned)
+
+
 # mount these last
 app.include_router(apiRouter)
 
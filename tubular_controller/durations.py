@@ -0,0 +1,72 @@
+import threading
+
+from tubular.pipeline import Pipeline
+from tubular.pipeline_db import PipelineDB
+from tubular.task import Task
+
+# weight of the newest run in the estimates
+DURATION_SMOOTHING = 0.3
+# estimate for tasks that have never succeeded
+DEFAULT_DURATION = 60.0
+
+
+class DurationEstimates:
+    """
+    Estimated run time of each task, a moving average of its successful
+    runs. Tasks are identified by their file
+    """
+
+    def __init__(self) -> None:
+        # task file -> (estimate, number of samples)
+        self._estimates: dict[str, tuple[float, int]] = {}
+        self._db: PipelineDB | None = None
+        self._lock = threading.Lock()
+
+    def load(self, db: PipelineDB):
+        self._db = db
+        self._estimates = db.getTaskDurations()
+
+    def get(self, task: Task) -> float:
+        try:
+            return self._estimates[task.meta.file][0]
+        except KeyError:
+            return DEFAULT_DURATION
+
+    def record(self, task: Task, duration: float):
+        with self._lock:
+            try:
+                estimate, samples = self._estimates[task.meta.file]
+                estimate += DURATION_SMOOTHING * (duration - estimate)
+            except KeyError:
+                estimate, samples = duration, 0
+            samples += 1
+            self._estimates[task.meta.file] = (estimate, samples)
+        if self._db is not None:
+            self._db.setTaskDuration(task.meta.file, estimate, duration,
+                                     samples)
+
+    def getRanks(self, pipeline: Pipeline) -> dict[Task, float]:
+        """
+        Returns the estimated time from each task starting until the
+        end of the pipeline, along its longest chain of dependents
+        """
+        dependents: dict[Task, list[Task]] = {x: [] for x in pipeline.tasks()}
+        for task in pipeline.tasks():
+            for need in task.needs:
+                dependents[need].append(task)
+
+        ranks: dict[Task, float] = {}
+
+        def _getRank(task: Task) -> float:
+            try:
+                return ranks[task]
+            except KeyError:
+                pass
+            rank = self.get(task) + max(
+                (_getRank(x) for x in dependents[task]), default=0.0)
+            ranks[task] = rank
+            return rank
+
+        for task in pipeline.tasks():
+            _getRank(task)
+        return ranks
@@ -0,0 +1,479 @@
+import bisect
+import io
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import IO, BinaryIO, Iterator
+
+from tubular.file_utils import STREAM_CHUNK_SIZE
+from tubular_controller.archiveContainers import ArchiveFile
+
+# indexes and compressed copies of a run's task outputs are kept in
+# <output path>.logs, with the same layout as the outputs
+LOGS_SUFFIX = ".logs"
+# the line number is recorded about every this many bytes, finding a
+# line reads at most this much past the nearest recorded one
+CHECKPOINT_BYTES = 256 * 1024
+# compressed logs are split into blocks of this size, each compressed on
+# its own so reading part of the log only decompresses the blocks in it
+LOG_BLOCK_SIZE = 1024 * 1024
+# number of loaded log indexes kept in memory
+MAX_CACHED_LOGS = 16
+# lines returned from the end of a log when the request doesn't say
+DEFAULT_TAIL_LINES = 200
+
+# banners the steps write when they start, "[ Script step-0.sh ] (T+ 1.00s)"
+_BANNER_RE = re.compile(rb"^\[ (.+?) ?\] \(T\+ [^)\n]*\)", re.MULTILINE)
+
+
+class _LogData:
+    """
+    The bytes of a log, read without loading the whole file
+    """
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, mode='rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # empty files can't be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access=mmap.ACCESS_READ) if size > 0 else b""
+
+    def read(self, start: int, end: int) -> bytes:
+        return self._map[start:end]
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+class _BlockData(_LogData):
+    """
+    A log compressed in blocks, the last block read is kept decompressed
+    so reading through it in chunks only decompresses each block once
+    """
+
+    def __init__(self, path: str, blocks: list[int], size: int) -> None:
+        super().__init__(path)
+        # compressed offset of each block, and of the end of the last one
+        self._blocks = blocks
+        self._size = size
+        self._cachedIdx = -1
+        self._cached = b""
+
+    def _getBlock(self, idx: int) -> bytes:
+        if idx != self._cachedIdx:
+            self._cached = zlib.decompress(
+                self._map[self._blocks[idx]:self._blocks[idx + 1]])
+            self._cachedIdx = idx
+        return self._cached
+
+    def read(self, start: int, end: int) -> bytes:
+        end = min(end, self._size)
+        out = []
+        while start < end:
+            idx = start // LOG_BLOCK_SIZE
+            blockStart = idx * LOG_BLOCK_SIZE
+            data = self._getBlock(idx)
+            out.append(data[start - blockStart:end - blockStart])
+            start = blockStart + LOG_BLOCK_SIZE
+        return b"".join(out)
+
+
+class _LogStream(io.RawIOBase):
+    """
+    File object over a log's data, for serving it with Range requests
+    """
+
+    def __init__(self, data: _LogData, size: int) -> None:
+        self._data = data
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        data = self._data.read(self._pos, self._pos + len(buffer))
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._data.close()
+        super().close()
+
+
+class LogIndex:
+    """
+    Where the lines and steps of a task's output are, so parts of it can be
+    read without going through the whole file
+    """
+
+    def __init__(self, data: dict) -> None:
+        self.size: int = data["size"]
+        self.numLines: int = data["lines"]
+        # (byte offset, line number) of line starts through the log
+        self.checkpoints: list[tuple[int, int]] = [
+            tuple(x) for x in data["checkpoints"]
+        ]
+        self._checkpointLines = [x[1] for x in self.checkpoints]
+        # (title, line number, byte offset) of each step's banner
+        self.steps: list[tuple[str, int, int]] = [
+            tuple(x) for x in data["steps"]
+        ]
+        # (line number, byte offset) of the line closing the last step
+        self.end: tuple[int, int] = tuple(data["end"])
+        # compressed offsets of the blocks, None if it isn't compressed
+        self.blocks: list[int] | None = data.get("blocks")
+
+    @staticmethod
+    def build(path: str) -> "LogIndex":
+        """
+        Scan an uncompressed log for its lines and step banners
+        """
+        data = _LogData(path)
+        try:
+            size = len(data._map)
+            checkpoints: list[tuple[int, int]] = []
+            steps: list[tuple[str, int, int]] = []
+            end = None
+            numLines = 0
+            start = 0
+            while start < size:
+                blockEnd = start + CHECKPOINT_BYTES
+                if blockEnd >= size:
+                    blockEnd = size
+                else:
+                    # blocks end on a line unless the line is very long
+                    newline = data._map.find(b"\n", blockEnd,
+                                             blockEnd + CHECKPOINT_BYTES)
+                    if newline >= 0:
+                        blockEnd = newline + 1
+                isLineStart = start == 0 or data._map[start - 1] == ord("\n")
+                if isLineStart:
+                    checkpoints.append((start, numLines))
+
+                block = data.read(start, blockEnd)
+                for m in _BANNER_RE.finditer(block):
+                    if m.start() == 0 and not isLineStart:
+                        continue
+                    title = m.group(1).decode(errors="replace")
+                    line = numLines + block.count(b"\n", 0, m.start())
+                    if title.startswith("Task "):
+                        # Task Complete or Task Failed
+                        end = (line, start + m.start())
+                    elif "Failed" not in title:
+                        steps.append((title, line, start + m.start()))
+                numLines += block.count(b"\n")
+                start = blockEnd
+
+            if size > 0 and data._map[size - 1] != ord("\n"):
+                numLines += 1
+        finally:
+            data.close()
+
+        return LogIndex({
+            "size": size,
+            "lines": numLines,
+            "checkpoints": checkpoints,
+            "steps": steps,
+            "end": end or (numLines, size),
+        })
+
+    def write(self, path: str):
+        temp = f"{path}.{uuid.uuid4().hex}"
+        with open(temp, mode='w') as f:
+            json.dump(
+                {
+                    "size": self.size,
+                    "lines": self.numLines,
+                    "checkpoints": self.checkpoints,
+                    "steps": self.steps,
+                    "end": self.end,
+                    "blocks": self.blocks,
+                }, f)
+        os.replace(temp, path)
+
+    @staticmethod
+    def _read(path: str) -> "LogIndex | None":
+        try:
+            with open(path, mode='r') as f:
+                return LogIndex(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def getSteps(self) -> list[dict]:
+        out = []
+        for idx, (title, line, _) in enumerate(self.steps):
+            end = self.steps[idx + 1][1] if idx + 1 < len(self.steps) \
+                else self.end[0]
+            out.append({"title": title, "line": line, "lines": end - line})
+        return out
+
+    def getStepRange(self, step: int) -> tuple[int, int, int]:
+        """
+        Returns the first line, start and end byte offsets of the step
+        """
+        if step < 0 or step >= len(self.steps):
+            raise RuntimeError(f"Step not found: {step}")
+        _, line, start = self.steps[step]
+        end = self.steps[step + 1][2] if step + 1 < len(self.steps) \
+            else self.end[1]
+        return line, start, end
+
+
+class Log:
+    """
+    An indexed task output, open for reading
+    """
+
+    def __init__(self, index: LogIndex, data: _LogData) -> None:
+        self.index = index
+        self._data = data
+
+    def __enter__(self) -> "Log":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._data.close()
+
+    def findLine(self, line: int) -> int:
+        """
+        Returns the byte offset of the start of the line
+        """
+        line = min(max(line, 0), self.index.numLines)
+        idx = bisect.bisect_right(self.index._checkpointLines, line) - 1
+        offset, curLine = self.index.checkpoints[idx] if idx >= 0 else (0, 0)
+        while curLine < line and offset < self.index.size:
+            chunk = self._data.read(offset, offset + STREAM_CHUNK_SIZE)
+            numLines = chunk.count(b"\n")
+            if curLine + numLines < line:
+                curLine += numLines
+                offset += len(chunk)
+                continue
+            pos = -1
+            for _ in range(line - curLine):
+                pos = chunk.find(b"\n", pos + 1)
+            return offset + pos + 1
+        return min(offset, self.index.size)
+
+    def readRange(self, start: int, end: int) -> Iterator[bytes]:
+        """
+        Yields the bytes between the offsets a chunk at a time
+        """
+        end = min(end, self.index.size)
+        while start < end:
+            data = self._data.read(start, min(start + STREAM_CHUNK_SIZE, end))
+            if len(data) == 0:
+                break
+            start += len(data)
+            yield data
+
+    def getLineRange(self, start: int, count: int) -> tuple[int, int, int, int]:
+        """
+        Returns the first and last line numbers and byte offsets of up to
+        count lines from the start line
+        """
+        start = min(max(start, 0), self.index.numLines)
+        end = min(start + max(count, 0), self.index.numLines)
+        return start, end, self.findLine(start), self.findLine(end)
+
+    def open(self) -> BinaryIO:
+        """
+        A file object over the whole log, it owns the log once opened
+        """
+        return io.BufferedReader(_LogStream(self._data, self.index.size),
+                                 buffer_size=STREAM_CHUNK_SIZE)
+
+
+def getLogDir(outputPath: str) -> str:
+    return f"{outputPath}{LOGS_SUFFIX}"
+
+
+def _getIndexPath(outputPath: str, file: str) -> str:
+    return os.path.join(getLogDir(outputPath), f"{file}.idx")
+
+
+def _getBlocksPath(outputPath: str, file: str) -> str:
+    return os.path.join(getLogDir(outputPath), f"{file}.blocks")
+
+
+def _compress(path: str, dest: str) -> list[int]:
+    """
+    Compress the log in blocks, returns where each one starts
+    """
+    blocks = [0]
+    with open(path, mode='rb') as f, open(dest, mode='wb') as out:
+        while True:
+            data = f.read(LOG_BLOCK_SIZE)
+            if len(data) == 0:
+                break
+            out.write(zlib.compress(data))
+            blocks.append(out.tell())
+    return blocks
+
+
+def indexLog(outputPath: str, file: str, compress: bool = False):
+    """
+    Write the index of a finished task's output, compressing the output
+    into the logs dir when asked to
+    """
+    path = os.path.join(outputPath, file)
+    index = LogIndex.build(path)
+    indexPath = _getIndexPath(outputPath, file)
+    os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+    if compress:
+        blocksPath = _getBlocksPath(outputPath, file)
+        temp = f"{blocksPath}.{uuid.uuid4().hex}"
+        try:
+            index.blocks = _compress(path, temp)
+            os.replace(temp, blocksPath)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    index.write(indexPath)
+    if compress:
+        os.remove(path)
+
+
+def _loadIndex(indexPath: str) -> LogIndex | None:
+    """
+    Recently used indexes are kept in memory until their file changes
+    """
+    try:
+        mtime = os.stat(indexPath).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _cacheLock:
+        try:
+            cachedTime, index = _cache[indexPath]
+            if cachedTime == mtime:
+                _cache.move_to_end(indexPath)
+                return index
+        except KeyError:
+            pass
+
+    index = LogIndex._read(indexPath)
+    if index is None:
+        return None
+
+    with _cacheLock:
+        _cache[indexPath] = (mtime, index)
+        _cache.move_to_end(indexPath)
+        while len(_cache) > MAX_CACHED_LOGS:
+            _cache.popitem(last=False)
+    return index
+
+
+def openLog(outputPath: str, file: str, writeIndex: bool = True) -> Log | None:
+    """
+    Open the task output, None if there isn't one. Outputs from before
+    they were indexed get an index written, unless writeIndex is False
+    because the output is still being written
+    """
+    index = _loadIndex(_getIndexPath(outputPath, file))
+    if index is not None and index.blocks is not None:
+        return Log(
+            index,
+            _BlockData(_getBlocksPath(outputPath, file), index.blocks,
+                       index.size))
+
+    path = os.path.join(outputPath, file)
+    if not os.path.isfile(path):
+        return None
+    if index is None or index.size != os.path.getsize(path):
+        index = None
+        if writeIndex:
+            try:
+                indexLog(outputPath, file)
+                index = _loadIndex(_getIndexPath(outputPath, file))
+            except Exception as err:
+                print(f"Unable to index {path}: {err}")
+        # still readable without writing the index out
+        if index is None:
+            index = LogIndex.build(path)
+    return Log(index, _LogData(path))
+
+
+class CompressedLog(ArchiveFile):
+    """
+    A task output that is only kept compressed, read through its blocks
+    """
+
+    def __init__(self, path: str, index: LogIndex) -> None:
+        if index.blocks is None:
+            raise RuntimeError(f"{path} isn't compressed")
+        stat = os.stat(path)
+        super().__init__(path, index.size,
+                         f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+        self._index = index
+        self._blocks = index.blocks
+
+    def open(self) -> IO[bytes]:
+        return Log(self._index,
+                   _BlockData(self.path, self._blocks,
+                              self._index.size)).open()
+
+
+def findCompressedLog(outputPath: str, file: str) -> CompressedLog | None:
+    index = _loadIndex(_getIndexPath(outputPath, file))
+    if index is None or index.blocks is None:
+        return None
+    return CompressedLog(_getBlocksPath(outputPath, file), index)
+
+
+def hasLog(outputPath: str, file: str) -> bool:
+    return os.path.isfile(os.path.join(outputPath, file)) or \
+        findCompressedLog(outputPath, file) is not None
+
+
+def listCompressedLogs(outputPath: str) -> dict[str, int]:
+    """
+    Returns the outputs that are only kept compressed, with their sizes
+    """
+    out: dict[str, int] = {}
+    logDir = getLogDir(outputPath)
+    for root, _, files in os.walk(logDir):
+        for x in files:
+            if not x.endswith(".idx"):
+                continue
+            index = LogIndex._read(os.path.join(root, x))
+            if index is not None and index.blocks is not None:
+                out[os.path.relpath(os.path.join(root, x[:-4]),
+                                    logDir)] = index.size
+    return out
+
+
+def removeLogs(outputPath: str):
+    shutil.rmtree(getLogDir(outputPath), ignore_errors=True)
+
+
+_cacheLock = threading.Lock()
+# index path -> (index mtime, index)
+_cache: OrderedDict[str, tuple[int, LogIndex]] = OrderedDict()
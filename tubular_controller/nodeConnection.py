@@ -1,86 +1,509 @@
-from tubular.task import Task
+from tubular.task import Task, NodeEvent
 from tubular_node.node import NodeStatus, PipelineStatus
 from tubular.pipeline import Pipeline
-from tubular.file_utils import ensureParents
+from tubular.file_utils import ensureParents, extractArchiveStream, STREAM_CHUNK_SIZE, CHECKSUM_HEADER
 
+import hashlib
+import math
+import os
 import threading
+import time
+import uuid
+from typing import Callable, Iterator
+from urllib.parse import quote
 import requests
+from requests.adapters import HTTPAdapter
+
+# Offline nodes are polled less and less often, up to this many seconds
+OFFLINE_BACKOFF_START = 2.0
+OFFLINE_BACKOFF_MAX = 60.0
+STATUS_TIMEOUT = 2
+
+# interrupted downloads resume where they left off this many times
+DOWNLOAD_ATTEMPTS = 3
+# seconds to wait for the node to send more data
+DOWNLOAD_TIMEOUT = 30
+
+
+def downloadFile(session: requests.Session,
+                 url: str,
+                 dest: str,
+                 json: dict | None = None):
+    """
+    Download a file in large chunks, resuming with a Range request if the
+    connection drops, and verify it against the node's checksum. Nothing
+    is left at dest if it fails
+    """
+    ensureParents(dest)
+    try:
+        _download(session, url, dest, json)
+    except Exception:
+        if os.path.exists(dest):
+            os.remove(dest)
+        raise
+
+
+def _download(session: requests.Session, url: str, dest: str,
+              json: dict | None):
+    with open(dest, mode='wb') as f:
+        digest = hashlib.sha256()
+        checksum: str | None = None
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            headers = {}
+            if f.tell() > 0:
+                headers["Range"] = f"bytes={f.tell()}-"
+            try:
+                with session.get(url=url,
+                                 stream=True,
+                                 json=json,
+                                 headers=headers,
+                                 timeout=DOWNLOAD_TIMEOUT) as r:
+                    if r.status_code == 416:
+                        # we already have all of it
+                        break
+                    r.raise_for_status()
+                    if r.status_code != 206 and f.tell() > 0:
+                        # the node ignored the range, start over
+                        f.seek(0)
+                        f.truncate()
+                        digest = hashlib.sha256()
+                    checksum = r.headers.get(CHECKSUM_HEADER, checksum)
+                    for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as err:
+                if attempt + 1 == DOWNLOAD_ATTEMPTS:
+                    raise
+                print(f"Download interrupted at {f.tell()} bytes, resuming:",
+                      err)
+
+    if checksum is not None and digest.hexdigest() != checksum:
+        raise RuntimeError(f"Checksum mismatch downloading {url}")
+
+
+class NodeSlot:
+    """
+    Controller side view of a single executor slot on a node
+    """
+
+    def __init__(self, idx: int) -> None:
+        self.idx = idx
+        self.status = NodeStatus.Offline
+        self.currentTask: Task | None = None
+        # when the node was known to have currentTask
+        self.sentTime = 0.0
+        # step the current task is on, from the node's events
+        self.taskStep = -1
+        # (repo url, branch, task path) -> hex commit, the task
+        # workspaces the node keeps for this slot
+        self.workspaces: dict[tuple[str, str, str], str] = {}
+        self._downloadThread: threading.Thread | None = None
+
+    def getWarmth(self, task: Task) -> int:
+        """
+        How much of the task's setup the slot can skip, 0 if it has
+        nothing, 1 for a clone of the branch, 2 for the task's workspace
+        and 3 if that is already at the task's commit
+        """
+        try:
+            commit = self.workspaces[(task.repoUrl, task.branch,
+                                      task.meta.file)]
+            return 3 if commit == task.commit.hex() else 2
+        except KeyError:
+            pass
+        for repoUrl, branch, _ in self.workspaces:
+            if repoUrl == task.repoUrl and branch == task.branch:
+                return 1
+        return 0
 
 
 class NodeConnection:
 
-    def __init__(self, name: str, hostname: str, port: int,
-                 tags: list[str]) -> None:
+    def __init__(self,
+                 name: str,
+                 hostname: str,
+                 port: int,
+                 tags: list[str],
+                 numSlots: int = 1,
+                 onIdle: Callable[[], None] | None = None,
+                 onLost: Callable[[Task], None] | None = None) -> None:
         self.name = name
         self.hostname = hostname
         self.port = port
         self.tags: set[str] = set(tags)
-        self.status = NodeStatus.Offline
+        # called whenever a slot becomes available for a new task
+        self.onIdle = onIdle
+        # called when the node no longer knows about a task we sent it
+        self.onLost = onLost
+
+        if numSlots < 1:
+            raise RuntimeError(f"Node {name}: slots must be at least 1")
+
+        self.slots: list[NodeSlot] = [NodeSlot(x) for x in range(numSlots)]
 
         self._url = f"http://{self.hostname}:{self.port}"
+        # keep-alive connections, enough for the heartbeat, the dispatcher
+        # and a download per slot
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=numSlots + 2)
+        self._session.mount("http://", adapter)
+        # url the node posts its events to, empty if the
+        # controller only polls
+        self.callbackUrl = ""
+        # no status requests are sent before this time while offline
+        self._nextCheck = 0.0
+        self._backoff = 0.0
+        # guards the slot states between the dispatcher and status updates
+        self._lock = threading.RLock()
 
-        self.currentTask: Task | None = None
+    @property
+    def status(self) -> NodeStatus:
+        """
+        Overall status of the node, Idle if any slot is free
+        """
+        statuses = set(x.status for x in self.slots)
+        for status in (NodeStatus.Idle, NodeStatus.Active,
+                       NodeStatus.Archiving):
+            if status in statuses:
+                return status
+        return NodeStatus.Offline
 
-        self._downloadThread: threading.Thread | None = None
+    def getIdleSlot(self, task: Task | None = None) -> NodeSlot | None:
+        """
+        Returns a free slot, the warmest one for the task if given
+        """
+        out: NodeSlot | None = None
+        outWarmth = -1
+        for slot in self.slots:
+            if slot.status != NodeStatus.Idle:
+                continue
+            if task is None:
+                return slot
+            warmth = slot.getWarmth(task)
+            if warmth > outWarmth:
+                out = slot
+                outWarmth = warmth
+        return out
+
+    def getWarmth(self, task: Task) -> int:
+        """
+        Warmth of the best idle slot for the task, see NodeSlot.getWarmth
+        """
+        with self._lock:
+            slot = self.getIdleSlot(task)
+            return 0 if slot is None else slot.getWarmth(task)
+
+    def _setSlotStatus(self, slot: NodeSlot, status: NodeStatus) -> bool:
+        """
+        Returns True if the slot just became idle. The caller must
+        call _notifyIdle() after releasing the lock
+        """
+        prevStatus = slot.status
+        slot.status = status
+        return status == NodeStatus.Idle and prevStatus != NodeStatus.Idle
+
+    def _notifyIdle(self):
+        if self.onIdle is not None:
+            self.onIdle()
+
+    def _setOffline(self):
+        self._backoff = min(max(self._backoff * 2, OFFLINE_BACKOFF_START),
+                            OFFLINE_BACKOFF_MAX)
+        self._nextCheck = time.time() + self._backoff
+        with self._lock:
+            for slot in self.slots:
+                # keep track of running tasks, they may still complete
+                # once the node comes back
+                if slot._downloadThread is None:
+                    slot.status = NodeStatus.Offline
 
-    def sendTask(self, pipeline: Pipeline, task: Task):
-        print("sending task to", self.name, task.meta.name)
-        self.currentTask = task
-        args = task.toTaskReq(pipeline.args)
-        requests.post(url=f'{self._url}/queue',
-                      json=args.model_dump(),
-                      timeout=5)
-
-    def _downloadArchive(self, task: Task, finalTaskStatus: PipelineStatus):
-        args = task.toTaskReq({}).model_dump()
-
-        # Download archived files
-        ensureParents(task.archiveZipFile)
-        with requests.get(url=f'{self._url}/archive', stream=True,
-                          json=args) as r:
+    def reserveSlot(self, task: Task) -> NodeSlot | None:
+        """
+        Claim a free slot for the task, None if there are none. The task
+        must then be sent with sendTask()
+        """
+        with self._lock:
+            slot = self.getIdleSlot(task)
+            if slot is None:
+                return None
+            slot.status = NodeStatus.Active
+            slot.currentTask = task
+            slot.taskStep = -1
+            # status from before the node gets the task is stale
+            slot.sentTime = math.inf
+            return slot
+
+    def sendTask(self, pipeline: Pipeline, task: Task, slot: NodeSlot) -> bool:
+        """
+        Sends the task to the slot reserved for it, the lock isn't held
+        while waiting on the node. Returns False and gives up the slot
+        if the node didn't take it
+        """
+        print("sending task to", self.name, slot.idx, task.meta.name)
+        args = task.toTaskReq(pipeline.args, slot.idx)
+        args.callback_url = self.callbackUrl
+        try:
+            r = self._session.post(url=f'{self._url}/queue',
+                                   json=args.model_dump(),
+                                   timeout=5)
             r.raise_for_status()
-            with open(task.archiveZipFile, mode='wb') as f:
-                for chunk in r.iter_content():
-                    f.write(chunk)
+        except requests.HTTPError as err:
+            print(f"Node {self.name} rejected task:", err)
+            with self._lock:
+                if slot.currentTask is task:
+                    # the next status update will sort out the real state
+                    slot.currentTask = None
+                    slot.sentTime = 0.0
+            return False
+        except (requests.Timeout, requests.ConnectionError):
+            with self._lock:
+                if slot.currentTask is task:
+                    slot.currentTask = None
+                    slot.sentTime = 0.0
+                    slot.status = NodeStatus.Offline
+            return False
+        with self._lock:
+            if slot.currentTask is task:
+                slot.sentTime = time.time()
+        return True
 
-        # Download output
-        ensureParents(task.outputZipFile)
-        with requests.get(url=f'{self._url}/output', stream=True,
-                          json=args) as r:
-            with open(task.outputZipFile, mode='wb') as f:
-                for chunk in r.iter_content():
-                    f.write(chunk)
+    def adoptTask(self, slotIdx: int, task: Task):
+        """
+        Resume tracking a task that was sent before a controller restart.
+        If the node doesn't have it anymore, onLost gets called
+        """
+        with self._lock:
+            slot = self.slots[slotIdx]
+            slot.status = NodeStatus.Active
+            slot.currentTask = task
+            slot.taskStep = -1
+            slot.sentTime = 0.0
+
+    def _downloadArchive(self, slot: NodeSlot, task: Task,
+                         finalTaskStatus: PipelineStatus):
+        args = task.toTaskReq({}, slot.idx).model_dump()
+
+        try:
+            if task.transfer == "stream":
+                self._streamArchive(task, args)
+            elif task.transfer == "lazy":
+                self._fetchManifest(task)
+            else:
+                self._downloadZips(task, args)
+        except Exception as err:
+            print(f"Error downloading archive from {self.name}:", err)
+            finalTaskStatus = PipelineStatus.Error
 
         # set status here so we wait till after the download
         task.setStatus(finalTaskStatus)
+        # the node is already idle by the time its files are available
+        with self._lock:
+            becameIdle = self._setSlotStatus(slot, NodeStatus.Idle)
+        if becameIdle:
+            self._notifyIdle()
 
-    def updateStatus(self, updateConfigs: bool):
+    def getUrl(self) -> str:
+        return self._url
+
+    def _downloadZips(self, task: Task, args: dict):
+        downloadFile(self._session, f'{self._url}/archive',
+                     task.archiveZipFile, args)
+        downloadFile(self._session, f'{self._url}/output', task.outputZipFile,
+                     args)
+
+    def _streamArchive(self, task: Task, args: dict):
+        """
+        Unpack the archive straight from the connection into the
+        pipeline's archive, no zips are written on either side
+        """
+        with self._session.get(url=f'{self._url}/archive_stream',
+                               stream=True,
+                               json=args,
+                               timeout=(STATUS_TIMEOUT,
+                                        DOWNLOAD_TIMEOUT)) as r:
+            r.raise_for_status()
+            extractArchiveStream(r.raw, task.archivePath)
+
+        ensureParents(task.outputFile)
+        with self._session.get(url=f'{self._url}/output_stream',
+                               stream=True,
+                               json=args,
+                               timeout=(STATUS_TIMEOUT,
+                                        DOWNLOAD_TIMEOUT)) as r:
+            r.raise_for_status()
+            with open(task.outputFile, mode='wb') as f:
+                for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+
+    def _fetchManifest(self, task: Task):
+        """
+        Only get the list of archived files and the output, the archive
+        stays on the node
+        """
+        r = self._session.get(url=f'{self._url}/retained/{task.id}/manifest',
+                              timeout=DOWNLOAD_TIMEOUT)
+        r.raise_for_status()
+        task.remoteFiles = {x["path"]: x["size"] for x in r.json()}
+        task.remoteNode = self.name
+
+        downloadFile(self._session, f'{self._url}/retained/{task.id}/output',
+                     task.outputFile)
+
+    def fetchRetainedFile(self, taskID: str, file: str, dest: str):
+        """
+        Download a single file of a lazily transferred archive
+        """
+        # only show up once it's complete
+        temp = f"{dest}.{uuid.uuid4().hex}"
         try:
-            if self._downloadThread is not None:
-                if self._downloadThread.is_alive():
-                    # don't do anything until the download is complete
-                    return
-                else:
-                    self._downloadThread.join()
-                    self._downloadThread = None
-
-            ret = requests.get(
-                url=f'{self._url}/status?updateConfig={updateConfigs}',
-                timeout=2)
-            data = ret.json()
+            downloadFile(
+                self._session,
+                f'{self._url}/retained/{taskID}/archive?file={quote(file)}',
+                temp)
+            os.replace(temp, dest)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def fetchRetainedArchive(self, taskID: str, archivePath: str):
+        """
+        Unpack the whole of a lazily transferred archive
+        """
+        with self._session.get(
+                url=f'{self._url}/retained/{taskID}/archive_stream',
+                stream=True,
+                timeout=(STATUS_TIMEOUT, DOWNLOAD_TIMEOUT)) as r:
+            r.raise_for_status()
+            extractArchiveStream(r.raw, archivePath)
 
-            taskStatus = PipelineStatus[data["task_status"]]
+    def streamOutput(self, taskID: str, offset: int) -> Iterator[bytes]:
+        """
+        Yields the task's output from the byte offset on as the node sends
+        it, ends when the task is done or the node stops waiting for more
+        """
+        with self._session.get(url=f'{self._url}/tasks/{taskID}/output',
+                               params={"offset": offset},
+                               stream=True,
+                               timeout=(STATUS_TIMEOUT, DOWNLOAD_TIMEOUT)) as r:
+            r.raise_for_status()
+            yield from r.iter_content(STREAM_CHUNK_SIZE)
 
-            if self.currentTask is not None and taskStatus != PipelineStatus.Running and taskStatus != PipelineStatus.NotRun:
-                self._downloadThread = threading.Thread(
-                    target=self._downloadArchive,
-                    args=(self.currentTask, taskStatus))
-                self._downloadThread.start()
-                self.status = NodeStatus.Archiving
-                self.currentTask = None
+    def releaseRetained(self, taskID: str):
+        """
+        Let the node delete the files of a lazily transferred task
+        """
+        r = self._session.delete(url=f'{self._url}/retained/{taskID}',
+                                 timeout=STATUS_TIMEOUT)
+        r.raise_for_status()
+
+    def _updateSlot(self, slot: NodeSlot, data: dict, requestTime: float,
+                    lostTasks: list[Task]) -> bool:
+        """
+        Returns True if the slot became idle
+        """
+        if slot._downloadThread is not None:
+            if slot._downloadThread.is_alive():
+                # don't do anything until the download is complete
+                return False
             else:
-                self.status = NodeStatus[data['status']]
+                slot._downloadThread.join()
+                slot._downloadThread = None
+
+        try:
+            slot.workspaces = {(x["repo_url"], x["branch"], x["task_path"]):
+                               x["commit"]
+                               for x in data["workspaces"]}
+        except KeyError:
+            pass
+
+        slotStatus = NodeStatus[data['status']]
+        taskStatus = PipelineStatus[data["task_status"]]
+
+        if slot.currentTask is not None and slot.currentTask.id != data[
+                "task_id"]:
+            if requestTime < slot.sentTime:
+                # the node hasn't started our task yet, this is stale
+                return False
+            # the node lost track of the task, i.e. it restarted
+            lostTasks.append(slot.currentTask)
+            slot.currentTask = None
+
+        # the slot only goes idle after its archive has been compressed
+        if slot.currentTask is not None and slotStatus == NodeStatus.Idle and taskStatus != PipelineStatus.Running and taskStatus != PipelineStatus.NotRun:
+            slot._downloadThread = threading.Thread(
+                target=self._downloadArchive,
+                args=(slot, slot.currentTask, taskStatus))
+            slot.status = NodeStatus.Archiving
+            slot.currentTask = None
+            slot._downloadThread.start()
+        elif slot.currentTask is None:
+            return self._setSlotStatus(slot, slotStatus)
+        return False
+
+    def handleEvent(self, event: NodeEvent):
+        """
+        Apply a state change pushed by the node
+        """
+        if event.slot < 0 or event.slot >= len(self.slots):
+            return
+        becameIdle = False
+        with self._lock:
+            slot = self.slots[event.slot]
+            # events for older tasks are stale, the polls sort out lost tasks
+            if slot.currentTask is None or slot.currentTask.id != event.task_id:
+                return
+            match event.event:
+                case "step":
+                    slot.taskStep = event.step
+                case "ready":
+                    becameIdle = self._updateSlot(slot, event.model_dump(),
+                                                  time.time(), [])
+        if becameIdle:
+            self._notifyIdle()
+
+    def updateStatus(self, updateConfigs: bool):
+        requestTime = time.time()
+        # always check when the configs change, the node may be back
+        # with a new config
+        if not updateConfigs and requestTime < self._nextCheck:
+            return
+        try:
+            ret = self._session.get(
+                url=f'{self._url}/status?updateConfig={updateConfigs}',
+                timeout=STATUS_TIMEOUT)
+            data = ret.json()
         except requests.Timeout:
-            self.status = NodeStatus.Offline
+            self._setOffline()
+            return
         except requests.ConnectionError:
-            self.status = NodeStatus.Offline
+            self._setOffline()
+            return
+        self._backoff = 0.0
+        self._nextCheck = 0.0
+
+        # the node only reports slots that have been used
+        slotData = {x["slot"]: x for x in data["slots"]}
+        becameIdle = False
+        lostTasks: list[Task] = []
+        with self._lock:
+            for slot in self.slots:
+                try:
+                    curData = slotData[slot.idx]
+                except KeyError:
+                    curData = {
+                        "status": NodeStatus.Idle.name,
+                        "task_status": PipelineStatus.NotRun.name,
+                        "task_id": "",
+                    }
+                if self._updateSlot(slot, curData, requestTime, lostTasks):
+                    becameIdle = True
+
+        for task in lostTasks:
+            print(f"Node {self.name} lost task {task.meta.name}")
+            if self.onLost is not None:
+                self.onLost(task)
+
+        if becameIdle:
+            self._notifyIdle()
@@ -0,0 +1,75 @@
+from tubular_controller.nodeConnection import NodeConnection
+from tubular.task import Task
+
+NodeClass = frozenset[str]
+
+
+class NodePool:
+    """
+    Index of the nodes by their tags. Nodes with identical tags form a
+    node class, tasks are matched against classes instead of every node
+    """
+
+    def __init__(self) -> None:
+        self.nodes: list[NodeConnection] = []
+        # node class -> nodes
+        self.classes: dict[NodeClass, list[NodeConnection]] = {}
+        # (whitelist, blacklist) -> eligible node classes
+        self._eligible: dict[tuple[NodeClass, NodeClass],
+                             list[NodeClass]] = {}
+
+    def rebuild(self, nodes: list[NodeConnection]):
+        self.nodes = nodes
+        self.classes = {}
+        self._eligible = {}
+        for node in nodes:
+            self.classes.setdefault(self.getNodeClass(node), []).append(node)
+
+    @staticmethod
+    def getNodeClass(node: NodeConnection) -> NodeClass:
+        return frozenset(node.tags)
+
+    def getEligibleClasses(self, whiteTags: set[str],
+                           blackTags: set[str]) -> list[NodeClass]:
+        key = (frozenset(whiteTags), frozenset(blackTags))
+        try:
+            return self._eligible[key]
+        except KeyError:
+            pass
+
+        out: list[NodeClass] = []
+        for nodeClass in self.classes:
+            # make sure all of the whitelisted tags are present
+            if not key[0] <= nodeClass:
+                continue
+            # make sure none of the blacklisted are there
+            if not key[1].isdisjoint(nodeClass):
+                continue
+            out.append(nodeClass)
+
+        self._eligible[key] = out
+        return out
+
+    def getWarmestNode(self, task: Task, nodeClasses: list[NodeClass],
+                       default: NodeConnection) -> NodeConnection:
+        """
+        The idle node of the classes with the warmest slot for the task,
+        default unless another one is warmer
+        """
+        out = default
+        outWarmth = default.getWarmth(task)
+        for nodeClass in nodeClasses:
+            for node in self.classes.get(nodeClass, []):
+                if node.getIdleSlot() is None:
+                    continue
+                warmth = node.getWarmth(task)
+                if warmth > outWarmth:
+                    out = node
+                    outWarmth = warmth
+        return out
+
+    def getNode(self, name: str) -> NodeConnection | None:
+        for node in self.nodes:
+            if node.name == name:
+                return node
+        return None
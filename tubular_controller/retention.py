@@ -0,0 +1,74 @@
+import time
+
+from tubular.pipeline_db import StoredRun
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class RetentionLimits:
+    """
+    Limits that apply to every pipeline, on top of their own. Pipelines
+    with a keep-days of their own use that instead of the global one
+    """
+
+    def __init__(self, keepDays: float = 0, maxBytes: int = 0) -> None:
+        self.keepDays = keepDays
+        self.maxBytes = maxBytes
+
+
+def selectExpiredRuns(runs: list[StoredRun],
+                      limits: RetentionLimits) -> list[StoredRun]:
+    """
+    Pick the runs to remove, oldest first. Runs must be ordered by
+    pipeline, newest first. Active and pinned runs are never removed and
+    neither is the newest run of each pipeline, but their sizes still
+    count towards the quotas
+    """
+    now = time.time()
+    expired: list[StoredRun] = []
+    # runs that can go, but only to get under the global quota
+    spare: list[StoredRun] = []
+
+    curPipeline = -1
+    numKept = 0
+    usedBytes = 0
+    for run in runs:
+        if run.pipelineId != curPipeline:
+            curPipeline = run.pipelineId
+            numKept = 0
+            usedBytes = 0
+            isNewest = True
+        else:
+            isNewest = False
+
+        size = run.size or 0
+        if run.active or run.pinned or isNewest:
+            usedBytes += size
+            numKept += 1
+            continue
+
+        keepDays = run.keepDays if run.keepDays > 0 else limits.keepDays
+        if run.keepRuns > 0 and numKept >= run.keepRuns:
+            expired.append(run)
+        elif keepDays > 0 and now - run.startTime > keepDays * SECONDS_PER_DAY:
+            expired.append(run)
+        elif run.maxBytes > 0 and usedBytes + size > run.maxBytes:
+            expired.append(run)
+        else:
+            usedBytes += size
+            numKept += 1
+            spare.append(run)
+
+    if limits.maxBytes > 0:
+        expiredRuns = {(x.pipelineId, x.runNum) for x in expired}
+        totalBytes = sum(x.size or 0 for x in runs
+                         if (x.pipelineId, x.runNum) not in expiredRuns)
+        spare.sort(key=lambda x: x.startTime)
+        for run in spare:
+            if totalBytes <= limits.maxBytes:
+                break
+            expired.append(run)
+            totalBytes -= run.size or 0
+
+    expired.sort(key=lambda x: x.startTime)
+    return expired
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from tubular import git_cmds
+from tubular.constantManager import ConstManager
+from tubular.file_utils import ensureParents
+from tubular.repo import Repo
+from tubular.task import Task
+
+_ARCHIVE_FILE = "archive.zip"
+_OUTPUT_FILE = "output.zip"
+
+# default limits of the cache, least recently used entries are removed
+# past them, can be overridden with TUBULAR_CACHE_MAX_MB and
+# TUBULAR_CACHE_KEEP_DAYS
+CACHE_MAX_MB = 10240
+CACHE_KEEP_DAYS = 30
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class TaskCache:
+    """
+    Results of earlier task runs, keyed by a hash of everything that goes
+    into the task: its definition, the repo contents it uses, the args
+    and the constants. Only tasks with cache enabled are stored
+    """
+
+    def __init__(self) -> None:
+        self.path = ""
+        self.maxBytes = CACHE_MAX_MB * 1024 * 1024
+        self.keepDays: float = CACHE_KEEP_DAYS
+        # held while entries are read or removed
+        self._lock = threading.Lock()
+
+    def setWorkspace(self, path: str):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def getKey(self, task: Task, repo: Repo, args: dict[str, str],
+               sources: list[Task]) -> str | None:
+        """
+        Returns None if the task can't be cached. Sources are the tasks
+        whose archives the task's get-archive steps read
+        """
+        if not task.meta.cache:
+            return None
+
+        # the archives are only known to be the same when the tasks that
+        # made them were cached too
+        sourceKeys: dict[str, str] = {}
+        for source in sources:
+            if source.cacheKey is None:
+                return None
+            sourceKeys[source.meta.name] = source.cacheKey
+
+        with open(os.path.join(task.meta.repoPath, task.meta.file),
+                  mode='r') as f:
+            taskDef = f.read()
+
+        inputs: dict[str, str] = {}
+        for path in task.meta.inputs or [""]:
+            try:
+                inputs[path] = git_cmds.getObjectHash(repo, task.commit, path)
+            except RuntimeError:
+                inputs[path] = "missing"
+
+        data = {
+            "repo": task.repoUrl,
+            "task": taskDef,
+            "inputs": inputs,
+            "args": args,
+            "constants": ConstManager.constants,
+        }
+        # left out otherwise so existing keys stay the same
+        if len(sourceKeys) > 0:
+            data["sources"] = sourceKeys
+        return hashlib.sha256(json.dumps(
+            data, sort_keys=True).encode()).hexdigest()
+
+    def restore(self, key: str, task: Task) -> bool:
+        """
+        Copy the cached files to where the task's downloads would go,
+        returns False if there is nothing cached
+        """
+        entry = os.path.join(self.path, key)
+        ensureParents(task.archiveZipFile)
+        ensureParents(task.outputZipFile)
+        with self._lock:
+            if not os.path.isdir(entry):
+                return False
+            # marks it as recently used
+            os.utime(entry)
+            _linkFile(os.path.join(entry, _ARCHIVE_FILE), task.archiveZipFile)
+            _linkFile(os.path.join(entry, _OUTPUT_FILE), task.outputZipFile)
+        return True
+
+    def store(self, key: str, task: Task):
+        """
+        Link the task's downloaded files into the cache
+        """
+        entry = os.path.join(self.path, key)
+        if os.path.isdir(entry):
+            return
+        # build the entry on the side so it only ever appears complete
+        temp = os.path.join(self.path, f".{uuid.uuid4().hex}")
+        os.makedirs(temp)
+        try:
+            _linkFile(task.archiveZipFile, os.path.join(temp, _ARCHIVE_FILE))
+            _linkFile(task.outputZipFile, os.path.join(temp, _OUTPUT_FILE))
+            os.rename(temp, entry)
+        except OSError:
+            # another run stored it first
+            shutil.rmtree(temp, ignore_errors=True)
+
+    def trim(self):
+        """
+        Remove the entries that haven't been used for keepDays, then the
+        least recently used ones until the cache fits in maxBytes
+        """
+        entries: list[tuple[float, int, str]] = []
+        total = 0
+        for x in os.scandir(self.path):
+            # entries being stored
+            if x.name.startswith(".") or not x.is_dir():
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(x.path, y))
+                for y in os.listdir(x.path))
+            entries.append((x.stat().st_mtime, size, x.path))
+            total += size
+        entries.sort()
+
+        cutoff = time.time() - self.keepDays * SECONDS_PER_DAY
+        for mtime, size, path in entries:
+            if total <= self.maxBytes and (self.keepDays <= 0 or
+                                           mtime >= cutoff):
+                continue
+            temp = os.path.join(self.path, f".{uuid.uuid4().hex}")
+            with self._lock:
+                try:
+                    os.rename(path, temp)
+                except OSError:
+                    continue
+            shutil.rmtree(temp, ignore_errors=True)
+            total -= size
+
+
+def _linkFile(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # i.e. no hardlinks on this filesystem
+        shutil.copyfile(src, dst)
@@ -1,46 +1,199 @@
+import heapq
+import itertools
+import time
+from typing import Callable
+
 from tubular.pipeline import Pipeline
-from tubular_controller.nodeConnection import NodeConnection
+from tubular_controller.nodePool import NodePool, NodeClass
 from tubular.task import Task
+from tubular.enums import Priority
+
+# Tasks are ordered by a virtual deadline, the time they were queued plus a
+# delay for their priority, so a waiting task eventually beats newer tasks
+# with a higher priority instead of starving
+PRIORITY_DELAY = {
+    Priority.Manual: 0,
+    Priority.Commit: 60,
+    Priority.Schedule: 300,
+}
+
+# Each task a pipeline already has queued pushes its next task back this
+# many seconds, so one wide pipeline can't hog the nodes
+FAIR_SHARE_DELAY = 5
+
+# Tasks with a long estimated time to the end of their pipeline are
+# moved forward, so the critical path starts first and short tasks fill
+# in the gaps. The boost grows with the time but never reaches this many
+# seconds, so waiting tasks still get their turn
+MAX_CRITICAL_PATH_BOOST = 120
+# estimated time to the end of the pipeline that gets half the boost
+HALF_BOOST_RANK = 300
+
+# A node may take a task it has a warm workspace for over the head of the
+# queue, if it was due at most this many seconds after the head
+AFFINITY_WINDOW = 10
+# and it is one of the next few tasks
+AFFINITY_LOOKAHEAD = 8
+
+
+def _getBoost(rank: float) -> float:
+    """
+    Seconds a task is moved forward for its rank, longer ranks always
+    get more so tasks keep their order however long the pipeline is
+    """
+    rank = max(rank, 0.0)
+    return MAX_CRITICAL_PATH_BOOST * rank / (rank + HALF_BOOST_RANK)
 
 
 class QueueTask:
 
-    def __init__(self, pipeline: Pipeline, task: Task,
-                 availableNodes: set[NodeConnection]) -> None:
+    def __init__(self,
+                 pipeline: Pipeline,
+                 task: Task,
+                 nodeClasses: list[NodeClass],
+                 rank: float = 0.0) -> None:
         self.pipeline = pipeline
         self.task = task
-        self.availableNodes = availableNodes
-        self.prev: QueueTask | None = None
-        self.next: QueueTask | None = None
+        self.nodeClasses = nodeClasses
+        # estimated seconds from the task starting to the pipeline ending
+        self.rank = rank
+        self.key = 0.0
+        self.seq = 0
+        self.queued = False
+
+
+# (key, seq, entry id, task), the entry id keeps the tuples unique
+# when a requeued task has stale entries in a heap
+_HeapEntry = tuple[float, int, int, QueueTask]
 
 
 class TaskQueue:
+    """
+    Priority queues for each node class. Each task is pushed into the queue
+    of every class that can run it, and is lazily dropped from the others
+    once it gets popped
+    """
 
     def __init__(self) -> None:
-        self.front: QueueTask | None = None
-        self.back: QueueTask | None = None
-        self.size = 0
+        # seq -> task
+        self._items: dict[int, QueueTask] = {}
+        self._classQueues: dict[NodeClass, list[_HeapEntry]] = {}
+        # number of queued tasks per pipeline run
+        self._pipelineCounts: dict[Pipeline, int] = {}
+        self._seq = itertools.count()
+        self._entryID = itertools.count()
 
     def push(self, item: QueueTask):
-        self.size += 1
-        if self.back is None:
-            self.front = item
-            self.back = item
-        else:
-            self.back.next = item
-            item.prev = self.back
-            self.back = item
+        numQueued = self._pipelineCounts.get(item.pipeline, 0)
+        item.key = (time.time() + PRIORITY_DELAY[item.pipeline.priority] +
+                    numQueued * FAIR_SHARE_DELAY - _getBoost(item.rank))
+        item.seq = next(self._seq)
+        self._link(item)
+
+    def requeue(self, item: QueueTask):
+        """
+        Put a popped task back in its original place
+        """
+        self._link(item)
+
+    def _link(self, item: QueueTask):
+        item.queued = True
+        self._items[item.seq] = item
+        self._pipelineCounts[item.pipeline] = self._pipelineCounts.get(
+            item.pipeline, 0) + 1
+        for nodeClass in item.nodeClasses:
+            heapq.heappush(self._classQueues.setdefault(nodeClass, []),
+                           self._makeEntry(item))
+            self._compact(nodeClass)
+
+    def _makeEntry(self, item: QueueTask) -> _HeapEntry:
+        return (item.key, item.seq, next(self._entryID), item)
+
+    def popFor(
+        self,
+        nodeClass: NodeClass,
+        score: Callable[[QueueTask], int] | None = None
+    ) -> QueueTask | None:
+        """
+        Pop the next task that can run on the node class. If score is
+        given, the highest scoring task that is close enough to the head
+        of the queue is popped instead
+        """
+        try:
+            queue = self._classQueues[nodeClass]
+        except KeyError:
+            return None
+
+        candidates: list[_HeapEntry] = []
+        while len(queue) > 0 and len(candidates) < AFFINITY_LOOKAHEAD:
+            entry = heapq.heappop(queue)
+            if not entry[3].queued:
+                continue
+            if len(candidates) > 0 and entry[0] > candidates[0][
+                    0] + AFFINITY_WINDOW:
+                heapq.heappush(queue, entry)
+                break
+            candidates.append(entry)
+            if score is None:
+                break
+
+        if len(candidates) == 0:
+            return None
+
+        best = 0
+        if score is not None:
+            bestScore = score(candidates[0][3])
+            for idx in range(1, len(candidates)):
+                curScore = score(candidates[idx][3])
+                if curScore > bestScore:
+                    best = idx
+                    bestScore = curScore
+
+        for idx, entry in enumerate(candidates):
+            if idx != best:
+                heapq.heappush(queue, entry)
+
+        item = candidates[best][3]
+        self.unlink(item)
+        self._compact(nodeClass)
+        return item
 
     def unlink(self, item: QueueTask):
-        self.size -= 1
-        if item is self.back:
-            self.back = item.prev
-        if item is self.front:
-            self.front = item.next
-        if item.prev is not None:
-            item.prev.next = item.next
-        if item.next is not None:
-            item.next.prev = item.prev
+        if not item.queued:
+            return
+        item.queued = False
+        self._items.pop(item.seq, None)
+        count = self._pipelineCounts[item.pipeline] - 1
+        if count == 0:
+            del self._pipelineCounts[item.pipeline]
+        else:
+            self._pipelineCounts[item.pipeline] = count
+
+    def _compact(self, nodeClass: NodeClass):
+        """
+        Drop the entries for tasks that were popped by other classes,
+        once they make up most of the heap
+        """
+        queue = self._classQueues[nodeClass]
+        if len(queue) <= 2 * len(self._items) + 64:
+            return
+        queue = [x for x in queue if x[3].queued]
+        heapq.heapify(queue)
+        self._classQueues[nodeClass] = queue
+
+    def reindex(self, pool: NodePool):
+        """
+        Recompute the classes of every queued task after the nodes change
+        """
+        self._classQueues = {}
+        for item in self._items.values():
+            item.nodeClasses = pool.getEligibleClasses(
+                item.task.meta.whiteTags, item.task.meta.blackTags)
+            for nodeClass in item.nodeClasses:
+                self._classQueues.setdefault(nodeClass, []).append(
+                    self._makeEntry(item))
+        for queue in self._classQueues.values():
+            heapq.heapify(queue)
 
     def __len__(self) -> int:
-        return self.size
+        return len(self._items)
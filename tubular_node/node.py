@@ -1,33 +1,98 @@
+import asyncio
 import threading
+import json
 import os
+import re
 import shutil
+import time
+import requests
+from typing import AsyncIterator, BinaryIO
 
 from tubular.yaml import loadYAML
 from tubular import git_cmds
-from tubular.task import Task, TaskDef, TaskRequest
+from tubular.task import Task, TaskDef, TaskRequest, NodeEvent
 from tubular.enums import NodeStatus, PipelineStatus
 from tubular.taskEnv import TaskEnv
-from tubular.file_utils import compressArchive, compressOutputFile
+from tubular.file_utils import compressArchive, compressOutputFile, writeChecksum, hashFile, STREAM_CHUNK_SIZE
+from tubular.artifacts import ArtifactCache
 from tubular.repo import Repo
 from tubular.tempManager import TempManager
 from tubular.constantManager import ConstManager
 
 # TODO clean up old pipeline repos/branches?
 
+EVENT_TIMEOUT = 2
+
+# files of lazily transferred tasks are kept until the controller
+# releases them, or this many days as a fallback
+RETAIN_DAYS = 14
+# how often expired task files are looked for
+RETAIN_CLEAN_PERIOD = 60 * 60
+
+# how often the output of a running task is checked for more data when
+# following it, and how long to follow it without any before returning
+LIVE_OUTPUT_POLL = 0.25
+LIVE_OUTPUT_WAIT = 15
+
+_TASK_ID_RE = re.compile(r"^[0-9a-f]+$")
+
+
+class NodeSlot:
+    """
+    A single task executor, each slot has its own workspace
+    so that concurrent tasks never share a checkout
+    """
+
+    def __init__(self, idx: int, workspace: str) -> None:
+        self.idx = idx
+        self.workspace = workspace
+        self.status = NodeStatus.Idle
+        self.taskStatus = PipelineStatus.Success
+        self.taskID = ""
+        # output file of the running task
+        self.outputFile = ""
+        self.workerThread = threading.Thread()
+        # (repo url, branch, task path) -> hex commit, for the task
+        # workspaces kept in this slot
+        self.workspaces: dict[tuple[str, str, str], str] = {}
+
+    def getStatus(self) -> dict:
+        return {
+            "slot": self.idx,
+            "status": self.status.name,
+            "task_status": self.taskStatus.name,
+            "task_id": self.taskID,
+            "workspaces": [{
+                "repo_url": x[0],
+                "branch": x[1],
+                "task_path": x[2],
+                "commit": commit,
+            } for x, commit in list(self.workspaces.items())],
+        }
+
 
 class NodeState:
 
     def __init__(self) -> None:
         self.workspace = ""
-        self.status = NodeStatus.Idle
-        self.workerThread = threading.Thread()
-        self.taskStatus = PipelineStatus.Success
+        # slot index -> slot, slots are created on first use
+        self.slots: dict[int, NodeSlot] = {}
+        self._slotLock = threading.Lock()
 
         self.configRepo = Repo("", "", "")
         self.configCommit = bytearray()
 
         self.needUpdateConfig = False
 
+        # task ID -> files of lazily transferred tasks
+        self.retainedPath = ""
+        self.retainDays: float = RETAIN_DAYS
+        self.shouldRun = True
+        self._cleanerThread = threading.Thread()
+        self._cleanerCV = threading.Condition()
+        # files fetched by get-archive steps
+        self.artifactCache = ArtifactCache()
+
     def start(self):
         try:
             self.workspace = os.path.join(
@@ -51,6 +116,18 @@ class NodeState:
         self.configRepo = Repo(configRepoUrl, configBranch, configDir)
         self.loadConfigs()
 
+        try:
+            self.retainDays = float(os.environ["TUBULAR_RETAIN_DAYS"])
+        except KeyError:
+            pass
+        self.retainedPath = os.path.join(self.workspace, "retained")
+        os.makedirs(self.retainedPath, exist_ok=True)
+        self._cleanerThread = threading.Thread(target=self.cleanerThread)
+        self._cleanerThread.start()
+
+        self.artifactCache.setWorkspace(
+            os.path.join(self.workspace, "artifacts"))
+
     def loadConfigs(self):
         remoteCommit = git_cmds.getLatestRemoteCommit(self.configRepo)
         if self.configCommit == remoteCommit:
@@ -67,75 +144,317 @@ class NodeState:
 
         TempManager.setWorkspace(os.path.join(self.workspace, "temp"))
 
+    def cleanerThread(self):
+        """
+        Removes the files of lazily transferred tasks the controller never
+        released, i.e. because it lost track of them
+        """
+        while self.shouldRun:
+            try:
+                self._cleanRetained()
+            except Exception as err:
+                print("Unable to remove expired task files:", err)
+            with self._cleanerCV:
+                if self.shouldRun:
+                    self._cleanerCV.wait(RETAIN_CLEAN_PERIOD)
+
+    def _cleanRetained(self):
+        cutoff = time.time() - self.retainDays * 24 * 60 * 60
+        for x in os.scandir(self.retainedPath):
+            if x.stat().st_mtime < cutoff:
+                print("Removing expired task files", x.name)
+                shutil.rmtree(x.path, ignore_errors=True)
+
     def stop(self):
-        if self.workerThread.is_alive():
-            self.workerThread.join()
+        with self._cleanerCV:
+            self.shouldRun = False
+            self._cleanerCV.notify()
+        if self._cleanerThread.is_alive():
+            self._cleanerThread.join()
+        for slot in list(self.slots.values()):
+            if slot.workerThread.is_alive():
+                slot.workerThread.join()
+
+    @property
+    def status(self) -> NodeStatus:
+        for slot in list(self.slots.values()):
+            if slot.status == NodeStatus.Active:
+                return NodeStatus.Active
+        return NodeStatus.Idle
+
+    def getSlot(self, idx: int) -> NodeSlot:
+        if idx < 0:
+            raise RuntimeError(f"Invalid slot: {idx}")
+        with self._slotLock:
+            try:
+                return self.slots[idx]
+            except KeyError:
+                slot = NodeSlot(idx, os.path.join(self.workspace,
+                                                  f"slot{idx}"))
+                self.slots[idx] = slot
+                return slot
+
+    def getStatus(self) -> list[dict]:
+        return [x.getStatus() for x in list(self.slots.values())]
 
     def queueTask(self, task: TaskRequest):
-        if self.status == NodeStatus.Active:
-            raise RuntimeError("Task already running")
+        slot = self.getSlot(task.slot)
+        with self._slotLock:
+            if slot.status == NodeStatus.Active:
+                raise RuntimeError(f"Task already running in slot {slot.idx}")
 
-        self.taskStatus = PipelineStatus.Running
+            slot.taskStatus = PipelineStatus.Running
+            slot.status = NodeStatus.Active
+            slot.taskID = task.task_id
 
-        self.status = NodeStatus.Active
-        self.workerThread = threading.Thread(
+        slot.workerThread = threading.Thread(
             target=self.runTask,
-            args=(task, ),
+            args=(slot, task),
         )
-        self.workerThread.start()
+        slot.workerThread.start()
 
-    def runTask(self, taskReq: TaskRequest):
-        # always attempt to update configs before starting a task
-        if self.needUpdateConfig:
+    def _updateConfigsIfNeeded(self, curSlot: NodeSlot):
+        with self._slotLock:
+            if not self.needUpdateConfig:
+                return
+            # loading configs resets the temp dirs, so we
+            # can't do it while another slot is busy
+            for slot in self.slots.values():
+                if slot is not curSlot and slot.status == NodeStatus.Active:
+                    return
             self.loadConfigs()
             self.needUpdateConfig = False
 
-        repoDir = os.path.join(self.workspace, taskReq.getRepoPath())
+    def _sendEvent(self,
+                   slot: NodeSlot,
+                   taskReq: TaskRequest,
+                   event: str,
+                   step: int = -1):
+        """
+        Tell the controller about a slot state change right away, if
+        this fails the controller still finds out on its next poll
+        """
+        if len(taskReq.callback_url) == 0:
+            return
+        data = NodeEvent(event=event, step=step, **slot.getStatus())
+        try:
+            requests.post(url=taskReq.callback_url,
+                          json=data.model_dump(),
+                          timeout=EVENT_TIMEOUT)
+        except requests.RequestException as err:
+            print("Unable to send event:", err)
+
+    def runTask(self, slot: NodeSlot, taskReq: TaskRequest):
+        try:
+            self._runTask(slot, taskReq)
+        finally:
+            self._sendEvent(slot, taskReq, "ready")
+
+    def _runTask(self, slot: NodeSlot, taskReq: TaskRequest):
+        self._sendEvent(slot, taskReq, "started")
+        # always attempt to update configs before starting a task
+        self._updateConfigsIfNeeded(slot)
+
+        repoDir = os.path.join(slot.workspace, taskReq.getRepoPath())
         repo = Repo(taskReq.repo_url, taskReq.branch, repoDir)
         try:
             git_cmds.cloneOrPull(repo)
+            # pin to the commit the pipeline run resolved
+            if len(taskReq.commit) > 0:
+                commit = bytes.fromhex(taskReq.commit)
+                if git_cmds.getCurrentLocalCommit(repo) != commit:
+                    git_cmds.checkoutCommit(repo, commit)
             taskDef = TaskDef(repoDir, taskReq.task_path)
             taskWorkspace = os.path.join(repoDir, f'{taskDef.name}.workspace')
             taskArchive = os.path.join(repoDir, f'{taskDef.name}.archive')
             taskOutput = os.path.join(repoDir, f'{taskDef.name}.output')
+            slot.outputFile = taskOutput
             task = Task(taskReq.repo_url, taskReq.branch, taskDef, taskArchive,
                         taskOutput)
         except:
-            self.taskStatus = PipelineStatus.Error
+            slot.taskStatus = PipelineStatus.Error
+            slot.status = NodeStatus.Idle
             raise
 
         if not os.path.isdir(taskWorkspace):
             os.makedirs(taskWorkspace, exist_ok=True)
+        slot.workspaces[(taskReq.repo_url, taskReq.branch,
+                         taskReq.task_path)] = git_cmds.getCurrentLocalCommit(
+                             repo).hex()
 
-        # Create archive dir
+        # Create archive dir, streamed archives are left
+        # in place after the last run
+        if os.path.isdir(taskArchive):
+            shutil.rmtree(taskArchive)
         os.makedirs(taskArchive, exist_ok=True)
 
         taskEnv = TaskEnv(taskWorkspace, taskArchive, taskOutput, taskReq.args)
+        taskEnv.artifacts = {x.task: x for x in taskReq.artifacts}
+        taskEnv.artifactCache = self.artifactCache
         taskEnv.start()
 
         try:
-            task.run(taskEnv)
-            self.taskStatus = PipelineStatus.Success
+            task.run(
+                taskEnv,
+                lambda idx: self._sendEvent(slot, taskReq, "step", idx))
+            slot.taskStatus = PipelineStatus.Success
         except:
-            self.taskStatus = PipelineStatus.Fail
-        print("Task complete")
+            slot.taskStatus = PipelineStatus.Fail
+        print(f"Task complete, slot {slot.idx}")
 
-        compressArchive(taskArchive, f'{taskArchive}.zip')
-        compressOutputFile(taskOutput)
+        if len(taskDef.archiveSources) > 0:
+            try:
+                self.artifactCache.trim()
+            except OSError as err:
+                print("Unable to trim the artifact cache:", err)
 
-        # Clear archive dir
-        shutil.rmtree(taskArchive)
-        # Clear output file
+        try:
+            if taskReq.transfer == "lazy":
+                # keep the files until the controller wants them
+                self._retainFiles(taskReq, taskArchive, taskOutput)
+            # streamed files get packed as they are downloaded
+            elif taskReq.transfer != "stream":
+                compressArchive(taskArchive, f'{taskArchive}.zip',
+                                taskReq.compression)
+                writeChecksum(f'{taskArchive}.zip')
+                writeChecksum(
+                    compressOutputFile(taskOutput, taskReq.compression))
 
-        self.status = NodeStatus.Idle
+                # Clear archive dir
+                shutil.rmtree(taskArchive)
+        except Exception as err:
+            print("Error archiving task:", err)
+            slot.taskStatus = PipelineStatus.Error
+        finally:
+            # always free up the slot
+            slot.status = NodeStatus.Idle
+
+    def _getRepoDir(self, taskReq: TaskRequest) -> str:
+        slot = self.getSlot(taskReq.slot)
+        return os.path.join(slot.workspace, taskReq.getRepoPath())
 
     def getArchiveFile(self, taskReq: TaskRequest):
-        repoDir = os.path.join(self.workspace, taskReq.getRepoPath())
+        repoDir = self._getRepoDir(taskReq)
         task = TaskDef(repoDir, taskReq.task_path)
         return os.path.join(repoDir, f'{task.name}.archive.zip')
 
     def getOutputFile(self, taskReq: TaskRequest):
-        repoDir = os.path.join(self.workspace, taskReq.getRepoPath())
+        repoDir = self._getRepoDir(taskReq)
         task = TaskDef(repoDir, taskReq.task_path)
 
         return os.path.join(repoDir, f'{task.name}.output.zip')
+
+    def getArchiveDir(self, taskReq: TaskRequest):
+        repoDir = self._getRepoDir(taskReq)
+        task = TaskDef(repoDir, taskReq.task_path)
+        return os.path.join(repoDir, f'{task.name}.archive')
+
+    def getRawOutputFile(self, taskReq: TaskRequest):
+        repoDir = self._getRepoDir(taskReq)
+        task = TaskDef(repoDir, taskReq.task_path)
+        return os.path.join(repoDir, f'{task.name}.output')
+
+    def _retainFiles(self, taskReq: TaskRequest, taskArchive: str,
+                     taskOutput: str):
+        retained = self.getRetainedDir(taskReq.task_id)
+        if os.path.exists(retained):
+            shutil.rmtree(retained)
+        os.makedirs(retained)
+        shutil.move(taskArchive, os.path.join(retained, "archive"))
+        shutil.move(taskOutput, os.path.join(retained, "output"))
+
+    def getRetainedDir(self, taskID: str) -> str:
+        if _TASK_ID_RE.match(taskID) is None:
+            raise RuntimeError(f"Invalid task ID: {taskID}")
+        return os.path.join(self.retainedPath, taskID)
+
+    def getRetainedManifest(self, taskID: str) -> list[dict]:
+        """
+        The files in the task's archive, with their sizes and hashes.
+        It's saved the first time it's asked for
+        """
+        retained = self.getRetainedDir(taskID)
+        manifest = os.path.join(retained, "manifest.json")
+        try:
+            with open(manifest, mode='r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+
+        archive = os.path.join(retained, "archive")
+        if not os.path.isdir(archive):
+            raise RuntimeError(f"No files for task {taskID}")
+        out = []
+        for root, _, files in os.walk(archive):
+            for x in files:
+                fullPath = os.path.join(root, x)
+                out.append({
+                    "path": os.path.relpath(fullPath, archive),
+                    "size": os.path.getsize(fullPath),
+                    "sha256": hashFile(fullPath),
+                })
+
+        temp = f"{manifest}.{threading.get_ident()}"
+        with open(temp, mode='w') as f:
+            json.dump(out, f)
+        os.replace(temp, manifest)
+        return out
+
+    def releaseRetained(self, taskID: str):
+        shutil.rmtree(self.getRetainedDir(taskID), ignore_errors=True)
+
+    def _openOutput(self, taskID: str) -> tuple[BinaryIO | None, NodeSlot | None]:
+        """
+        Open the output of the task, with the slot running it. None if the
+        task hasn't written any yet
+        """
+        retained = os.path.join(self.getRetainedDir(taskID), "output")
+        for slot in list(self.slots.values()):
+            if slot.taskID != taskID or len(slot.outputFile) == 0:
+                continue
+            try:
+                return open(slot.outputFile, mode='rb'), slot
+            except FileNotFoundError:
+                # lazily transferred outputs are moved once the task is done
+                if slot.status == NodeStatus.Active and not os.path.isfile(retained):
+                    return None, slot
+        try:
+            return open(retained, mode='rb'), None
+        except FileNotFoundError:
+            raise RuntimeError(f"No output for task {taskID}")
+
+    def followOutput(self, taskID: str, offset: int) -> AsyncIterator[bytes]:
+        """
+        Yields the task's output from the byte offset on, waiting for more
+        while the task runs. Returns at the end of the output once the task
+        is done, or when nothing new was written for LIVE_OUTPUT_WAIT
+        seconds so the caller can check on it and come back. Waiting
+        doesn't hold a thread, only the reads are blocking and they're local
+        """
+        # opened up front so missing tasks fail before the response starts
+        f, slot = self._openOutput(taskID)
+        return self._followOutput(f, slot, taskID, offset)
+
+    async def _followOutput(self, f: BinaryIO | None,
+                            slot: NodeSlot | None, taskID: str,
+                            offset: int) -> AsyncIterator[bytes]:
+
+        def isRunning() -> bool:
+            return (slot is not None and slot.taskID == taskID and
+                    slot.status == NodeStatus.Active)
+
+        if f is None:
+            return
+        with f:
+            f.seek(offset)
+            idleTime = 0.0
+            while True:
+                data = f.read(STREAM_CHUNK_SIZE)
+                if len(data) > 0:
+                    idleTime = 0.0
+                    yield data
+                    continue
+                if not isRunning() or idleTime >= LIVE_OUTPUT_WAIT:
+                    return
+                await asyncio.sleep(LIVE_OUTPUT_POLL)
+                idleTime += LIVE_OUTPUT_POLL
@@ -1,9 +1,11 @@
 from typing import Dict, Any
 
 from tubular_node.node import NodeState, TaskRequest
+from tubular.file_utils import streamArchive, readChecksum, sanitizeFilepath, CHECKSUM_HEADER
+import os
 
 from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from contextlib import asynccontextmanager
 
 NODE_STATE = NodeState()
@@ -31,22 +33,86 @@ async def getStatus(updateConfig: bool = False):
         NODE_STATE.needUpdateConfig = True
     return {
         "status": NODE_STATE.status.name,
-        "task_status": NODE_STATE.taskStatus.name,
+        "slots": NODE_STATE.getStatus(),
     }
 
 
+def _makeFileResponse(path: str) -> FileResponse:
+    """
+    FileResponse handles Range requests, so interrupted downloads
+    can resume, the checksum lets the controller verify the result
+    """
+    headers = {}
+    checksum = readChecksum(path)
+    if checksum is not None:
+        headers[CHECKSUM_HEADER] = checksum
+    return FileResponse(path, headers=headers)
+
+
 @app.get("/archive")
 async def getArchive(task: TaskRequest) -> FileResponse:
     archive = NODE_STATE.getArchiveFile(task)
-    return FileResponse(archive)
+    return _makeFileResponse(archive)
 
 
 @app.get("/output")
 async def getOutput(task: TaskRequest) -> FileResponse:
     output = NODE_STATE.getOutputFile(task)
+    return _makeFileResponse(output)
+
+
+@app.get("/archive_stream")
+async def getArchiveStream(task: TaskRequest) -> StreamingResponse:
+    archive = NODE_STATE.getArchiveDir(task)
+    return StreamingResponse(streamArchive(archive),
+                             media_type="application/x-tar")
+
+
+@app.get("/output_stream")
+async def getOutputStream(task: TaskRequest) -> FileResponse:
+    output = NODE_STATE.getRawOutputFile(task)
     return FileResponse(output)
 
 
+@app.get("/retained/{taskID}/manifest")
+def getRetainedManifest(taskID: str) -> list[dict]:
+    return NODE_STATE.getRetainedManifest(taskID)
+
+
+@app.get("/retained/{taskID}/archive")
+async def getRetainedFile(taskID: str, file: str) -> FileResponse:
+    archive = os.path.join(NODE_STATE.getRetainedDir(taskID), "archive")
+    return FileResponse(sanitizeFilepath(archive, file))
+
+
+@app.get("/retained/{taskID}/archive_stream")
+async def getRetainedArchive(taskID: str) -> StreamingResponse:
+    archive = os.path.join(NODE_STATE.getRetainedDir(taskID), "archive")
+    return StreamingResponse(streamArchive(archive),
+                             media_type="application/x-tar")
+
+
+@app.get("/retained/{taskID}/output")
+async def getRetainedOutput(taskID: str) -> FileResponse:
+    output = os.path.join(NODE_STATE.getRetainedDir(taskID), "output")
+    return FileResponse(output)
+
+
+@app.get("/tasks/{taskID}/output")
+def getLiveOutput(taskID: str, offset: int = 0) -> StreamingResponse:
+    """
+    The task's output from the byte offset on, it's followed while
+    the task runs
+    """
+    return StreamingResponse(NODE_STATE.followOutput(taskID, max(offset, 0)),
+                             media_type="application/octet-stream")
+
+
+@app.delete("/retained/{taskID}")
+async def releaseRetained(taskID: str):
+    NODE_STATE.releaseRetained(taskID)
+
+
 @app.post("/queue")
 async def addTask(task: TaskRequest):
     NODE_STATE.queueTask(task)